@@ -0,0 +1,107 @@
+"""Check that STIR histograms the listmode file of `synthetic_input.py` as intended.
+
+The prompts and delayeds of the whole acquisition are histogrammed with
+STIR's `lm_to_projdata` and compared with the events in the listmode file:
+the total counts have to be equal, and so do the counts of every view and
+tangential position summed over all sinograms, which checks the header
+and the transaxial bin mapping of `EventSampler`.
+The result is stored as 'stir_check' in `synthetic_input.json`, `run_recon.sh`
+only reconstructs synthetic data which passed.
+Needs SIRF and STIR, run it in the container after writing the data:
+
+Usage: python check_synthetic_input.py INPUT_DIR
+"""
+
+import sys
+import json
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from sirf.STIR import AcquisitionData
+
+from listmode import histogram_frames, sinogram_counts
+from synthetic_input import NUM_TANGENTIAL, NUM_VIEWS, PROMPT_BIT, TIME_TAG
+
+
+def transaxial_profile(addresses: np.ndarray) -> np.ndarray:
+    """Counts of every view and tangential position of listmode bin addresses."""
+    bins = addresses % (NUM_VIEWS * NUM_TANGENTIAL)
+    return np.bincount(bins, minlength=NUM_VIEWS * NUM_TANGENTIAL).reshape(
+        NUM_VIEWS, NUM_TANGENTIAL
+    )
+
+
+def read_listmode_events(list_file: Path) -> dict:
+    """Bin addresses of the prompts and delayeds in a listmode data file."""
+    words = np.fromfile(list_file, dtype="<u4")
+    events = words[(words & TIME_TAG) == 0]
+    is_prompt = (events & PROMPT_BIT) != 0
+    return {
+        "prompts": events[is_prompt] & (PROMPT_BIT - 1),
+        "delayeds": events[~is_prompt],
+    }
+
+
+def check_synthetic_input(input_dir: Path) -> bool:
+    """Histogram the synthetic listmode file with STIR and compare it to its events.
+
+    :param input_dir: Directory written by synthetic_input.py
+    :return: Whether the counts and transaxial profiles of prompts and delayeds match
+    """
+    with open(input_dir / "synthetic_input.json") as f:
+        parameters = json.load(f)
+    list_header = input_dir / parameters["listmode_header"]
+    events = read_listmode_events(list_header.with_suffix(""))
+
+    matches = True
+    with tempfile.TemporaryDirectory() as tmpdir:
+        template_file = str(Path(tmpdir) / "template.hs")
+        AcquisitionData(
+            "Siemens_mMR", span=11, max_ring_diff=60, view_mash_factor=1
+        ).write(template_file)
+
+        for name, addresses in events.items():
+            (sinogram_file,) = histogram_frames(
+                str(list_header),
+                template_file,
+                [(0, parameters["duration"])],
+                str(Path(tmpdir) / name),
+                delayeds=name == "delayeds",
+            )
+            counts = sinogram_counts(sinogram_file)
+            profile = (
+                AcquisitionData(sinogram_file)
+                .as_array()
+                .reshape(-1, NUM_VIEWS, NUM_TANGENTIAL)
+                .sum(axis=0)
+            )
+            expected_profile = transaxial_profile(addresses)
+            profile_matches = np.array_equal(np.rint(profile), expected_profile)
+            print(
+                f"{name}: {counts:.0f} counts in the sinogram, {len(addresses)} events, "
+                f"transaxial profile {'matches' if profile_matches else 'differs'}"
+            )
+            matches &= counts == len(addresses) and profile_matches
+    return matches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "input_dir", type=Path, help="Directory written by synthetic_input.py"
+    )
+    args = parser.parse_args()
+
+    passed = check_synthetic_input(args.input_dir)
+    parameters_file = args.input_dir / "synthetic_input.json"
+    with open(parameters_file) as f:
+        parameters = json.load(f)
+    parameters["stir_check"] = "passed" if passed else "failed"
+    with open(parameters_file, "w") as f:
+        json.dump(parameters, f, indent=2)
+    sys.exit(0 if passed else 1)
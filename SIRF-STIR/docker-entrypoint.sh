@@ -53,7 +53,10 @@ if [ "$1" = 'recon' ]; then
     check_stir_files_exist
     verifyInputs
     extractOnDemand
-    nm_mrac2mu -i ./input/MRAC -o ./output/human_mumap.nii || true  # Fails in the end but file is still output
+    # Synthetic input (see synthetic_input.py) comes without MRAC but with human_mumap.nii
+    if [ -d ./input/MRAC ]; then
+        nm_mrac2mu -i ./input/MRAC -o ./output/human_mumap.nii || true  # Fails in the end but file is still output
+    fi
     python merge_umaps.py ./input/hardware_umap.nii ./output/human_mumap.nii ./output/combined_mumap.nii
     python recon.py $2 $3 $4
 else if [ "$1" = 'sleep' ]; then
@@ -0,0 +1,154 @@
+"""Histogram listmode data for all frames at once.
+
+`ListmodeToSinograms` handles a single time interval and scans the listmode
+file from the beginning for every frame. STIR's `lm_to_projdata` accepts a frame
+definition file with many frames and histograms all of them while walking through
+the file once, so the total listmode I/O is linear in the file size.
+"""
+
+import os
+import subprocess
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+LM_TO_PROJDATA_PAR = """lm_to_projdata Parameters:=
+  input file := {list_file}
+  output filename prefix := {prefix}
+  template_projdata := {template}
+  frame_definition file := {frame_definition_file}
+  Store 'prompts' := {store_prompts}
+  Store 'delayeds' := {store_delayeds}
+End :=
+"""
+
+
+def write_frame_definitions(
+    filepath: str, intervals: List[Tuple[float, float]]
+) -> List[Optional[int]]:
+    """Write a STIR frame definition file covering all intervals.
+
+    STIR frames always start at the beginning of the acquisition and follow
+    each other without gaps, so gaps before or between intervals are
+    written as additional frames which are histogrammed but not used.
+
+    :param filepath: Path of the `.fdef` file to write
+    :param intervals: Sorted, non overlapping (start, end) tuples in seconds
+    :return: For every STIR frame (numbered from 1) the index of the interval
+        it corresponds to or None for gap frames
+    """
+    frame_to_interval = []
+    current_time = 0
+    with open(filepath, "w") as f:
+        for interval_idx, (start, end) in enumerate(intervals):
+            if start > current_time:
+                f.write(f"1 {start - current_time}\n")
+                frame_to_interval.append(None)
+            f.write(f"1 {end - start}\n")
+            frame_to_interval.append(interval_idx)
+            current_time = end
+    return frame_to_interval
+
+
+def frame_sinogram_file(prefix: str, stir_frame_num: int) -> str:
+    """Header filename `lm_to_projdata` writes for a frame."""
+    return f"{prefix}_f{stir_frame_num}g1d0b0.hs"
+
+
+def histogram_frames(
+    list_file: str,
+    template_file: str,
+    intervals: List[Tuple[float, float]],
+    prefix: str,
+    delayeds: bool = False,
+) -> List[str]:
+    """Histogram prompts or delayeds of all intervals in a single pass over the listmode file.
+
+    The sinograms of all frames are written before this returns, every frame
+    needs disk space for one sinogram (about 0.3 GB for the mMR at span 11).
+    Delete the files once they are used.
+
+    :param list_file: Listmode header in STIR .l.hdr format
+    :param template_file: Template sinogram defining the geometry
+    :param intervals: Sorted, non overlapping (start, end) tuples in seconds
+    :param prefix: Output filename prefix
+    :param delayeds: Histogram delayed instead of prompt coincidences
+    :return: Sinogram header filenames in the order of `intervals`
+    """
+    frame_definition_file = f"{prefix}.fdef"
+    par_file = f"{prefix}.par"
+    frame_to_interval = write_frame_definitions(frame_definition_file, intervals)
+
+    with open(par_file, "w") as f:
+        f.write(
+            LM_TO_PROJDATA_PAR.format(
+                list_file=list_file,
+                prefix=prefix,
+                template=template_file,
+                frame_definition_file=frame_definition_file,
+                store_prompts=int(not delayeds),
+                store_delayeds=int(delayeds),
+            )
+        )
+    subprocess.run(["lm_to_projdata", par_file], check=True)
+
+    sinogram_files = [None] * len(intervals)
+    for stir_frame_num, interval_idx in enumerate(frame_to_interval, 1):
+        filename = frame_sinogram_file(prefix, stir_frame_num)
+        if interval_idx is None:
+            remove_sinogram(filename)
+        else:
+            sinogram_files[interval_idx] = filename
+    return sinogram_files
+
+
+def remove_sinogram(header_file: str) -> None:
+    """Remove a STIR interfile sinogram header and its data file."""
+    for filename in (header_file, f"{header_file[:-3]}.s"):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def sinogram_counts(header_file: str) -> float:
+    """Total counts of an interfile sinogram, read with numpy instead of STIR.
+
+    :param header_file: Sinogram header as written by `lm_to_projdata`
+    :return: Sum over all bins
+    """
+    keys = dict()
+    with open(header_file) as f:
+        for line in f:
+            key, separator, value = line.partition(":=")
+            if separator:
+                keys[key.strip().lstrip("!").lower()] = value.strip()
+
+    if keys.get("number format", "float") != "float" or (
+        keys.get("number of bytes per pixel", "4") != "4"
+    ):
+        raise ValueError(f"Only 4 byte float sinograms are supported: {header_file}")
+    byte_order = (
+        ">" if keys.get("imagedata byte order", "").upper() == "BIGENDIAN" else "<"
+    )
+    data = np.memmap(
+        os.path.join(os.path.dirname(header_file), keys["name of data file"]),
+        dtype=f"{byte_order}f4",
+        mode="r",
+        offset=int(keys.get("data offset in bytes[1]", 0)),
+    )
+    return float(data.sum(dtype=np.float64))
+
+
+def detector_pairs(num_views: int, num_tangential: int) -> Tuple[np.ndarray, ...]:
+    """Transaxial detector numbers of the two ends of every sinogram bin.
+
+    Mirrors `ProjDataInfoCylindricalNoArcCorr::get_det_num_pair_for_view_tangential_pos_num`
+    in STIR for data without view mashing (num_detectors = 2 * num_views).
+
+    :return: det1, det2 arrays of shape (num_views, num_tangential)
+    """
+    num_detectors = 2 * num_views
+    views = np.arange(num_views)[:, None]
+    tang_pos = np.arange(num_tangential)[None, :] - num_tangential // 2
+    det1 = (views + (tang_pos >> 1)) % num_detectors
+    det2 = (views - ((tang_pos + 1) >> 1) + num_detectors // 2) % num_detectors
+    return det1, det2
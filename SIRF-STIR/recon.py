@@ -1,20 +1,52 @@
 import os
 import sys
-from typing import Tuple, Any
+import json
+import time
+import itertools
+import multiprocessing
+from typing import List, Tuple, Any
 from pathlib import Path
+from datetime import datetime
 
 import numpy as np
-import nibabel as nib
 from sirf.STIR import *
 import sirf.Reg as reg
 
-from utils import get_intervals, get_file_with_suffix, ReconMetadata
+from utils import (
+    get_intervals,
+    get_file_with_suffix,
+    get_num_workers,
+    hash_inputs,
+    memory_growth_report,
+    read_metadata_records,
+    Nifti4DWriter,
+    ReconMetadata,
+    RECORD_FILE_NAME,
+)
+from listmode import (
+    frame_sinogram_file,
+    histogram_frames,
+    remove_sinogram,
+    sinogram_counts,
+)
 
 output_path = Path(f"./output/")
 
-meta = ReconMetadata(os.getenv("GIT_COMMIT_SHORT_SHA"))
+# Record the RSS around every block and optionally the top Python allocations
+TRACK_MEMORY = os.getenv("RECON_TRACK_MEMORY") == "1"
+TRACE_ALLOCATIONS = int(os.getenv("RECON_TRACE_ALLOCATIONS", 0))
+
+meta = ReconMetadata(
+    os.getenv("GIT_COMMIT_SHORT_SHA"),
+    output_path,
+    track_memory=TRACK_MEMORY,
+    trace_allocations=TRACE_ALLOCATIONS,
+)
 meta.start()
 
+meta.add_metadatum("track_memory", TRACK_MEMORY)
+meta.add_metadatum("trace_allocations", TRACE_ALLOCATIONS)
+
 TIME_START, TIME_END, TIME_STEP = [int(val) for val in sys.argv[1:]]
 meta.add_metadatum("time_start", TIME_START)
 meta.add_metadatum("time_end", TIME_END)
@@ -29,11 +61,25 @@ list_file = get_file_with_suffix(".l.hdr", input_data_path)
 norm_file = get_file_with_suffix(".n.hdr", input_data_path)
 attn_file = os.path.join(outpu_data_path, "combined_mumap.nii")
 
+# frame invariant intermediate results reused across runs
+CACHE_DIR = Path(outpu_data_path) / "cache"
+# sha256 of the input files by path, size and modification time, see file_digest
+DIGEST_CACHE_FILE = CACHE_DIR / "file_digests.json"
+
 # output filename prefixes
 SINO_FILE_PREFIX = "sino"
+DELAYEDS_FILE_PREFIX = "delayeds"
 
-IMAGE_X_SIZE = meta.add_metadatum("image_x_size", 344)
-IMAGE_Y_SIZE = meta.add_metadatum("image_y_size", 344)
+# 4D result written frame by frame
+RESULT_FILE = output_path / "result.nii"
+
+# Transaxial image size in voxels, smaller sizes speed up every block but the histogramming
+IMAGE_X_SIZE = meta.add_metadatum(
+    "image_x_size", int(os.getenv("RECON_IMAGE_SIZE", 344))
+)
+IMAGE_Y_SIZE = meta.add_metadatum(
+    "image_y_size", int(os.getenv("RECON_IMAGE_SIZE", 344))
+)
 
 # Choose a number of subsets.
 # For the mMR, best performance requires to not use a multiple of 9 as there are gaps
@@ -42,8 +88,40 @@ NUM_SUBSETS = meta.add_metadatum("num_subsets", 21)
 # (Clinical reconstructions use around 60 subiterations, e.g. 21 subsets, 3 full iterations)
 NUM_SUBITERATIONS = meta.add_metadatum("num_subiterations", 60)
 
+# Start every frame from the previous frame's estimate scaled by the ratio of prompt counts.
+# Voxels are raised to a fraction of the mean, multiplicative OSEM updates keep zeros at zero
+WARM_START = meta.add_metadatum("warm_start", os.getenv("RECON_WARM_START") == "1")
+WARM_START_FLOOR = meta.add_metadatum("warm_start_floor", 0.01)
+# Stop once a full iteration changes the estimate by less than this (relative L2 norm),
+# NUM_SUBITERATIONS is the upper limit. 0 always runs NUM_SUBITERATIONS
+CONVERGENCE_TOLERANCE = meta.add_metadatum(
+    "convergence_tolerance", float(os.getenv("RECON_CONVERGENCE_TOLERANCE", 0))
+)
+
 NUM_ITERATIONS_SCATTER = meta.add_metadatum("num_iterations_scatter", 3)
 NUM_SUBSETS_SCATTER = meta.add_metadatum("num_subsets_scatter", 21)
+# Scatter changes slowly, estimate it once on the sum of this many consecutive frames
+# and scale it to every frame of the group by its prompt counts. 1 estimates every frame
+SCATTER_GROUP_SIZE = meta.add_metadatum(
+    "scatter_group_size", int(os.getenv("RECON_SCATTER_GROUP_SIZE", 1))
+)
+
+# Estimate randoms once from the delayeds of the whole scan and scale them to every frame
+# by its delayeds (see load_or_make_randoms_model) instead of estimating them per frame.
+# The delayeds of all frames are counted with one pass over the listmode file
+RANDOMS_MODEL = meta.add_metadatum(
+    "randoms_model", os.getenv("RECON_RANDOMS_MODEL", "1") == "1"
+)
+# Histogram all frames in one pass over the listmode file instead of one ListmodeToSinograms
+# per frame, which reads the file from its start up to the end of the frame, so the listmode I/O
+# is linear instead of quadratic in the number of frames.
+# Needs temporary disk space for the prompts sinograms of all frames at once and RANDOMS_MODEL,
+# without a ListmodeToSinograms per frame there is no per frame randoms estimate
+SINGLE_PASS_HISTOGRAM = meta.add_metadatum(
+    "single_pass_histogram", os.getenv("RECON_SINGLE_PASS_HISTOGRAM", "1") == "1"
+)
+if SINGLE_PASS_HISTOGRAM and not RANDOMS_MODEL:
+    raise ValueError("RECON_SINGLE_PASS_HISTOGRAM=1 needs RECON_RANDOMS_MODEL=1")
 
 PRE_SMOOTHING_FWHM = meta.add_metadatum("psf_fwhm", 4)
 
@@ -51,6 +129,26 @@ SPAN = meta.add_metadatum("span", 11)
 MAX_RING_DIFF = meta.add_metadatum("max_ring_diff", 60)
 VIEW_MASH_FACTOR = meta.add_metadatum("view_mash_factor", 1)
 
+# Frames are reconstructed by up to RECON_WORKERS processes in parallel,
+# as many as fit into the RAM budget with the peak RAM of one worker (0 disables the budget)
+RECON_WORKERS = meta.add_metadatum("recon_workers", int(os.getenv("RECON_WORKERS", 1)))
+MEMORY_BUDGET_GB = meta.add_metadatum(
+    "memory_budget_gb", float(os.getenv("RECON_MEMORY_BUDGET_GB", 0))
+)
+WORKER_MEMORY_GB = meta.add_metadatum(
+    "worker_memory_gb", float(os.getenv("RECON_WORKER_MEMORY_GB", 8))
+)
+
+# Metadata which does not change the reconstructed images and is not part of frame cache keys
+CACHE_IRRELEVANT_METADATA = {
+    "identifier",
+    "track_memory",
+    "trace_allocations",
+    "recon_workers",
+    "memory_budget_gb",
+    "worker_memory_gb",
+}
+
 # redirect STIR messages to some files
 # you can check these if things go wrong
 _ = MessageRedirector("info.txt", "warnings.txt")
@@ -64,37 +162,155 @@ template_acq_data = AcquisitionData(
 template_acq_data.write("template.hs")
 
 
-def make_sinogram(
-    list_file: str, time_start: int, time_end: int
-) -> Tuple[AcquisitionData, Any]:  # TODO: Check type of randoms
-    """Process the listmode data to produce a sinogram for the given time interval
-
-    :param list_filepath: Filepath to listmode data file header in STIR .l.hdr format
-        File can be obtained from dcm/bf format with pet_rd_tools nm_extract
-    :param time_start: Start of timeframe in seconds from start
-    :param time_end: End of timeframe in seconds from start
-    :return: Tuple with the sinogram and estimated randoms
+def histogram_listmode(intervals: List[Tuple[int, int]]) -> List[Tuple[str, str]]:
+    """Histogram prompts and delayeds of all frames with one pass each over the listmode file.
+
+    :param intervals: Frame start and end times in seconds from start as returned by get_intervals
+    :return: Filenames of the prompts and delayeds sinograms for every frame
     """
-    meta.start_block("histograming")
+    start = time.perf_counter()
+    prompts_files = histogram_frames(
+        list_file, "template.hs", intervals, SINO_FILE_PREFIX
+    )
+    delayeds_files = histogram_delayeds(intervals)
+    meta.add_metadatum("histograming_seconds", time.perf_counter() - start)
+
+    return list(zip(prompts_files, delayeds_files))
 
+
+def histogram_delayeds(intervals: List[Tuple[int, int]]) -> List[str]:
+    """Histogram the delayeds of all frames with one pass over the listmode file.
+
+    :param intervals: Frame start and end times in seconds from start as returned by get_intervals
+    :return: Filenames of the delayeds sinograms for every frame
+    """
+    return histogram_frames(
+        list_file, "template.hs", intervals, DELAYEDS_FILE_PREFIX, delayeds=True
+    )
+
+
+def histogram_interval(
+    time_start: float, time_end: float, prefix: str
+) -> ListmodeToSinograms:
+    """Histogram the prompts of a time interval with a ListmodeToSinograms of its own.
+
+    :param time_start: Start of the interval in seconds from start
+    :param time_end: End of the interval in seconds from start
+    :param prefix: Output filename prefix, the sinogram is written to `frame_sinogram_file(prefix, 1)`
+    :return: The processed ListmodeToSinograms, e.g. to estimate randoms from
+    """
     lm2sino = ListmodeToSinograms()
 
     lm2sino.set_input(list_file)
-    lm2sino.set_output_prefix(SINO_FILE_PREFIX)
+    lm2sino.set_output_prefix(prefix)
     lm2sino.set_template("template.hs")
     lm2sino.set_time_interval(time_start, time_end)
 
     lm2sino.set_up()
     lm2sino.process()
 
+    return lm2sino
+
+
+def frame_prefix(frame_idx: int) -> str:
+    """Output filename prefix of the sinogram of a frame histogrammed on its own."""
+    return f"{SINO_FILE_PREFIX}_{frame_idx}"
+
+
+def count_delayeds(delayeds_files: List[str]) -> List[float]:
+    """Sum the delayeds of every frame and delete their sinograms.
+
+    The sinograms are read with numpy, so the process forking the workers runs no STIR code.
+
+    :param delayeds_files: Delayeds sinogram of every frame as returned by histogram_delayeds
+    :return: Delayed counts of every frame
+    """
+    delayed_counts = []
+    for delayeds_file in delayeds_files:
+        delayed_counts.append(sinogram_counts(delayeds_file))
+        remove_sinogram(delayeds_file)
+    return delayed_counts
+
+
+def load_or_make_randoms_model() -> AcquisitionData:
+    """Load the randoms model from the cache directory or estimate and store it.
+
+    Estimating randoms for short frames is based on few delayeds. The distribution of the
+    randoms changes little over the scan, so STIR estimates it once from the delayeds of
+    the whole scan and it is scaled to each frame by its number of delayeds (see make_sinogram).
+    Only used with RANDOMS_MODEL. The cache file is keyed by the listmode file,
+    the time range of the scan and the scanner geometry.
+
+    :return: Randoms estimate normalised to one delayed count
+    """
+    time_start, time_end = intervals[0][0], intervals[-1][1]
+    # The listmode header points to the data file next to it
+    listmode_files = [
+        filename
+        for filename in (list_file, list_file[: -len(".hdr")])
+        if os.path.exists(filename)
+    ]
+    key = hash_inputs(
+        listmode_files,
+        time_start,
+        time_end,
+        SPAN,
+        MAX_RING_DIFF,
+        VIEW_MASH_FACTOR,
+        digest_cache=DIGEST_CACHE_FILE,
+    )
+    cache_file = CACHE_DIR / f"randoms_model_{key}.hs"
+    if cache_file.exists():
+        print(f"using cached randoms model {cache_file}")
+        return AcquisitionData(str(cache_file))
+
+    start = time.perf_counter()
+    prefix = f"{SINO_FILE_PREFIX}_scan_{os.getpid()}"
+    lm2sino = histogram_interval(time_start, time_end, prefix)
+    randoms = lm2sino.estimate_randoms()
+    randoms_model = randoms * (1 / max(float(randoms.as_array().sum()), 1))
+    remove_sinogram(frame_sinogram_file(prefix, 1))
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    randoms_model.write(str(cache_file))
+    meta.add_metadatum("randoms_model_seconds", time.perf_counter() - start)
+    return randoms_model
+
+
+def make_sinogram(
+    prompts_file: str, frame_idx: int
+) -> Tuple[AcquisitionData, AcquisitionData]:
+    """Histogram the sinogram of a frame and estimate its randoms.
+
+    With SINGLE_PASS_HISTOGRAM the sinogram was already histogrammed by histogram_listmode
+    and is only loaded, the time of the single pass is stored as `histograming_seconds`.
+    With RANDOMS_MODEL the randoms model is scaled to the frame's delayeds instead of
+    estimating the randoms of the frame. The durations of the histograming and randoms
+    blocks are then not comparable to runs without them.
+
+    :param prompts_file: Prompts sinogram header of the frame, see `prompts_files`
+    :param frame_idx: Index of the frame, starting at 1
+    :return: Tuple with the sinogram and estimated randoms
+    """
+    meta.start_block("histograming")
+
+    if SINGLE_PASS_HISTOGRAM:
+        acq_data = AcquisitionData(prompts_file)
+    else:
+        lm2sino = histogram_interval(*intervals[frame_idx - 1], frame_prefix(frame_idx))
+        acq_data = lm2sino.get_output()
+
     meta.end_block("histograming")
     meta.start_block("randoms")
 
-    randoms = lm2sino.estimate_randoms()
+    if RANDOMS_MODEL:
+        randoms = randoms_model * delayed_counts[frame_idx - 1]
+    else:
+        randoms = lm2sino.estimate_randoms()
 
     meta.end_block("randoms")
 
-    return lm2sino.get_output(), randoms
+    return acq_data, randoms
 
 
 def load_attenuation_image(filepath: str, acq_data: AcquisitionData) -> ImageData:
@@ -110,24 +326,15 @@ def load_attenuation_image(filepath: str, acq_data: AcquisitionData) -> ImageDat
     return attn_image.move_to_scanner_centre(acq_data)
 
 
-def make_acquisition_sensitivity(
-    acq_data: AcquisitionData, norm_filepath: str, attenuation_image: ImageData
-) -> Tuple[AcquisitionSensitivityModel, Any]:
-    """Combine detector efficiencies calculated from norm
-    file and attenuation model into one acquisition
-    sensitivity model.
+def make_attenuation_factors(
+    acq_data: AcquisitionData, attenuation_image: ImageData
+) -> AcquisitionData:
+    """Ray trace the attenuation image into attenuation factors.
 
-    :param acq_data: Sinogram data from make_sinogram
-    :param norm_filepath: filepath to normalization file header in STIR .n.hdr format
-    :param attenuation_image: Mumap loaded with get_attenuation_image
-    :return: Prepared STIR AcquistionSensitivityModel object
-        combining attenuation and detector efficiencies, Attenuation factors
+    :param acq_data: Acquisition data defining the sinogram geometry
+    :param attenuation_image: Mumap loaded with load_attenuation_image
+    :return: Attenuation factors in the geometry of `acq_data`
     """
-    asm_norm = AcquisitionSensitivityModel(norm_filepath)
-    asm_norm.set_up(acq_data)
-    det_efficiencies = acq_data.get_uniform_copy(1)
-    asm_norm.unnormalise(det_efficiencies)
-
     attn_acq_model = AcquisitionModelUsingRayTracingMatrix()
     asm_attn = AcquisitionSensitivityModel(attenuation_image, attn_acq_model)
     # converting attenuation into attenuation factors (see previous exercise)
@@ -135,12 +342,84 @@ def make_acquisition_sensitivity(
     attn_factors = acq_data.get_uniform_copy(1)
     print("applying attenuation (please wait, may take a while)...")
     asm_attn.unnormalise(attn_factors)
+    return attn_factors
+
+
+def load_or_make_attenuation_factors(
+    acq_data: AcquisitionData, attenuation_image: ImageData
+) -> AcquisitionData:
+    """Load attenuation factors from the cache directory or compute and store them.
+
+    The cache file is keyed by the hash of the mumap file and the scanner geometry
+    (span, max ring difference, view mashing), which is all they depend on.
+
+    :param acq_data: Acquisition data defining the sinogram geometry
+    :param attenuation_image: Mumap loaded with load_attenuation_image
+    :return: Attenuation factors in the geometry of `acq_data`
+    """
+    key = hash_inputs(
+        [attn_file],
+        SPAN,
+        MAX_RING_DIFF,
+        VIEW_MASH_FACTOR,
+        digest_cache=DIGEST_CACHE_FILE,
+    )
+    cache_file = CACHE_DIR / f"attn_factors_{key}.hs"
+    if cache_file.exists():
+        print(f"using cached attenuation factors {cache_file}")
+        return AcquisitionData(str(cache_file))
+
+    attn_factors = make_attenuation_factors(acq_data, attenuation_image)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    attn_factors.write(str(cache_file))
+    return attn_factors
+
+
+def make_acquisition_sensitivity(
+    acq_data: AcquisitionData, norm_filepath: str, attn_factors: AcquisitionData
+) -> AcquisitionSensitivityModel:
+    """Combine detector efficiencies calculated from norm
+    file and attenuation factors into one acquisition
+    sensitivity model.
+
+    :param acq_data: Acquisition data defining the sinogram geometry
+    :param norm_filepath: filepath to normalization file header in STIR .n.hdr format
+    :param attn_factors: Attenuation factors from load_or_make_attenuation_factors
+    :return: Prepared STIR AcquistionSensitivityModel object
+        combining attenuation and detector efficiencies
+    """
+    asm_norm = AcquisitionSensitivityModel(norm_filepath)
+    asm_norm.set_up(acq_data)
 
     asm_attn = AcquisitionSensitivityModel(attn_factors)
     asm = AcquisitionSensitivityModel(asm_norm, asm_attn)
     asm.set_up(acq_data)
 
-    return asm, attn_factors
+    return asm
+
+
+def prepare_frame_invariants() -> Tuple[ImageData, AcquisitionSensitivityModel, Any]:
+    """Load the mumap and set up everything that does not depend on the time window.
+
+    All frames share the sinogram geometry of the template, so the
+    attenuation image, attenuation (correction) factors and the sensitivity
+    model are computed once per run instead of once per frame.
+
+    :return: attenuation image, acquisition sensitivity model, attenuation correction factors
+    """
+    start = time.perf_counter()
+
+    attenuation_image = load_attenuation_image(attn_file, template_acq_data)
+    attn_factors = load_or_make_attenuation_factors(
+        template_acq_data, attenuation_image
+    )
+    asm = make_acquisition_sensitivity(template_acq_data, norm_file, attn_factors)
+
+    acf_factors = attn_factors.get_uniform_copy()
+    acf_factors.fill(1 / attn_factors.as_array())
+
+    meta.add_metadatum("frame_invariants_seconds", time.perf_counter() - start)
+    return attenuation_image, asm, acf_factors
 
 
 def make_scatter_estimate(
@@ -148,45 +427,121 @@ def make_scatter_estimate(
     attenuation_image: ImageData,
     randoms: AcquisitionData,
     asm: AcquisitionSensitivityModel,
-    attn_factors: Any,
+    acf_factors: Any,
 ) -> AcquisitionData:
     """Setup and process scatter estimation.
 
     :param acq_data: Sinogram data from make_sinogram
     :param attenuation_image: The combined object and hardware umap
     :param randoms: Estimated randoms as returned by make_sinogram
-    :param asm: acquisition sensitivity as returned by make_acquisition_sensitivity
-    :param attn_factors: attenuation factors as returned by make_acquisition_sensitivity
+    :param asm: acquisition sensitivity as returned by prepare_frame_invariants
+    :param acf_factors: attenuation correction factors as returned by prepare_frame_invariants
     :return: Estimated scatter sinogram. Currently dividing the output by 1000 because
         the scatter estimation broke the reconstruction and it looked like if the problem
         is with units when comparing them to the randoms. However, this is not 100% sure.
     """
-    meta.start_block("scatter")
-
     se = ScatterEstimator()
     se.set_input(acq_data)
     se.set_attenuation_image(attenuation_image)
     se.set_randoms(randoms)
     se.set_asm(asm)
-
-    acf_factors = attn_factors.get_uniform_copy()
-    acf_factors.fill(1 / attn_factors.as_array())
-
     se.set_attenuation_correction_factors(acf_factors)
     se.set_num_iterations(NUM_ITERATIONS_SCATTER)
-    se.set_output_prefix("scatter_estimate")
+    # Parallel workers must not overwrite each other's intermediate estimates
+    se.set_output_prefix(f"scatter_estimate_{os.getpid()}")
     se.set_OSEM_num_subsets(NUM_SUBSETS_SCATTER)
 
     se.set_up()
     se.process()
 
-    meta.end_block("scatter")
-
     return (
         se.get_output() / 1000
     )  # TODO: find out why this looks so bad. It should be a quite uniform background
 
 
+def make_group_sinogram(
+    group_start: int, group_end: int
+) -> Tuple[AcquisitionData, AcquisitionData]:
+    """Histogram the prompts of a group of frames and estimate their randoms.
+
+    :param group_start: Index of the first frame of the group in `prompts_files`
+    :param group_end: Index after the last frame of the group in `prompts_files`
+    :return: Tuple with the summed sinogram and its estimated randoms
+    """
+    if SINGLE_PASS_HISTOGRAM:
+        acq_data = AcquisitionData(prompts_files[group_start])
+        prompts = acq_data.as_array()
+        for prompts_file in prompts_files[group_start + 1 : group_end]:
+            prompts += AcquisitionData(prompts_file).as_array()
+        acq_data.fill(prompts)
+    else:
+        prefix = f"{SINO_FILE_PREFIX}_group_{group_start}"
+        lm2sino = histogram_interval(
+            intervals[group_start][0],
+            intervals[min(group_end, len(intervals)) - 1][1],
+            prefix,
+        )
+        acq_data = lm2sino.get_output()
+        if not RANDOMS_MODEL:
+            randoms = lm2sino.estimate_randoms()
+        remove_sinogram(frame_sinogram_file(prefix, 1))
+
+    if RANDOMS_MODEL:
+        randoms = randoms_model * sum(delayed_counts[group_start:group_end])
+    return acq_data, randoms
+
+
+# Scatter estimate of the current group of frames: group index, estimate, prompt counts
+group_scatter = None
+
+
+def get_frame_scatter(
+    acq_data: AcquisitionData, randoms: AcquisitionData, counts: float, frame_idx: int
+) -> AcquisitionData:
+    """Estimate the scatter of a frame or scale it from the estimate of its group.
+
+    With a SCATTER_GROUP_SIZE above 1 the first frame of a group estimates
+    the scatter of the summed group, which the other frames reuse.
+
+    :param acq_data: Sinogram data from make_sinogram
+    :param randoms: Estimated randoms as returned by make_sinogram
+    :param counts: Total prompts of `acq_data`
+    :param frame_idx: Index of the frame, starting at 1
+    :return: Estimated scatter sinogram of the frame
+    """
+    global group_scatter
+
+    meta.start_block("scatter")
+
+    if SCATTER_GROUP_SIZE == 1:
+        meta.add_frame_metadatum("scatter_estimated", True)
+        scatter = make_scatter_estimate(
+            acq_data, attenuation_image, randoms, asm, acf_factors
+        )
+    else:
+        group_idx = (frame_idx - 1) // SCATTER_GROUP_SIZE
+        estimate = group_scatter is None or group_scatter[0] != group_idx
+        meta.add_frame_metadatum("scatter_estimated", estimate)
+        if estimate:
+            group_start = group_idx * SCATTER_GROUP_SIZE
+            group_acq_data, group_randoms = make_group_sinogram(
+                group_start, group_start + SCATTER_GROUP_SIZE
+            )
+            group_scatter = (
+                group_idx,
+                make_scatter_estimate(
+                    group_acq_data, attenuation_image, group_randoms, asm, acf_factors
+                ),
+                float(group_acq_data.as_array().sum()),
+            )
+        _, scatter, group_counts = group_scatter
+        scatter = scatter * (counts / group_counts)
+
+    meta.end_block("scatter")
+
+    return scatter
+
+
 def make_acquisiton_model(
     asm: AcquisitionSensitivityModel,
     acq_data: AcquisitionData,
@@ -197,7 +552,7 @@ def make_acquisiton_model(
     """Combine acquistion data, randoms and scatter into an acquisition model.
     Uses acquisition model relying on ray tracing matrix.
 
-    :param asm: Acquisition sensitivity model as returned by make_acquisition_sensitivity
+    :param asm: Acquisition sensitivity model as returned by prepare_frame_invariants
     :param acq_data: Acqisition data as returned by make_sinogram
     :param randoms: Randoms as returned by make_sinogram
     :param scatter_estimate: Scatter estimated as returned by estimage_scatter
@@ -218,14 +573,18 @@ def reconstruct(
     acq_data: AcquisitionData,
     acq_model: AcquisitionModelUsingRayTracingMatrix,
     initial_image: ImageData,
-) -> AcquisitionData:
+) -> Tuple[ImageData, int]:
     """Setup objective function and reconstructor.
     Process and return the output.
 
+    With a CONVERGENCE_TOLERANCE, subiterations are run one by one and the
+    reconstruction stops after the first full iteration (NUM_SUBSETS subiterations)
+    that changes the estimate by less than the tolerance.
+
     :param acq_data: Acquisition data returned by make_sinogram
     :param acq_model: Acqisition model returned by make_acquisition_model
-    :param initial image: Initial image to start with
-    :return: Processed reconstruction
+    :param initial image: Initial value as returned by make_initial_image
+    :return: Processed reconstruction and the number of subiterations run
     """
     meta.start_block("recon")
 
@@ -240,51 +599,337 @@ def reconstruct(
     recon.set_objective_function(obj_fun)
     recon.set_up(initial_image)
     recon.set_current_estimate(initial_image)
-    recon.process()
+
+    if CONVERGENCE_TOLERANCE <= 0:
+        recon.process()
+        subiterations = NUM_SUBITERATIONS
+    else:
+        previous = initial_image.as_array()
+        for subiterations in range(1, NUM_SUBITERATIONS + 1):
+            recon.update_current_estimate()
+            # A single subset only sees part of the data, compare full iterations
+            if subiterations % NUM_SUBSETS == 0:
+                current = recon.get_current_estimate().as_array()
+                change = np.linalg.norm(current - previous) / np.linalg.norm(previous)
+                if change < CONVERGENCE_TOLERANCE:
+                    break
+                previous = current
 
     meta.end_block("recon")
 
-    return recon.get_output()
+    return recon.get_current_estimate(), subiterations
 
 
-def reconstruct_frame(time_start: int, time_end: int, frame_idx: int) -> np.array:
-    """Run reconstruction for a single frame.
+# Frame index, estimate and prompt counts of the previous frame for warm starts
+previous_frame = None
 
-    :param time_start: Start of frame in seconds from beginning
-    :param time_end: End of frame in seconds from beginning
-    :param frame_idx: Index of the current frame
+
+def make_initial_image(acq_data: AcquisitionData, counts: float) -> ImageData:
+    """Create the image to start the reconstruction of a frame from.
+
+    Whether the previous frame was used is recorded as `warm_started` frame metadatum.
+
+    :param acq_data: Sinogram data from make_sinogram
+    :param counts: Total prompts of `acq_data`
+    :return: Uniform image or with WARM_START the estimate of the previous frame
+        scaled by the ratio of prompt counts
+    """
+    initial_image = acq_data.create_uniform_image(1.0, (IMAGE_X_SIZE, IMAGE_Y_SIZE))
+    # Without a previous frame or its counts to scale by, fall back to the uniform image
+    warm_started = previous_frame is not None and previous_frame[2] > 0
+    meta.add_frame_metadatum("warm_started", warm_started)
+    if not warm_started:
+        return initial_image
+
+    _, previous_estimate, previous_counts = previous_frame
+    estimate = previous_estimate * (counts / previous_counts)
+    initial_image.fill(np.maximum(estimate, WARM_START_FLOOR * estimate.mean()))
+    return initial_image
+
+
+def nifti_geometry(image: ImageData) -> Tuple[Tuple[int, int, int], np.ndarray]:
+    """Shape and affine of an image in the NIfTI orientation SIRF writes it in.
+
+    :return: Shape in NIfTI voxel order and the voxel to RAS+ affine
     """
-    acq_data, randoms = make_sinogram(list_file, time_start, time_end)
-    attenuation_image = load_attenuation_image(attn_file, acq_data)
-    asm, attn_factors = make_acquisition_sensitivity(
-        acq_data, norm_file, attenuation_image
+    nifti_image = reg.NiftiImageData(image)
+    # SIRF geometry is in LPS coordinates, NIfTI affines are in RAS
+    affine = np.diag([-1.0, -1.0, 1.0, 1.0]) @ np.array(
+        nifti_image.get_geometrical_info().get_index_to_physical_point_matrix()
     )
-    scatter_estimate = make_scatter_estimate(
-        acq_data, attenuation_image, randoms, asm, attn_factors
+    return nifti_image.as_array().shape, affine
+
+
+def write_result_frame(recon: ImageData, frame_idx: int) -> None:
+    """Copy a reconstructed frame into its slot of the 4D result.
+
+    The conversion to NIfTI orientation happens in memory, the frame is not written to disk on its own.
+    """
+    result_writer.write_frame(
+        frame_idx,
+        reg.NiftiImageData(recon).as_array().astype(np.float32, copy=False),
+        frame_cache_keys[frame_idx - 1],
     )
 
-    initial_image = acq_data.create_uniform_image(1.0, (IMAGE_X_SIZE, IMAGE_Y_SIZE))
+
+def reconstruct_frame(prompts_file: str, frame_idx: int) -> None:
+    """Run reconstruction for a single frame and write it to the result.
+
+    :param prompts_file: Prompts sinogram of the frame, see `prompts_files`
+    :param frame_idx: Index of the current frame
+    """
+    global previous_frame
+
+    acq_data, randoms = make_sinogram(prompts_file, frame_idx)
+    counts = float(acq_data.as_array().sum())
+    scatter_estimate = get_frame_scatter(acq_data, randoms, counts, frame_idx)
+
+    if WARM_START and frame_idx - 1 in cached_frames:
+        previous_frame = load_cached_frame(frame_idx - 1)
+    initial_image = make_initial_image(acq_data, counts)
     acq_model = make_acquisiton_model(
         asm, acq_data, randoms, scatter_estimate, initial_image
     )
 
-    recon = reconstruct(acq_data, acq_model, initial_image)
+    recon, subiterations = reconstruct(acq_data, acq_model, initial_image)
+    meta.add_frame_metadatum("subiterations", subiterations)
 
-    reg.NiftiImageData(recon).write(f"./output/frame_{frame_idx}.nii")
+    write_result_frame(recon, frame_idx)
 
-    return recon.as_array()
+    if WARM_START:
+        previous_frame = (frame_idx, recon.as_array(), counts)
 
 
-result = []
-intervals = get_intervals(TIME_START, TIME_END, TIME_STEP)
+def run_frame(frame_idx: int, prompts_file: str) -> None:
+    """Reconstruct a frame, record its timings and delete its sinogram.
 
-for current_frame_idx, (interval_start, interval_end) in enumerate(intervals, 1):
+    :param frame_idx: Index of the frame, starting at 1
+    :param prompts_file: Prompts sinogram of the frame, see `prompts_files`
+    """
     meta.start_frame()
-    print(f"Reconstructing frame {current_frame_idx}")
+    print(f"Reconstructing frame {frame_idx}")
+
+    reconstruct_frame(prompts_file, frame_idx)
+    remove_sinogram(prompts_file)
+    meta.end_frame(frame_idx)
+
+
+def _init_worker(lock: Any) -> None:
+    global attenuation_image, asm, acf_factors, randoms_model
+
+    # Keep the intermediate sinograms of the workers apart in memory
+    # instead of in temporary files
+    AcquisitionData.set_storage_scheme("memory")
+    # The first worker computes and caches the attenuation factors
+    # and the randoms model, the others load them
+    with lock:
+        attenuation_image, asm, acf_factors = prepare_frame_invariants()
+        if RANDOMS_MODEL:
+            randoms_model = load_or_make_randoms_model()
+
+
+def _run_frames_in_worker(frames: List[Tuple[int, str]]) -> None:
+    for frame_idx, prompts_file in frames:
+        run_frame(frame_idx, prompts_file)
+
+
+def reconstruct_frames_parallel(frames: List[Tuple[int, str]], workers: int) -> None:
+    """Reconstruct frames with a pool of worker processes.
+
+    The workers are forked before this process runs any STIR computation,
+    because the OpenMP runtime does not survive a fork once its threads are started.
+    Before the fork this process only creates the template sinogram and image,
+    runs lm_to_projdata in subprocesses and sums the delayeds with numpy.
+    Every worker sets up the frame invariants and the randoms model once and writes the images of its
+    frames into their slots of the 4D result and their timing records itself.
+    Records are ordered by frame index when read.
+    Frames are handed out by scatter group, so every group is reconstructed by a single worker.
+
+    :param frames: Index and prompts sinogram of the frames to reconstruct
+    :param workers: Number of worker processes
+    """
+    context = multiprocessing.get_context("fork")
+    with context.Pool(
+        workers, initializer=_init_worker, initargs=(context.Lock(),)
+    ) as pool:
+        groups = [
+            list(group)
+            for _, group in itertools.groupby(
+                frames, key=lambda frame: (frame[0] - 1) // SCATTER_GROUP_SIZE
+            )
+        ]
+        for _ in pool.imap_unordered(_run_frames_in_worker, groups):
+            pass
+
+
+def get_frame_cache_keys(n_frames: int) -> List[str]:
+    """Hash everything the image of each frame depends on.
+
+    The keys cover the content of the listmode, norm and mumap files and every
+    metadatum added so far except CACHE_IRRELEVANT_METADATA. Together with the
+    time parameters the frame index defines the interval of a frame. Warm started
+    frames also depend on the key of their previous frame.
+
+    :param n_frames: Number of frames
+    :return: Key of every frame
+    """
+    parameters = {
+        key: value
+        for key, value in meta.metadata.items()
+        if key not in CACHE_IRRELEVANT_METADATA
+    }
+    input_files = [list_file, norm_file, attn_file]
+    # Listmode and norm headers point to the data files next to them
+    input_files += [
+        header[: -len(".hdr")]
+        for header in (list_file, norm_file)
+        if os.path.exists(header[: -len(".hdr")])
+    ]
+    run_key = hash_inputs(
+        input_files,
+        json.dumps(parameters, sort_keys=True),
+        digest_cache=DIGEST_CACHE_FILE,
+    )
+
+    keys = []
+    for frame_idx in range(1, n_frames + 1):
+        previous_key = keys[-1] if WARM_START and keys else None
+        keys.append(hash_inputs([], run_key, frame_idx, previous_key))
+    return keys
+
+
+def load_cached_frame(frame_idx: int) -> Tuple[int, np.array, float]:
+    """Load a cached frame to warm start the next frame from, see `previous_frame`."""
+    # Back from NIfTI to STIR orientation in memory, the reverse of write_result_frame
+    nifti_image = reg.NiftiImageData(template_image)
+    nifti_image.fill(result_writer.read_frame(frame_idx))
+    image = ImageData(nifti_image).as_array()
+    if SINGLE_PASS_HISTOGRAM:
+        counts = float(AcquisitionData(prompts_files[frame_idx - 1]).as_array().sum())
+    else:
+        lm2sino = histogram_interval(*intervals[frame_idx - 1], frame_prefix(frame_idx))
+        counts = float(lm2sino.get_output().as_array().sum())
+        remove_sinogram(prompts_files[frame_idx - 1])
+    return frame_idx, image, counts
+
+
+def report_scatter_savings() -> None:
+    """Estimate the time saved by scaling group scatter estimates instead of estimating every frame.
+
+    The saving is the number of frames with scaled scatter times the mean duration
+    of the frames which estimated it, minus the time spent on scaling.
+    """
+    durations = {True: [], False: []}
+    records = read_metadata_records(output_path / RECORD_FILE_NAME)
+    for timings, frame_metadata in zip(records["timings"], records["frame_metadata"]):
+        if frame_metadata.get("cached"):
+            continue  # Reconstructed by an earlier run
+        block = timings["scatter"]
+        seconds = (
+            datetime.fromisoformat(block["end"])
+            - datetime.fromisoformat(block["start"])
+        ).total_seconds()
+        durations[frame_metadata["scatter_estimated"]].append(seconds)
+    if not durations[True] or not durations[False]:
+        return
+
+    saved = len(durations[False]) * np.mean(durations[True]) - sum(durations[False])
+    meta.add_metadatum("scatter_seconds_saved", saved)
+    print(
+        f"Estimated scatter for {len(durations[True])} frame groups, "
+        f"scaled for {len(durations[False])} frames, saving about {saved:.0f} s"
+    )
+
+
+intervals = get_intervals(TIME_START, TIME_END, TIME_STEP)
+if not intervals:
+    raise ValueError(
+        f"No frame of {TIME_STEP} s between {TIME_START} s and {TIME_END} s"
+    )
+
+# Image with the geometry of every frame
+template_image = template_acq_data.create_uniform_image(
+    0.0, (IMAGE_X_SIZE, IMAGE_Y_SIZE)
+)
+# Created before the workers are forked, they write to the same file
+result_writer = Nifti4DWriter(
+    RESULT_FILE, *nifti_geometry(template_image), len(intervals)
+)
+
+# Frames whose image was written with the same inputs and parameters are not reconstructed again
+frame_cache_keys = get_frame_cache_keys(len(intervals))
+cached_frames = {
+    frame_idx
+    for frame_idx, key in enumerate(frame_cache_keys, 1)
+    if result_writer.read_key(frame_idx) == key
+}
+meta.add_metadatum("cache_hits", len(cached_frames))
+meta.add_metadatum("cached_frames", sorted(cached_frames))
+for frame_idx in sorted(cached_frames):
+    meta.add_cached_frame(frame_idx)
+print(f"Found {len(cached_frames)} of {len(intervals)} frames in the cache")
+
+# Prompts sinogram of every frame, histogrammed up front with SINGLE_PASS_HISTOGRAM
+# and otherwise by make_sinogram
+prompts_files = [
+    frame_sinogram_file(frame_prefix(frame_idx), 1)
+    for frame_idx in range(1, len(intervals) + 1)
+]
+frames = []
+if len(cached_frames) < len(intervals):
+    # Cached frames are histogrammed as well, scatter groups include them
+    if SINGLE_PASS_HISTOGRAM:
+        prompts_files, delayeds_files = zip(*histogram_listmode(intervals))
+        delayed_counts = count_delayeds(delayeds_files)
+    elif RANDOMS_MODEL:
+        start = time.perf_counter()
+        delayed_counts = count_delayeds(histogram_delayeds(intervals))
+        meta.add_metadatum("delayeds_histograming_seconds", time.perf_counter() - start)
+    frames = [
+        (frame_idx, prompts_file)
+        for frame_idx, prompts_file in enumerate(prompts_files, 1)
+        if frame_idx not in cached_frames
+    ]
+
+workers = meta.add_metadatum(
+    "num_workers",
+    get_num_workers(
+        # Warm starts chain the frames, they are reconstructed one after another
+        1 if WARM_START else RECON_WORKERS,
+        MEMORY_BUDGET_GB,
+        WORKER_MEMORY_GB,
+        len(frames),
+    ),
+)
 
-    frame = reconstruct_frame(interval_start, interval_end, current_frame_idx)
-    result.append(frame)
-    meta.end_frame()
+if workers == 1 and frames:
+    attenuation_image, asm, acf_factors = prepare_frame_invariants()
+    if RANDOMS_MODEL:
+        randoms_model = load_or_make_randoms_model()
+    for frame_idx, prompts_file in frames:
+        run_frame(frame_idx, prompts_file)
+elif frames:
+    reconstruct_frames_parallel(frames, workers)
+
+if frames:
+    for frame_idx in cached_frames:
+        remove_sinogram(prompts_files[frame_idx - 1])
+
+if SCATTER_GROUP_SIZE > 1:
+    report_scatter_savings()
+
+if TRACK_MEMORY or TRACE_ALLOCATIONS:
+    growth = memory_growth_report(read_metadata_records(output_path / RECORD_FILE_NAME))
+    if growth:
+        meta.add_metadatum(
+            "memory_growth_mib_per_frame", growth["growth_mib_per_frame"]
+        )
+        meta.add_metadatum("memory_growth_block", growth["responsible_block"])
+        print(
+            f"RSS grows by {growth['growth_mib_per_frame']:.1f} MiB per frame, "
+            f"most retained by block '{growth['responsible_block']}': "
+            f"{growth['retained_mib_per_block']}"
+        )
 
 meta.end()
 meta.save(output_path)
@@ -4,20 +4,70 @@ TIME_START=0
 TIME_END=3180
 TIME_STEP=30
 
+# Synthetic input (see synthetic_input.py) is only as long as its duration
+# and only used once check_synthetic_input.py confirmed that STIR reads it as intended
+if [ -f input/synthetic_input.json ]; then
+    if ! grep -q '"stir_check": "passed"' input/synthetic_input.json; then
+        echo "input/synthetic_input.json has not passed check_synthetic_input.py yet, see README.md"
+        exit 1
+    fi
+    TIME_END=$(sed -n 's/^ *"duration": \([0-9]*\).*/\1/p' input/synthetic_input.json)
+    echo "Using TIME_END=${TIME_END} from input/synthetic_input.json"
+fi
+
+if [ $((TIME_END - TIME_START)) -lt $TIME_STEP ]; then
+    echo "TIME_START=${TIME_START} to TIME_END=${TIME_END} is shorter than one frame of TIME_STEP=${TIME_STEP} s"
+    exit 1
+fi
+
+# Number of frames reconstructed in parallel, limited to as many workers
+# as fit into the RAM budget (0 disables the budget)
+RECON_WORKERS=1
+RECON_MEMORY_BUDGET_GB=0
+RECON_WORKER_MEMORY_GB=8
+
+# Start every frame from the previous one (1 to enable, frames are then reconstructed serially)
+# and stop OSEM once a full iteration changes the image by less than the tolerance (0 to disable)
+RECON_WARM_START=0
+RECON_CONVERGENCE_TOLERANCE=0
+
+# Estimate randoms once for the whole scan and scale them to every frame by its delayeds
+# (1 to enable, 0 estimates the randoms of every frame)
+RECON_RANDOMS_MODEL=1
+# Histogram all frames in one pass over the listmode file (0 histograms every frame with its own
+# ListmodeToSinograms as before). Needs temporary disk space for the sinograms of all frames
+# and RECON_RANDOMS_MODEL=1
+RECON_SINGLE_PASS_HISTOGRAM=1
+
+# Estimate scatter once per group of consecutive frames (1 estimates every frame)
+RECON_SCATTER_GROUP_SIZE=1
+
+# Transaxial size of the reconstructed images in voxels
+RECON_IMAGE_SIZE=344
+
+# Record the RSS at the start and end of every block (1 to enable)
+# and the top N Python allocations per block with tracemalloc (0 to disable)
+RECON_TRACK_MEMORY=0
+RECON_TRACE_ALLOCATIONS=0
+
 GIT_COMMIT_SHORT_SHA=$(git rev-parse --short HEAD)
 WORKDIR=/home/jovyan/work/recon
 
 docker container rm sirf-stir-recon
-docker container rm fslmerge
 if [ "$1" = "--build" ]; then
     docker build --build-arg=GIT_COMMIT_SHORT_SHA=$GIT_COMMIT_SHORT_SHA -t sirf-recon .
-    docker build -f Dockerfile-fslmerge -t fslmerge .
 fi
 
 echo "Running reconstruction with SIRF."
 echo "To see container logs run 'docker logs -t -f --since=5m sirf-stir-recon'."
 
-container_id=$(docker run -d --name=sirf-stir-recon -v ${PWD}/input:${WORKDIR}/input -v ${PWD}/output:${WORKDIR}/output sirf-recon recon $TIME_START $TIME_END $TIME_STEP)
+container_id=$(docker run -d --name=sirf-stir-recon \
+    -e RECON_WORKERS=$RECON_WORKERS -e RECON_MEMORY_BUDGET_GB=$RECON_MEMORY_BUDGET_GB -e RECON_WORKER_MEMORY_GB=$RECON_WORKER_MEMORY_GB \
+    -e RECON_WARM_START=$RECON_WARM_START -e RECON_CONVERGENCE_TOLERANCE=$RECON_CONVERGENCE_TOLERANCE \
+    -e RECON_RANDOMS_MODEL=$RECON_RANDOMS_MODEL -e RECON_SINGLE_PASS_HISTOGRAM=$RECON_SINGLE_PASS_HISTOGRAM \
+    -e RECON_SCATTER_GROUP_SIZE=$RECON_SCATTER_GROUP_SIZE -e RECON_IMAGE_SIZE=$RECON_IMAGE_SIZE \
+    -e RECON_TRACK_MEMORY=$RECON_TRACK_MEMORY -e RECON_TRACE_ALLOCATIONS=$RECON_TRACE_ALLOCATIONS \
+    -v ${PWD}/input:${WORKDIR}/input -v ${PWD}/output:${WORKDIR}/output sirf-recon recon $TIME_START $TIME_END $TIME_STEP)
 status_code=$(docker wait sirf-stir-recon)
 
 if [ $status_code -ne 0 ]; then
@@ -25,12 +75,3 @@ if [ $status_code -ne 0 ]; then
     echo "Run 'docker logs ${container_id}' to view container logs"
     exit 1
 fi
-
-container_id=$(docker run -d --name=fslmerge -v ${PWD}/output:/work/output fslmerge)
-status_code=$(docker wait fslmerge)
-
-if [ $status_code -ne 0 ]; then
-    echo "Error in when merging frames using FSL"
-    echo "Run 'docker logs ${container_id}' to view container logs"
-    exit $status_code
-fi
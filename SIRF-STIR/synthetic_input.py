@@ -0,0 +1,501 @@
+"""Write synthetic Siemens mMR input data for end-to-end reconstruction tests.
+
+A digital phantom (water cylinder with hot spheres) is turned into a 32 bit
+PETLINK listmode file with a `.l.hdr` header, a uniform component based
+normalisation with a `.n.hdr` header and the mumaps `docker-entrypoint.sh`
+merges into `combined_mumap.nii`. Trues are sampled from the activity and
+attenuated by the water cylinder, randoms and delayeds are uniform over the sinogram.
+Only numpy and nibabel are needed, so the data can be generated on any machine.
+
+The headers and the bin mapping follow STIR's definitions but have not been
+read by STIR yet. `check_synthetic_input.py` histograms the data with STIR and
+stores its result in `synthetic_input.json`, `run_recon.sh` only reconstructs
+synthetic data which passed it.
+
+The images are not meant to be quantitatively correct, the data is meant to exercise
+histogramming, randoms, scatter and OSEM with a configurable number of counts.
+
+Usage: python synthetic_input.py INPUT_DIR OUTPUT_DIR [--rate 100000] [--duration 300]
+    [--randoms-fraction 0.3] [--seed 0]
+"""
+
+import json
+import argparse
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+import nibabel as nib
+
+from listmode import detector_pairs
+
+# Geometry of the Siemens mMR as defined in STIR
+NUM_RINGS = 64
+RING_SPACING_MM = 4.0625
+# Inner ring radius plus average depth of interaction
+RING_RADIUS_MM = 328.0 + 6.7
+NUM_VIEWS = 252
+NUM_TANGENTIAL = 344
+NUM_DETECTORS_PER_RING = 2 * NUM_VIEWS
+# Listmode bin addresses are in span 1, normalisation axial effects in span 11
+MAX_RING_DIFF = 60
+NORM_SPAN = 11
+
+# Geometry of the mumaps written by nm_mrac2mu
+UMAP_SHAPE = (344, 344, 127)
+UMAP_VOXEL_SIZE_MM = (2.08626, 2.08626, 2.03125)
+WATER_MU_PER_CM = 0.096  # At 511 keV
+
+PHANTOM_RADIUS_MM = 100.0
+PHANTOM_LENGTH_MM = 180.0
+# Hot spheres in the central plane as in the NEMA image quality phantom:
+# (distance from axis in mm, angle in degrees, radius in mm)
+PHANTOM_SPHERES = [
+    (57.2, angle, radius)
+    for angle, radius in zip(range(0, 360, 60), (5.0, 6.5, 8.5, 11.0, 14.0, 18.5))
+]
+SPHERE_TO_BACKGROUND = 4.0
+
+# TIME_STEP of run_recon.sh, shorter acquisitions have no frame to reconstruct
+MIN_DURATION = 30
+
+TIME_TAG = np.uint32(1 << 31)
+PROMPT_BIT = np.uint32(1 << 30)
+
+LISTMODE_HEADER = """!INTERFILE:=
+%comment:=Synthetic phantom written by synthetic_input.py
+!originating system:=2008
+%SMS-MI header name space:=sinogram subheader
+%SMS-MI version number:=3.4
+
+!GENERAL DATA:=
+%listmode header file:={name}.l.hdr
+%listmode data file:={name}.l
+!name of data file:={name}.l
+
+!GENERAL IMAGE DATA:=
+%study date (yyyy:mm:dd):=2024:01:01
+%study time (hh:mm:ss GMT+00:00):=08:00:00
+isotope name:=F-18
+isotope gamma halflife (sec):=6586.2
+isotope branching factor:=0.9673
+radiopharmaceutical:=Fluorodeoxyglucose
+imagedata byte order:=LITTLEENDIAN
+%patient orientation:=HFS
+!PET data type:=emission
+data format:=listmode
+number of dimensions:=3
+matrix axis label[1]:=bin
+matrix axis label[2]:=projection
+matrix axis label[3]:=plane
+matrix size[1]:={num_tangential}
+matrix size[2]:={num_views}
+matrix size[3]:={num_sinograms}
+%axial compression:=1
+%maximum ring difference:={max_ring_diff}
+%number of segments:={num_segments}
+%segment table:={{{segment_table}}}
+%number of TOF time bins:=1
+
+!IMAGE DATA DESCRIPTION:=
+!total number of data sets:=1
+%total listmode word counts:={word_counts}
+%LM event and tag words format (bits):=32
+%timing tagwords interval (msec):=1
+%image duration from timing tags (msec):={duration_ms}
+image duration (sec):={duration_s}
+!END OF INTERFILE:=
+"""
+
+NORM_HEADER = """!INTERFILE:=
+%comment:=Uniform normalisation written by synthetic_input.py
+!originating system:=2008
+%SMS-MI header name space:=sinogram subheader
+%SMS-MI version number:=3.4
+
+!GENERAL DATA:=
+!name of data file:={name}.n
+
+!GENERAL IMAGE DATA:=
+%study date (yyyy:mm:dd):=2024:01:01
+%study time (hh:mm:ss GMT+00:00):=08:00:00
+imagedata byte order:=LITTLEENDIAN
+data format:=normalization
+number format:=float
+!number of bytes per pixel:=4
+number of rings:={num_rings}
+%axial compression:={span}
+%maximum ring difference:={max_ring_diff}
+%number of segments:={num_segments}
+%segment table:={{{segment_table}}}
+%number of normalization components:={num_components}
+{components}
+!END OF INTERFILE:=
+"""
+
+# Name, shape and value of the uniform normalisation components
+NORM_COMPONENTS = [
+    ("geometric effects", (NUM_TANGENTIAL, 127), 1.0),
+    ("crystal interference", (NUM_TANGENTIAL, 9), 1.0),
+    ("crystal efficiencies", (NUM_DETECTORS_PER_RING, NUM_RINGS), 1.0),
+    ("axial effects", (837,), 1.0),
+    ("paralyzable dead time", (NUM_RINGS,), 0.0),
+    ("non-paralyzable dead time", (NUM_RINGS,), 0.0),
+    ("TX crystal dependent", (9,), 1.0),
+    ("additional axial effects", (837,), 1.0),
+]
+
+
+def segment_sequence(max_segment: int) -> list:
+    """Segment numbers in the order they are stored: 0, -1, 1, -2, 2, ..."""
+    return [0] + [sign * s for s in range(1, max_segment + 1) for sign in (-1, 1)]
+
+
+def span_segment_table(span: int) -> list:
+    """Number of axial positions of every segment in storage order."""
+    max_segment = (MAX_RING_DIFF - span // 2 + span - 1) // span
+    return [
+        2 * NUM_RINGS - 1 - (2 * (abs(s) * span - span // 2) if s else 0)
+        for s in segment_sequence(max_segment)
+    ]
+
+
+def make_phantom() -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Activity and attenuation of the phantom on the mumap grid.
+
+    :return: activity, mumap in 1/cm, affine centred on the scanner
+    """
+    centre = (np.array(UMAP_SHAPE) - 1) / 2
+    affine = np.diag([*UMAP_VOXEL_SIZE_MM, 1.0])
+    affine[:3, 3] = -centre * UMAP_VOXEL_SIZE_MM
+
+    x, y, z = (
+        (np.arange(n) - c) * size
+        for n, c, size in zip(UMAP_SHAPE, centre, UMAP_VOXEL_SIZE_MM)
+    )
+    radius = np.hypot(x[:, None], y[None, :])
+    inside = (radius <= PHANTOM_RADIUS_MM)[..., None] & (
+        np.abs(z) <= PHANTOM_LENGTH_MM / 2
+    )
+    mumap = np.where(inside, WATER_MU_PER_CM, 0).astype(np.float32)
+
+    activity = inside.astype(np.float32)
+    for distance, angle, sphere_radius in PHANTOM_SPHERES:
+        sx = distance * np.cos(np.radians(angle))
+        sy = distance * np.sin(np.radians(angle))
+        sphere = (
+            (x[:, None, None] - sx) ** 2
+            + (y[None, :, None] - sy) ** 2
+            + z[None, None, :] ** 2
+        ) <= sphere_radius**2
+        activity[sphere] = SPHERE_TO_BACKGROUND
+    return activity, mumap, affine
+
+
+class EventSampler:
+    """Samples the bin addresses of true and random coincidences of the phantom.
+
+    :param activity: Activity on the mumap grid as returned by `make_phantom`
+    :param affine: Affine of the mumap grid
+    :param rng: Random number generator
+    """
+
+    def __init__(
+        self, activity: np.ndarray, affine: np.ndarray, rng: np.random.Generator
+    ) -> None:
+        self.rng = rng
+        self.voxels = np.flatnonzero(activity)
+        self.cdf = np.cumsum(activity.ravel()[self.voxels], dtype=np.float64)
+        self.cdf /= self.cdf[-1]
+        self.affine = affine
+
+        # Sinogram bin of every ordered detector pair, -1 if the pair is no bin
+        det_a, det_b = detector_pairs(NUM_VIEWS, NUM_TANGENTIAL)
+        self.bin_of_pair = np.full(
+            (NUM_DETECTORS_PER_RING, NUM_DETECTORS_PER_RING), -1, dtype=np.int64
+        )
+        self.bin_of_pair[det_a, det_b] = np.arange(NUM_VIEWS * NUM_TANGENTIAL).reshape(
+            det_a.shape
+        )
+
+        # First sinogram of every ring difference
+        segments = segment_sequence(MAX_RING_DIFF)
+        sizes = [NUM_RINGS - abs(s) for s in segments]
+        self.segment_start = np.zeros(2 * MAX_RING_DIFF + 1, dtype=np.int64)
+        self.segment_start[np.array(segments) + MAX_RING_DIFF] = np.concatenate(
+            ([0], np.cumsum(sizes)[:-1])
+        )
+        self.num_sinograms = sum(sizes)
+
+        # Share of emissions which are detected, to draw enough of them at once
+        self.detected_fraction = len(self._sample_lines(100_000)) / 100_000
+
+    def _sample_points(self, n: int) -> np.ndarray:
+        idx = self.voxels[np.searchsorted(self.cdf, self.rng.random(n))]
+        voxel = np.stack(np.unravel_index(idx, UMAP_SHAPE), axis=1)
+        voxel = voxel + self.rng.random((n, 3)) - 0.5
+        return voxel @ self.affine[:3, :3].T + self.affine[:3, 3]
+
+    def _sample_lines(self, n: int) -> np.ndarray:
+        """Bin addresses of `n` emissions, lines outside the scanner are dropped."""
+        points = self._sample_points(n)
+        angle = self.rng.uniform(0, np.pi, n)
+        # Polar angles beyond the maximum ring difference are never detected
+        cot_polar = self.rng.uniform(-0.45, 0.45, n)
+        u = np.stack((np.cos(angle), np.sin(angle)), axis=1)
+
+        # Attenuation along the line through the water cylinder
+        distance = np.abs(points[:, 0] * u[:, 1] - points[:, 1] * u[:, 0])
+        chord = 2 * np.sqrt(np.clip(PHANTOM_RADIUS_MM**2 - distance**2, 0, None))
+        chord *= np.sqrt(1 + cot_polar**2)
+        detected = self.rng.random(n) < np.exp(-WATER_MU_PER_CM / 10 * chord)
+        points, u, cot_polar = points[detected], u[detected], cot_polar[detected]
+
+        # Transaxial intersections with the detector ring
+        p_dot_u = np.einsum("ij,ij->i", points[:, :2], u)
+        root = np.sqrt(p_dot_u**2 - (points[:, :2] ** 2).sum(1) + RING_RADIUS_MM**2)
+        dets, rings = [], []
+        for s in (-p_dot_u - root, -p_dot_u + root):
+            end = points[:, :2] + s[:, None] * u
+            phi = np.arctan2(end[:, 1], end[:, 0]) % (2 * np.pi)
+            dets.append(
+                np.rint(phi / (2 * np.pi) * NUM_DETECTORS_PER_RING).astype(np.int64)
+                % NUM_DETECTORS_PER_RING
+            )
+            z = points[:, 2] + s * cot_polar
+            rings.append(np.floor(z / RING_SPACING_MM + NUM_RINGS / 2).astype(np.int64))
+        return self._addresses(*dets, *rings)
+
+    def _addresses(
+        self,
+        det_a: np.ndarray,
+        det_b: np.ndarray,
+        ring_a: np.ndarray,
+        ring_b: np.ndarray,
+    ) -> np.ndarray:
+        bins = self.bin_of_pair[det_a, det_b]
+        swapped = bins < 0
+        bins[swapped] = self.bin_of_pair[det_b[swapped], det_a[swapped]]
+        ring_a, ring_b = (
+            np.where(swapped, ring_b, ring_a),
+            np.where(swapped, ring_a, ring_b),
+        )
+        ring_diff = ring_b - ring_a
+        valid = (
+            (bins >= 0)
+            & (np.minimum(ring_a, ring_b) >= 0)
+            & (np.maximum(ring_a, ring_b) < NUM_RINGS)
+            & (np.abs(ring_diff) <= MAX_RING_DIFF)
+        )
+        sinogram = (
+            self.segment_start[ring_diff[valid] + MAX_RING_DIFF]
+            + np.minimum(ring_a, ring_b)[valid]
+        )
+        return (sinogram * NUM_VIEWS * NUM_TANGENTIAL + bins[valid]).astype(np.uint32)
+
+    def trues(self, n: int) -> np.ndarray:
+        """Bin addresses of `n` detected true coincidences."""
+        addresses = []
+        n_missing = n
+        while n_missing > 0:
+            n_emissions = int(1.1 * n_missing / self.detected_fraction) + 100
+            addresses.append(self._sample_lines(n_emissions)[:n_missing])
+            n_missing -= len(addresses[-1])
+        return np.concatenate(addresses)
+
+    def randoms(self, n: int) -> np.ndarray:
+        """Bin addresses of `n` coincidences uniform over the sinogram."""
+        return self.rng.integers(
+            0, self.num_sinograms * NUM_VIEWS * NUM_TANGENTIAL, n, dtype=np.uint32
+        )
+
+
+def listmode_second(
+    sampler: EventSampler, second: int, rate: float, randoms_fraction: float
+) -> np.ndarray:
+    """Listmode words of one second, every millisecond starts with its time tag."""
+    rng = sampler.rng
+    n_prompts = rng.poisson(rate)
+    n_randoms = rng.binomial(n_prompts, randoms_fraction)
+    words = np.concatenate(
+        (
+            sampler.trues(n_prompts - n_randoms) | PROMPT_BIT,
+            sampler.randoms(n_randoms) | PROMPT_BIT,
+            sampler.randoms(rng.poisson(rate * randoms_fraction)),
+        )
+    )
+    ms = rng.integers(0, 1000, len(words))
+    order = np.argsort(ms, kind="stable")
+    counts = np.bincount(ms, minlength=1000)
+
+    result = np.empty(len(words) + 1000, dtype=np.uint32)
+    tag_positions = np.arange(1000) + np.concatenate(([0], np.cumsum(counts)[:-1]))
+    is_event = np.ones(len(result), dtype=bool)
+    is_event[tag_positions] = False
+    result[tag_positions] = TIME_TAG | np.arange(second * 1000, (second + 1) * 1000)
+    result[is_event] = words[order]
+    return result
+
+
+def write_listmode(
+    directory: Path,
+    name: str,
+    sampler: EventSampler,
+    rate: float,
+    duration: int,
+    randoms_fraction: float,
+) -> Path:
+    """Write `<name>.l` and its header `<name>.l.hdr`.
+
+    :param rate: Mean prompts per second, trues and randoms
+    :param duration: Acquisition time in seconds
+    :param randoms_fraction: Share of randoms in the prompts, also the rate of delayeds
+    :return: Path of the header
+    """
+    word_counts = 0
+    with open(directory / f"{name}.l", "wb") as f:
+        for second in range(duration):
+            words = listmode_second(sampler, second, rate, randoms_fraction)
+            words.astype("<u4").tofile(f)
+            word_counts += len(words)
+
+    segment_table = [NUM_RINGS - abs(s) for s in segment_sequence(MAX_RING_DIFF)]
+    header = directory / f"{name}.l.hdr"
+    header.write_text(
+        LISTMODE_HEADER.format(
+            name=name,
+            num_tangential=NUM_TANGENTIAL,
+            num_views=NUM_VIEWS,
+            num_sinograms=sampler.num_sinograms,
+            max_ring_diff=MAX_RING_DIFF,
+            num_segments=len(segment_table),
+            segment_table=",".join(map(str, segment_table)),
+            word_counts=word_counts,
+            duration_ms=duration * 1000,
+            duration_s=duration,
+        )
+    )
+    return header
+
+
+def write_norm(directory: Path, name: str) -> Path:
+    """Write a uniform normalisation `<name>.n` and its header `<name>.n.hdr`."""
+    components = []
+    offset = 0
+    with open(directory / f"{name}.n", "wb") as f:
+        for idx, (component, shape, value) in enumerate(NORM_COMPONENTS, 1):
+            np.full(shape, value, dtype="<f4").tofile(f)
+            components.append(
+                f"%normalization component[{idx}]:={component}\n"
+                f"%number of dimensions[{idx}]:={len(shape)}\n"
+                f"%matrix size[{idx}]:={{{','.join(map(str, shape))}}}\n"
+                f"%data offset in bytes[{idx}]:={offset}"
+            )
+            offset += int(np.prod(shape)) * 4
+
+    segment_table = span_segment_table(NORM_SPAN)
+    header = directory / f"{name}.n.hdr"
+    header.write_text(
+        NORM_HEADER.format(
+            name=name,
+            num_rings=NUM_RINGS,
+            span=NORM_SPAN,
+            max_ring_diff=MAX_RING_DIFF,
+            num_segments=len(segment_table),
+            segment_table=",".join(map(str, segment_table)),
+            num_components=len(NORM_COMPONENTS),
+            components="\n".join(components),
+        )
+    )
+    return header
+
+
+def write_synthetic_input(
+    input_dir: Path,
+    output_dir: Path,
+    rate: float,
+    duration: int,
+    randoms_fraction: float = 0.3,
+    seed: int = 0,
+) -> dict:
+    """Write listmode, norm and mumaps where `docker-entrypoint.sh` and recon.py expect them.
+
+    The listmode and norm headers and `hardware_umap.nii` are written to `input_dir`,
+    the phantom mumap as `human_mumap.nii` to `output_dir`, replacing the output of
+    nm_mrac2mu. The parameters are stored in `input_dir/synthetic_input.json`.
+
+    :return: Parameters and number of written listmode words
+    """
+    input_dir.mkdir(parents=True, exist_ok=True)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    activity, mumap, affine = make_phantom()
+    nib.save(
+        nib.Nifti1Image(np.zeros_like(mumap), affine), input_dir / "hardware_umap.nii"
+    )
+    nib.save(nib.Nifti1Image(mumap, affine), output_dir / "human_mumap.nii")
+
+    sampler = EventSampler(activity, affine, rng)
+    list_header = write_listmode(
+        input_dir, "synthetic", sampler, rate, duration, randoms_fraction
+    )
+    write_norm(input_dir, "synthetic_norm")
+
+    parameters = {
+        "rate": rate,
+        "duration": duration,
+        "randoms_fraction": randoms_fraction,
+        "seed": seed,
+        "listmode_words": (input_dir / "synthetic.l").stat().st_size // 4,
+        "listmode_header": list_header.name,
+    }
+    with open(input_dir / "synthetic_input.json", "w") as f:
+        json.dump(parameters, f, indent=2)
+    return parameters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("input_dir", type=Path, help="Mounted as recon input")
+    parser.add_argument("output_dir", type=Path, help="Mounted as recon output")
+    parser.add_argument(
+        "--rate", type=float, default=100_000, help="Prompts per second"
+    )
+    parser.add_argument(
+        "--duration",
+        type=int,
+        default=300,
+        help="Acquisition time in seconds, at least one frame (TIME_STEP in run_recon.sh)",
+    )
+    parser.add_argument(
+        "--randoms-fraction",
+        type=float,
+        default=0.3,
+        help="Share of randoms in the prompts",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.duration < MIN_DURATION:
+        parser.error(
+            f"--duration must be at least {MIN_DURATION} s, "
+            "run_recon.sh reconstructs frames of TIME_STEP seconds"
+        )
+
+    parameters = write_synthetic_input(
+        args.input_dir,
+        args.output_dir,
+        args.rate,
+        args.duration,
+        args.randoms_fraction,
+        args.seed,
+    )
+    print(
+        f"Wrote {parameters['listmode_words']} listmode words "
+        f"for {args.duration} s to {args.input_dir}, "
+        f"run_recon.sh reads TIME_END={args.duration} from synthetic_input.json "
+        "once check_synthetic_input.py passed"
+    )
@@ -1,14 +1,23 @@
 import os
 import json
-from copy import deepcopy
+import hashlib
+import tracemalloc
 from datetime import timedelta, datetime
-from typing import List, Tuple, Dict, TypeVar
-from math import floor, sqrt
+from typing import List, Tuple, Dict, Optional, TypeVar
+from math import floor
 from pathlib import Path
 from collections import defaultdict
 
+import numpy as np
+import nibabel as nib
+
 T = TypeVar("T")
 
+MiB = 1024**2
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACEMALLOC_FRAMES = 25
+
 
 def get_intervals(
     time_start: float, time_end: float, time_step: float
@@ -20,6 +29,179 @@ def get_intervals(
     ]
 
 
+# Digests of the files hashed in this process by path, size and modification time
+_file_digests: Dict[Tuple[str, int, int], str] = dict()
+
+
+def file_digest(file: str, digest_cache: Optional[Path] = None) -> str:
+    """sha256 of the content of a file, read only once per version of the file.
+
+    Digests are kept in memory by path, size and modification time, so a file
+    is read once per run (and processes forked later inherit its digest).
+    With `digest_cache` they are also stored in that json file, so later runs
+    only read files which changed since.
+
+    :param file: Path of the file
+    :param digest_cache: Json file with the digests of earlier runs
+    :return: Hex digest
+    """
+    path = os.path.abspath(file)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key in _file_digests:
+        return _file_digests[key]
+
+    cached = dict()
+    if digest_cache is not None and digest_cache.exists():
+        with open(digest_cache) as f:
+            cached = json.load(f)
+    entry = cached.get(path)
+    if entry is not None and (entry["size"], entry["mtime_ns"]) == key[1:]:
+        _file_digests[key] = entry["sha256"]
+        return entry["sha256"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    _file_digests[key] = digest.hexdigest()
+
+    if digest_cache is not None:
+        cached[path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": _file_digests[key],
+        }
+        digest_cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = digest_cache.with_name(f"{digest_cache.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(cached, f)
+        os.replace(tmp_file, digest_cache)
+    return _file_digests[key]
+
+
+def hash_inputs(
+    files: List[str], *parameters, digest_cache: Optional[Path] = None
+) -> str:
+    """Hash the content of input files together with parameters,
+    e.g. to key cached intermediate results.
+
+    :param files: Paths of files whose content is hashed, see `file_digest`
+    :param parameters: Further values included through their string representation
+    :param digest_cache: Json file keeping the file digests across runs
+    :return: Hex digest (first 16 characters of the sha256)
+    """
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update(file_digest(file, digest_cache).encode())
+    digest.update(repr(parameters).encode())
+    return digest.hexdigest()[:16]
+
+
+class Nifti4DWriter:
+    """Write the frames of a dynamic image straight into one preallocated 4D NIfTI file.
+
+    The uncompressed file is created once with the geometry of a frame and
+    every frame is copied into its slot through a memory map as soon as it is done,
+    so frames can be written in any order and by several processes at the same time.
+    An existing file with the same geometry and number of frames is reused.
+
+    The cache key of every written frame is stored in `<filepath>.keys/frame_<idx>.key`
+    after its data is flushed, so a frame interrupted while writing never has a key.
+
+    :param filepath: Path of the 4D image, must end with `.nii`
+    :param frame_shape: Shape of a frame in NIfTI voxel order
+    :param affine: Voxel to RAS+ (mm) affine of a frame
+    :param n_frames: Number of frames
+    """
+
+    def __init__(
+        self,
+        filepath: Path,
+        frame_shape: Tuple[int, int, int],
+        affine: np.ndarray,
+        n_frames: int,
+    ) -> None:
+        self.filepath = Path(filepath)
+        self.shape = (*frame_shape, n_frames)
+        self.affine = affine
+        self.key_dir = Path(f"{filepath}.keys")
+
+        if not self._matches():
+            self._create()
+
+    def _matches(self) -> bool:
+        if not self.filepath.exists():
+            return False
+        image = nib.load(self.filepath)
+        return (
+            image.shape == self.shape
+            and image.get_data_dtype() == np.float32
+            and np.allclose(image.affine, self.affine)
+        )
+
+    def _create(self) -> None:
+        header = nib.Nifti1Header()
+        header.set_data_shape(self.shape)
+        header.set_data_dtype(np.float32)
+        header.set_qform(self.affine, code=1)
+        header.set_sform(self.affine, code=1)
+        header.set_xyzt_units("mm", "sec")
+        header.set_data_offset(352)  # Header and the empty extension flag
+
+        with open(self.filepath, "wb") as f:
+            header.write_to(f)
+            f.write(b"\0" * 4)
+            # Sparse file, frames which are never written read as zeros
+            f.truncate(352 + np.prod(self.shape) * 4)
+
+        if self.key_dir.exists():
+            for key_file in self.key_dir.iterdir():
+                key_file.unlink()
+        self.key_dir.mkdir(exist_ok=True)
+
+    def _memmap(self, mode: str) -> np.memmap:
+        return np.memmap(
+            self.filepath,
+            dtype=np.float32,
+            mode=mode,
+            offset=352,
+            shape=self.shape,
+            order="F",
+        )
+
+    def _key_file(self, frame_idx: int) -> Path:
+        return self.key_dir / f"frame_{frame_idx}.key"
+
+    def write_frame(self, frame_idx: int, frame: np.ndarray, key: str = "") -> None:
+        """Copy a frame into its slot and store its cache key.
+
+        :param frame_idx: Index of the frame, starting at 1
+        :param frame: 3D image of `frame_shape`
+        :param key: Cache key of the frame, see `read_key`
+        """
+        data = self._memmap("r+")
+        data[..., frame_idx - 1] = frame
+        data.flush()
+        del data
+
+        key_file = self._key_file(frame_idx)
+        with open(f"{key_file}.tmp", "w") as f:
+            f.write(key)
+        os.replace(f"{key_file}.tmp", key_file)
+
+    def read_frame(self, frame_idx: int) -> np.ndarray:
+        """Copy of a frame written before."""
+        return np.array(self._memmap("r")[..., frame_idx - 1])
+
+    def read_key(self, frame_idx: int) -> Optional[str]:
+        """Cache key of a frame or None if the frame was not written."""
+        key_file = self._key_file(frame_idx)
+        if not key_file.exists():
+            return None
+        return key_file.read_text()
+
+
 def get_file_with_suffix(suffix: str, input_data_path: str) -> str:
     files = [file for file in os.listdir(input_data_path) if file.endswith(suffix)]
     if len(files) == 0:
@@ -29,6 +211,140 @@ def get_file_with_suffix(suffix: str, input_data_path: str) -> str:
     return os.path.join(input_data_path, files.pop())
 
 
+def get_num_workers(
+    requested: int, memory_budget_gb: float, worker_memory_gb: float, n_frames: int
+) -> int:
+    """Number of processes to reconstruct frames with.
+
+    :param requested: Maximum number of worker processes
+    :param memory_budget_gb: RAM available to all workers together, 0 for no limit
+    :param worker_memory_gb: Peak RAM of one worker reconstructing a frame
+    :param n_frames: Number of frames to reconstruct
+    :return: Number of workers, at least 1
+    """
+    workers = min(requested, n_frames)
+    if memory_budget_gb > 0 and worker_memory_gb > 0:
+        workers = min(workers, floor(memory_budget_gb / worker_memory_gb))
+    return max(workers, 1)
+
+
+RECORD_FILE_NAME = "metadata.jsonl"
+
+
+def rotated_record_files(record_file: Path) -> List[Path]:
+    """Record files of earlier runs kept by `ReconMetadata`, oldest first."""
+    return sorted(record_file.parent.glob(f"{record_file.stem}.*{record_file.suffix}"))
+
+
+def _read_record_file(record_file: Path, previous_frames: Dict[int, tuple]) -> dict:
+    """Parse one record file of `read_metadata_records`.
+
+    :param previous_frames: Timings and frame metadata of earlier runs by frame index,
+        to look up the frames this run took from the cache
+    """
+    result = {"metadata": dict(), "total_seconds": None, "frames": dict()}
+    cached = []
+    with open(record_file) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            record = json.loads(line)
+            if "metadata" in record:
+                result["metadata"].update(record["metadata"])
+            elif "frame" in record:
+                result["frames"][record.get("frame_idx", len(result["frames"]) + 1)] = (
+                    record["frame"],
+                    record.get("frame_metadata", dict()),
+                )
+            elif "cached_frame_idx" in record:
+                cached.append(record["cached_frame_idx"])
+            elif "total_seconds" in record:
+                result["total_seconds"] = record["total_seconds"]
+    for frame_idx in cached:
+        if frame_idx in previous_frames and frame_idx not in result["frames"]:
+            timings, frame_metadata = previous_frames[frame_idx]
+            result["frames"][frame_idx] = (timings, {**frame_metadata, "cached": True})
+    return result
+
+
+def read_metadata_records(record_file: Path) -> dict:
+    """Read the record stream written by `ReconMetadata` into the layout of metadata.json.
+
+    A truncated last line, e.g. from a crash while writing, is ignored.
+    Frames which the run took from the cache keep the timings and frame metadata
+    of the earlier run which reconstructed them, read from its rotated record file,
+    with 'cached' set in their frame metadata.
+
+    :param record_file: Path to a metadata.jsonl file
+    :return: Dict with keys 'metadata', 'total_seconds' (None if the run did not end)
+        and 'frame_indices', 'timings' and 'frame_metadata' with one entry per
+        completed frame, ordered by frame index
+    """
+    previous_frames = dict()
+    for previous_file in rotated_record_files(record_file):
+        previous_frames.update(
+            _read_record_file(previous_file, previous_frames)["frames"]
+        )
+
+    result = _read_record_file(record_file, previous_frames)
+    # Frames reconstructed in parallel finish out of order
+    frames = sorted(result.pop("frames").items())
+    result["frame_indices"] = [frame_idx for frame_idx, _ in frames]
+    result["timings"] = [timings for _, (timings, _) in frames]
+    result["frame_metadata"] = [frame_metadata for _, (_, frame_metadata) in frames]
+    return result
+
+
+def current_rss() -> int:
+    """Resident set size of the current process in bytes."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def memory_growth_report(records: dict) -> Dict[str, T]:
+    """Find the block responsible for memory growing from frame to frame.
+
+    Needs the per block RSS recorded by `ReconMetadata` with `track_memory`.
+    The growth rate is a linear fit of the RSS at the end of every frame. For every
+    block, the memory it retains (RSS at its end minus RSS at its start) is averaged
+    over the frames. The block retaining the most is named as responsible.
+
+    :param records: Dict as returned by `read_metadata_records`
+    :return: Dict with 'growth_mib_per_frame', 'retained_mib_per_block' and
+        'responsible_block', empty if less than two frames have RSS records
+    """
+    rss = [
+        frame_metadata["rss"]
+        for frame_metadata in records["frame_metadata"]
+        # Frames taken from the cache were measured in the process of an earlier run
+        if "rss" in frame_metadata and not frame_metadata.get("cached")
+    ]
+    if len(rss) < 2:
+        return dict()
+
+    frame_ends = np.array([frame["frame"]["end"] for frame in rss]) / MiB
+    growth, _ = np.polyfit(np.arange(len(frame_ends)), frame_ends, 1)
+
+    blocks = {block for frame in rss for block in frame if block != "frame"}
+    retained = {
+        block: float(
+            np.mean(
+                [
+                    (frame[block]["end"] - frame[block]["start"]) / MiB
+                    for frame in rss
+                    if "end" in frame.get(block, dict())
+                ]
+            )
+        )
+        for block in sorted(blocks)
+    }
+    return {
+        "growth_mib_per_frame": float(growth),
+        "retained_mib_per_block": retained,
+        "responsible_block": max(retained, key=retained.get) if retained else None,
+    }
+
+
 class ReconMetadata:
     """Utility class to easily time different parts of the reconstruction,
     store some metadata and in the end store it to a json logfile.
@@ -41,18 +357,70 @@ class ReconMetadata:
         Log as many block durations as you want with `start_block` and `end_block`.
 
         In the end call the `end` method and save the processing statistics using `save`.
-        This will create a json file in the specified directory called `%Y-%m-%d-%H-%M_metadata_{id}.json`,
-        where the first part indicates the current date and time and
-        `id` is the identifier passed to the ReconMetadata constructor.
+        This will create a file called `metadata.json` in the specified directory.
+
+    Every metadatum and every finished frame is appended to `metadata.jsonl`
+    in `outdir` and flushed to disk right away, so the timings survive a crash
+    and can be read while the reconstruction is still running
+    (see `read_metadata_records`). `save` compacts the records into `metadata.json`.
+    The record file of an earlier run is renamed to `metadata.<time of its last
+    record>.jsonl` instead of being overwritten, so frames taken from the cache
+    (see `add_cached_frame`) keep the records of the run which reconstructed them.
+
+    With `track_memory` the RSS of the process at the start and end of every block
+    is stored in the frame metadata as 'rss', see `memory_growth_report`.
+    With `trace_allocations` > 0, tracemalloc is started as well and the Python
+    allocations which grew the most during a block are stored as 'allocations'.
+    Tracemalloc slows Python code down and does not see allocations of STIR itself.
+
+    :param identifier: Identifier of the run, e.g. the git commit
+    :param outdir: Directory of the record file
+    :param track_memory: Record the RSS at the start and end of every block
+    :param trace_allocations: Number of top allocating source lines recorded per block
     """
 
-    def __init__(self, identifier: str = "") -> None:
+    def __init__(
+        self,
+        identifier: str = "",
+        outdir: Path = Path("."),
+        track_memory: bool = False,
+        trace_allocations: int = 0,
+    ) -> None:
         self._current_times = defaultdict(dict)
-        self._previous_times = []
+        self._frame_metadata = dict()
+        self._track_memory = track_memory or trace_allocations > 0
+        self._trace_allocations = trace_allocations
+        self._snapshots = dict()
+        if trace_allocations > 0:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._record_file = outdir / RECORD_FILE_NAME
         self._identifier = identifier
         self._metadata = dict()
+        self._rotate_record_file()
         self.add_metadatum("identifier", identifier)
 
+    def _rotate_record_file(self) -> None:
+        if not self._record_file.exists():
+            return
+        modified = datetime.fromtimestamp(self._record_file.stat().st_mtime)
+        stem = f"{self._record_file.stem}.{modified:%Y%m%dT%H%M%S}"
+        rotated = self._record_file.with_name(f"{stem}{self._record_file.suffix}")
+        suffix = 1
+        while rotated.exists():
+            rotated = self._record_file.with_name(
+                f"{stem}_{suffix}{self._record_file.suffix}"
+            )
+            suffix += 1
+        self._record_file.rename(rotated)
+
+    def _append_record(self, record: dict) -> None:
+        # Each record is written with a single write to a file opened in append mode,
+        # so records of frames reconstructed in parallel processes do not interleave
+        with open(self._record_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
     def start(self) -> None:
         """Set overall start to current time"""
         self.start_time = datetime.now()
@@ -60,56 +428,73 @@ class ReconMetadata:
     def end(self) -> None:
         """Set overall end to current time"""
         self.end_time = datetime.now()
+        self._append_record({"total_seconds": self.total_duration.seconds})
 
     def start_block(self, block_name: str) -> None:
         """Set start time of a task within the reconstruction"""
         self._current_times[block_name]["start"] = datetime.now().isoformat()
+        if self._track_memory:
+            self._frame_metadata.setdefault("rss", dict())[block_name] = {
+                "start": current_rss()
+            }
+            if self._trace_allocations:
+                self._snapshots[block_name] = tracemalloc.take_snapshot()
 
     def end_block(self, block_name: str) -> None:
         """Set end time of a task within the reconstruction"""
         if block_name not in self._current_times:
             raise RuntimeError(f"Block '{block_name}' was not started!")
         self._current_times[block_name]["end"] = datetime.now().isoformat()
+        if self._track_memory:
+            self._frame_metadata["rss"][block_name]["end"] = current_rss()
+            if self._trace_allocations:
+                self._frame_metadata.setdefault("allocations", dict())[block_name] = (
+                    self._top_allocations(self._snapshots.pop(block_name))
+                )
 
-    @property
-    def total_duration(self) -> timedelta:
-        return self.end_time - self.start_time
-
-    def _calc_durations(self) -> List[Dict[str, float]]:
+    def _top_allocations(self, previous: tracemalloc.Snapshot) -> List[str]:
+        # Attribute allocations to the innermost line of the reconstruction scripts
+        # instead of the numpy or SIRF internals which did the allocation
+        size_diffs = defaultdict(int)
+        for stat in tracemalloc.take_snapshot().compare_to(previous, "traceback"):
+            frames = [
+                frame
+                for frame in stat.traceback
+                if frame.filename.startswith(SCRIPT_DIR)
+                and frame.filename != os.path.abspath(__file__)
+            ] or list(stat.traceback)
+            location = f"{os.path.basename(frames[-1].filename)}:{frames[-1].lineno}"
+            size_diffs[location] += stat.size_diff
+        top = sorted(
+            (item for item in size_diffs.items() if item[1] > 0),
+            key=lambda item: item[1],
+            reverse=True,
+        )
         return [
-            {
-                block_key: timings[block_key]["end"] - timings[block_key]["start"]
-                for block_key in timings.keys()
-            }
-            for timings in self._previous_times
+            f"{location}: {size_diff / MiB:+.1f} MiB"
+            for location, size_diff in top[: self._trace_allocations]
         ]
 
-    @staticmethod
-    def _calc_averages(durations: List[Dict[str, float]]) -> Dict[str, float]:
-        return {
-            key: sum([el[key] for el in durations]) / len(durations)
-            for key in durations[0].keys()
-        }
+    @property
+    def metadata(self) -> Dict[str, str]:
+        """All metadata added so far."""
+        return dict(self._metadata)
 
-    @staticmethod
-    def _calc_deviations(
-        durations: List[Dict[str, float]], averages: Dict[str, float]
-    ) -> Dict[str, float]:
-        return {
-            key: sqrt(
-                sum([(el[key] - averages[key]) ** 2 for el in durations])
-                / len(durations)
-            )
-            for key in durations[0].keys()
-        }
+    @property
+    def total_duration(self) -> timedelta:
+        return self.end_time - self.start_time
 
     def save(self, outdir: Path):
+        """Compact the record stream into `metadata.json` inside `outdir`."""
+        records = read_metadata_records(self._record_file)
         with open(outdir / "metadata.json", "w") as f:
             json.dump(
                 {
                     "metadata": self._metadata,
                     "total_seconds": self.total_duration.seconds,
-                    "timings": self._previous_times,
+                    "frame_indices": records["frame_indices"],
+                    "timings": records["timings"],
+                    "frame_metadata": records["frame_metadata"],
                 },
                 f,
             )
@@ -117,10 +502,36 @@ class ReconMetadata:
     def start_frame(self) -> None:
         self.start_block("frame")
 
-    def end_frame(self) -> None:
+    def end_frame(self, frame_idx: Optional[int] = None) -> None:
+        """End the current frame and append its timings to the record file.
+
+        :param frame_idx: Index of the frame starting at 1, used to order frames which
+            were reconstructed in parallel and did not finish in order
+        """
         self.end_block("frame")
-        self._previous_times.append(deepcopy(self._current_times))
+        record = {"frame": self._current_times}
+        if frame_idx is not None:
+            record["frame_idx"] = frame_idx
+        if self._frame_metadata:
+            record["frame_metadata"] = self._frame_metadata
+        self._append_record(record)
         self._current_times = defaultdict(dict)
+        self._frame_metadata = dict()
+
+    def add_cached_frame(self, frame_idx: int) -> None:
+        """Record that a frame was taken from the cache instead of being reconstructed.
+
+        :param frame_idx: Index of the frame starting at 1, as passed to `end_frame`
+        """
+        self._append_record({"cached_frame_idx": frame_idx})
+
+    def add_frame_metadatum(self, key: str, value: T) -> T:
+        """Add a metadata of the current frame, saved with its timings in `end_frame`.
+
+        :return: Value for easier assignment
+        """
+        self._frame_metadata[key] = value
+        return value
 
     def add_metadatum(self, key: str, value: T) -> T:
         """Add a metadata to save to the logfile.
@@ -128,4 +539,5 @@ class ReconMetadata:
         :return: Value for easier assignment
         """
         self._metadata[key] = str(value)
+        self._append_record({"metadata": {key: str(value)}})
         return value
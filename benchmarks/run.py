@@ -0,0 +1,337 @@
+"""Micro-benchmarks of the loaders, image evaluation and utilities on synthetic data.
+
+Every benchmark generates its input with `benchmarks.synthetic` (outside of
+the timed region) and runs the code once to warm up. It is then timed `--repeat`
+times, short benchmarks in loops of at least MIN_SAMPLE_SECONDS per sample,
+and the median time per run is reported, which is less affected by single
+slow runs on a busy machine.
+`--scale` multiplies the input sizes. Results are compared against the
+baselines stored in `benchmarks/baselines.json` for the same scale,
+benchmarks slower than `--threshold` times their baseline are reported as
+regressions and make the script exit with status 1. Identical runs in separate
+processes differed by up to 1.6 times on a shared machine, the default threshold
+of 2 only catches real slowdowns, e.g. a loader becoming quadratic in its input.
+`--save-baseline` stores the current results as new baselines.
+Baselines are machine specific, save them on the machine the comparison runs on.
+Benchmarks whose dependencies are not installed (e.g. nilearn) are skipped.
+
+Usage: python -m benchmarks.run [--scale N] [--repeat N] [--filter NAME]
+    [--save-baseline] [--threshold 2.0]
+"""
+
+import sys
+import json
+import argparse
+import tempfile
+import importlib.util
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from benchmarks import synthetic
+from plotting.loading import (
+    load_e7_histo_timings,
+    load_e7_recon_timings,
+    parse_resources_file,
+    parse_timings,
+    prepare_for_single_frame_plot,
+)
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BASELINE_FILE = Path(__file__).with_name("baselines.json")
+MIN_SAMPLE_SECONDS = 0.2
+
+
+def load_script_module(name: str, filepath: Path):
+    """Import a script of a toolbox directory under a unique module name.
+
+    The toolbox directories are no packages and several of them contain a
+    `utils.py`, so their directory is only put on `sys.path` while importing.
+    """
+    sys.path.insert(0, str(filepath.parent))
+    previous_utils = sys.modules.pop("utils", None)
+    try:
+        spec = importlib.util.spec_from_file_location(name, filepath)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(filepath.parent))
+        sys.modules.pop("utils", None)
+        if previous_utils is not None:
+            sys.modules["utils"] = previous_utils
+    return module
+
+
+class Benchmark(NamedTuple):
+    """A benchmark prepares its input of a given scale in a temporary directory
+    and returns the callable that is timed."""
+
+    name: str
+    size: Callable[[int], str]  # Description of the input size at a scale
+    prepare: Callable[[int, Path], Callable[[], object]]
+
+
+def prepare_snrs_cnrs(scale: int, tmpdir: Path) -> Callable[[], object]:
+    analyze = load_script_module(
+        "analyze", REPO_DIR / "image_evaluation" / "analyze.py"
+    )
+    shape = (45 * scale, 54, 45)
+    atlas, indices = synthetic.make_atlas(shape, n_regions=116)
+    # Frames in memory, so the region statistics are timed without loading the image
+    frames = synthetic.make_frames(shape, n_frames=4)
+    reducer = analyze.LabelReducer(atlas)
+    cerebelum_ids, other_ids = indices[-18:], indices[:-18]
+
+    def run():
+        for i in range(frames.shape[-1]):
+            stats = reducer.reduce(np.maximum(frames[..., i], 0))
+            analyze.get_snrs(stats, indices)
+            analyze.get_cnrs(stats, cerebelum_ids, other_ids)
+
+    return run
+
+
+def prepare_evaluation(scale: int, tmpdir: Path) -> Callable[[], object]:
+    analyze = load_script_module(
+        "analyze", REPO_DIR / "image_evaluation" / "analyze.py"
+    )
+    shape = (45 * scale, 54, 45)
+    atlas, indices = synthetic.make_atlas(shape, n_regions=116)
+    # Evaluated from a 4D file, so loading and iterating the frames is timed as well
+    image_file = synthetic.write_nifti(
+        tmpdir / "result.nii", synthetic.make_frames(shape, n_frames=4)
+    )
+    reducer = analyze.LabelReducer(atlas)
+    cerebelum_ids, other_ids = indices[-18:], indices[:-18]
+    return lambda: analyze.evaluate(
+        str(image_file), reducer, indices, cerebelum_ids, other_ids
+    )
+
+
+def prepare_resources(scale: int, tmpdir: Path) -> Callable[[], object]:
+    resource_file = synthetic.write_resources_csv(
+        tmpdir / "resources.csv", 50_000 * scale
+    )
+    return lambda: parse_resources_file(resource_file, use_cache=False)
+
+
+def prepare_resources_cached(scale: int, tmpdir: Path) -> Callable[[], object]:
+    resource_file = synthetic.write_resources_csv(
+        tmpdir / "resources.csv", 50_000 * scale
+    )
+    parse_resources_file(resource_file)  # Write the cache
+    return lambda: parse_resources_file(resource_file)
+
+
+def prepare_timings(scale: int, tmpdir: Path) -> Callable[[], object]:
+    metadata = synthetic.make_metadata(106 * scale)
+    return lambda: parse_timings(metadata)
+
+
+def prepare_e7_loaders(scale: int, tmpdir: Path) -> Callable[[], object]:
+    histo_log, recon_log = synthetic.write_e7_logs(tmpdir, 106 * scale)
+
+    def run():
+        load_e7_histo_timings(histo_log)
+        load_e7_recon_timings(recon_log)
+
+    return run
+
+
+def prepare_single_frame_plots(scale: int, tmpdir: Path) -> Callable[[], object]:
+    n_frames = 106 * scale
+    frame_seconds = 60.0
+    resource_file = synthetic.write_resources_csv(
+        tmpdir / "resources.csv",
+        int(n_frames * frame_seconds / synthetic.RESOURCE_SAMPLE_INTERVAL),
+    )
+    resources = parse_resources_file(resource_file, use_cache=False)
+    timings = parse_timings(synthetic.make_metadata(n_frames, frame_seconds))
+
+    def run():
+        for frame_idx in range(n_frames):
+            prepare_for_single_frame_plot(resources, timings, frame_idx)
+
+    return run
+
+
+def prepare_intervals(scale: int, tmpdir: Path) -> Callable[[], object]:
+    sirf_utils = load_script_module(
+        "sirf_stir_utils", REPO_DIR / "SIRF-STIR" / "utils.py"
+    )
+    return lambda: sirf_utils.get_intervals(0, 100_000 * scale, 1)
+
+
+def prepare_merge_umaps(scale: int, tmpdir: Path) -> Callable[[], object]:
+    merge_umaps = load_script_module(
+        "merge_umaps", REPO_DIR / "SIRF-STIR" / "merge_umaps.py"
+    )
+    rng = np.random.default_rng(0)
+    hardware = synthetic.write_nifti(
+        tmpdir / "hardware_umap.nii",
+        rng.random((128 * scale, 128, 64), dtype=np.float32),
+        voxel_size=2.0,
+    )
+    human = synthetic.write_nifti(
+        tmpdir / "human_umap.nii",
+        rng.random((96 * scale, 96, 48), dtype=np.float32),
+        voxel_size=2.5,
+    )
+    outpath = tmpdir / "combined_umap.nii"
+    return lambda: merge_umaps.merge_umaps(str(hardware), str(human), str(outpath))
+
+
+BENCHMARKS = [
+    Benchmark(
+        "evaluation.get_snrs_get_cnrs",
+        lambda scale: f"4 frames of {45 * scale}x54x45, 116 regions",
+        prepare_snrs_cnrs,
+    ),
+    Benchmark(
+        "evaluation.evaluate",
+        lambda scale: f"4D NIfTI with 4 frames of {45 * scale}x54x45, 116 regions",
+        prepare_evaluation,
+    ),
+    Benchmark(
+        "loading.parse_resources_file",
+        lambda scale: f"{50_000 * scale} samples",
+        prepare_resources,
+    ),
+    Benchmark(
+        "loading.parse_resources_file_cached",
+        lambda scale: f"{50_000 * scale} samples",
+        prepare_resources_cached,
+    ),
+    Benchmark(
+        "loading.parse_timings",
+        lambda scale: f"{106 * scale} frames",
+        prepare_timings,
+    ),
+    Benchmark(
+        "loading.e7_loaders",
+        lambda scale: f"{106 * scale} frames, 100 lines between events, 600 setup lines",
+        prepare_e7_loaders,
+    ),
+    Benchmark(
+        "loading.prepare_for_single_frame_plot",
+        lambda scale: f"{106 * scale} frames of 60 s at 10 Hz",
+        prepare_single_frame_plots,
+    ),
+    Benchmark(
+        "sirf_stir.get_intervals",
+        lambda scale: f"{100_000 * scale} intervals",
+        prepare_intervals,
+    ),
+    Benchmark(
+        "sirf_stir.merge_umaps",
+        lambda scale: f"{128 * scale}x128x64 and {96 * scale}x96x48 voxels",
+        prepare_merge_umaps,
+    ),
+]
+
+
+def run_benchmark(
+    benchmark: Benchmark, scale: int, repeat: int
+) -> Optional[Dict[str, object]]:
+    """Time a benchmark, None if its dependencies are not installed."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            function = benchmark.prepare(scale, Path(tmpdir))
+        except ImportError as e:
+            print(f"{benchmark.name:40s} skipped ({e})")
+            return None
+
+        start = perf_counter()
+        function()
+        number = max(1, int(MIN_SAMPLE_SECONDS / (perf_counter() - start)))
+
+        seconds = []
+        for _ in range(repeat):
+            start = perf_counter()
+            for _ in range(number):
+                function()
+            seconds.append((perf_counter() - start) / number)
+
+    return {"size": benchmark.size(scale), "seconds": float(np.median(seconds))}
+
+
+def load_baselines() -> Dict[str, Dict[str, dict]]:
+    if not BASELINE_FILE.exists():
+        return dict()
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+
+def main(
+    scale: int, repeat: int, name_filter: str, save: bool, threshold: float
+) -> List[str]:
+    """Run all benchmarks matching `name_filter` and compare them to the baselines.
+
+    :return: Names of the benchmarks slower than `threshold` times their baseline
+    """
+    baselines = load_baselines()
+    scale_baselines = baselines.setdefault(str(scale), dict())
+    regressions = []
+
+    print(f"{'benchmark':40s} {'seconds':>9s} {'baseline':>9s} {'ratio':>6s}  size")
+    for benchmark in BENCHMARKS:
+        if name_filter not in benchmark.name:
+            continue
+        result = run_benchmark(benchmark, scale, repeat)
+        if result is None:
+            continue
+
+        baseline = scale_baselines.get(benchmark.name)
+        ratio = None
+        if baseline is not None and baseline["size"] == result["size"]:
+            ratio = result["seconds"] / baseline["seconds"]
+        print(
+            f"{benchmark.name:40s} {result['seconds']:9.4f} "
+            + (
+                f"{baseline['seconds']:9.4f} {ratio:6.2f}"
+                if ratio is not None
+                else f"{'-':>9s} {'-':>6s}"
+            )
+            + f"  {result['size']}"
+            + ("  REGRESSION" if ratio is not None and ratio > threshold else "")
+        )
+        if ratio is not None and ratio > threshold:
+            regressions.append(benchmark.name)
+        if save:
+            scale_baselines[benchmark.name] = result
+
+    if save:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baselines, f, indent=2)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--scale", type=int, default=1, help="Input size multiplier")
+    parser.add_argument(
+        "--repeat", type=int, default=9, help="Timed runs per benchmark"
+    )
+    parser.add_argument(
+        "--filter", default="", help="Only run benchmarks containing this name"
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Store results as baselines"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=2.0,
+        help="Slowdown relative to the baseline reported as regression",
+    )
+    args = parser.parse_args()
+
+    regressions = main(
+        args.scale, args.repeat, args.filter, args.save_baseline, args.threshold
+    )
+    sys.exit(1 if regressions else 0)
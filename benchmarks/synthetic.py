@@ -0,0 +1,193 @@
+"""Deterministic synthetic inputs in the formats the toolbox code reads.
+
+Every generator takes a size and a seed and produces the same data for
+the same arguments, so benchmark timings are comparable between runs.
+"""
+
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+from plotting.loading import E7_HISTO_SETUP_LINES, E7_LOG_START_OF_MSG_COL_IDX
+
+START_TIME = pd.Timestamp("2024-01-01 08:00:00")
+RESOURCE_SAMPLE_INTERVAL = 0.1  # Seconds, the default of sample_resources.py
+# Blocks of a generic frame with their share of the frame duration
+FRAME_BLOCKS = {
+    "histograming": 0.1,
+    "randoms": 0.05,
+    "scatter": 0.15,
+    "recon_itr1": 0.3,
+    "recon_itr2": 0.3,
+}
+
+
+def make_atlas(
+    shape: Tuple[int, int, int], n_regions: int, seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Label volume with `n_regions` randomly placed labels inside a zero border.
+
+    :return: atlas, sorted region indices
+    """
+    rng = np.random.default_rng(seed)
+    atlas = np.zeros(shape, dtype=np.int16)
+    border = tuple(slice(s // 10, s - s // 10) for s in shape)
+    indices = np.arange(1, n_regions + 1, dtype=np.int16) * 10
+    atlas[border] = rng.choice(indices, size=atlas[border].shape)
+    return atlas, indices
+
+
+def make_frames(
+    shape: Tuple[int, int, int], n_frames: int, seed: int = 0
+) -> np.ndarray:
+    """Activity frames with negative noise as in reconstructed images, shape (*shape, n_frames)."""
+    rng = np.random.default_rng(seed)
+    return rng.normal(loc=5000, scale=2000, size=(*shape, n_frames)).astype(np.float32)
+
+
+def write_nifti(filepath: Path, data: np.ndarray, voxel_size: float = 2.0) -> Path:
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    nib.save(nib.Nifti1Image(data, affine), filepath)
+    return filepath
+
+
+def frame_timings(n_frames: int, frame_seconds: float) -> List[Dict[str, dict]]:
+    """Timings of consecutive frames in the layout of 'metadata.json'.
+
+    Every frame starts with a one second gap and is split into `FRAME_BLOCKS`.
+    """
+    timings = []
+    for frame_idx in range(n_frames):
+        frame_start = START_TIME + pd.Timedelta(seconds=frame_idx * frame_seconds + 1)
+        block_start = frame_start
+        frame = {}
+        for block, share in FRAME_BLOCKS.items():
+            block_end = block_start + pd.Timedelta(seconds=share * (frame_seconds - 1))
+            frame[block] = {"start": str(block_start), "end": str(block_end)}
+            block_start = block_end
+        frame["frame"] = {"start": str(frame_start), "end": str(block_start)}
+        timings.append(frame)
+    return timings
+
+
+def make_metadata(n_frames: int, frame_seconds: float = 60.0) -> dict:
+    """Content of a 'metadata.json' written by `ReconMetadata.save`."""
+    return {
+        "metadata": {"identifier": "synthetic"},
+        "total_seconds": int(n_frames * frame_seconds),
+        "timings": frame_timings(n_frames, frame_seconds),
+        "frame_metadata": [{} for _ in range(n_frames)],
+    }
+
+
+def write_metadata_json(filepath: Path, n_frames: int, frame_seconds: float = 60.0):
+    with open(filepath, "w") as f:
+        json.dump(make_metadata(n_frames, frame_seconds), f)
+    return filepath
+
+
+def write_resources_csv(
+    filepath: Path, n_samples: int, gpu: bool = True, seed: int = 0
+) -> Path:
+    """'resources.csv' as written by sample_resources.py, sampled every 100 ms from `START_TIME`.
+
+    Memory alternates between MiB and GiB values, the first sample reads 0B
+    like `docker stats` right after a container started.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(
+        START_TIME, periods=n_samples, freq=f"{int(RESOURCE_SAMPLE_INTERVAL * 1000)}ms"
+    ).strftime("%Y-%m-%d %H:%M:%S.%f")
+    memory = np.where(
+        rng.random(n_samples) < 0.5,
+        np.char.add(np.char.mod("%.2f", rng.random(n_samples) * 900), "MiB"),
+        np.char.add(np.char.mod("%.3f", rng.random(n_samples) * 30), "GiB"),
+    )
+    memory[0] = "0B"
+    columns = {
+        "Timestamp": times,
+        "CPU_Usage(%)": np.char.add(
+            np.char.mod("%.2f", rng.random(n_samples) * 800), "%"
+        ),
+        "Memory_Usage(%)": np.char.add(
+            np.char.mod("%.2f", rng.random(n_samples) * 10), "%"
+        ),
+        "Memory_Usage/Limit": np.char.add(memory, " / 250GiB"),
+        "GPU_Memory": "",
+        "GPU_Utilization": "",
+        "Disk_Read": np.round(rng.random(n_samples) * 100, 2),
+        "Disk_Written": np.round(rng.random(n_samples) * 100, 2),
+    }
+    if gpu:
+        columns["GPU_Memory"] = np.char.add(
+            rng.integers(0, 8000, n_samples).astype(str), " MiB"
+        )
+        columns["GPU_Utilization"] = np.char.add(
+            rng.integers(0, 100, n_samples).astype(str), " %"
+        )
+    pd.DataFrame(columns).to_csv(filepath, index=False)
+    return filepath
+
+
+class _E7LogWriter:
+    """Writes lines in the fixed column layout of e7 tools logs:
+    message type in column 0, timestamp in columns 2 to 25, message from column 38."""
+
+    def __init__(self, f, rng: np.random.Generator) -> None:
+        self.f = f
+        self.rng = rng
+        self.time = START_TIME
+
+    def line(self, msg: str, msg_type: str = "I") -> None:
+        self.time += pd.Timedelta(milliseconds=int(self.rng.integers(1, 20)))
+        timestamp = self.time.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        prefix = f"{msg_type} {timestamp} [T{self.rng.integers(1000, 9999)}]"
+        self.f.write(f"{prefix.ljust(E7_LOG_START_OF_MSG_COL_IDX - 1)}{msg}\n")
+
+    def filler(self, n_lines: int) -> None:
+        for length in self.rng.integers(5, 80, n_lines):
+            self.line("processing " + "x" * length)
+
+
+def write_e7_logs(
+    directory: Path, n_frames: int, filler_lines: int = 100, seed: int = 0
+) -> Tuple[Path, Path]:
+    """HistogramReplay and e7_recon logs with `filler_lines` unrelated lines between events.
+
+    :return: Path of the histogramming log, path of the reconstruction log
+    """
+    rng = np.random.default_rng(seed)
+    histo_log = directory / "log_HistogramReplay_synthetic.txt"
+    recon_log = directory / "log_e7_recon_synthetic.txt"
+
+    with open(histo_log, "w") as f:
+        log = _E7LogWriter(f, rng)
+        f.write("HistogramReplay log\n")
+        log.line("Sinogram no = 0 (setup)")
+        log.filler(E7_HISTO_SETUP_LINES)
+        log.line("Frame_write: Just sent Frame 0")
+        for frame_idx in range(n_frames):
+            log.line(f"Sinogram no = {2 * frame_idx + 1}")
+            log.filler(filler_lines)
+            log.line(f"Sinogram no = {2 * frame_idx + 2}")
+            log.filler(filler_lines)
+            log.line(f"Frame_write: Just sent Frame {frame_idx + 1}")
+
+    with open(recon_log, "w") as f:
+        log = _E7LogWriter(f, rng)
+        f.write("e7_recon log\n")
+        for frame_idx in range(n_frames):
+            log.line(f"axis table=4084 frame {frame_idx}")
+            log.filler(filler_lines)
+            log.line("estimate scatter sinogram")
+            log.filler(filler_lines)
+            log.line("End Scatter Simulation Iteration 2")
+            log.line(f"start calculation of image {frame_idx}")
+            log.filler(filler_lines)
+            log.line(f"finished calculation of image {frame_idx}")
+
+    return histo_log, recon_log
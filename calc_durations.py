@@ -1,55 +1,184 @@
-"""Script to caculate the total durations of substeps in
-the reconstruction and there shares of the total time.
+"""Compare the durations of the reconstruction blocks of toolbox runs.
 
-For non e7-tools data
+For every run the total, share of the total run time, mean, standard deviation
+and percentiles of the per frame duration of every block are computed.
+Iterations of a block ('<block>_itr<n>') are reported summed per frame under
+the block name and individually. 'unassigned' is the part of every frame not
+covered by its blocks, 'between_frames' the part of the total run time outside
+of all frames (e.g. setup before the first frame), which has no per frame statistics.
+
+A run is either a generic toolbox directory with 'metadata.json' (or
+'metadata.jsonl') and 'resources.csv', e.g. 'results/<date>-<sha>/SIRF-STIR',
+or an e7 tools directory with logs, e.g. 'results/JSRecon/GPU'.
+
+Usage: python calc_durations.py RUN_DIR [RUN_DIR ...] [--percentiles 50 95] [--csv FILE]
 """
 
+import argparse
 from pathlib import Path
+from typing import List, Tuple
+
+import pandas as pd
 
-from plotting.loading import load_resources_and_timings
-
-resources, timings = load_resources_and_timings(Path("results/SIRF-STIR"))
-
-start = resources.index[0]
-end = resources.index[-1]
-
-total_duration = end - start
-histo_duration = (
-    timings[("histograming", "end")] - timings[("histograming", "start")]
-).sum()
-randoms_duration = (timings[("randoms", "end")] - timings[("randoms", "start")]).sum()
-histo_duration = histo_duration + randoms_duration
-histo_perc = (histo_duration / total_duration) * 100
-
-is_scatter_start = [
-    col[0].startswith("scatter") and col[1] == "start" for col in timings.columns
-]
-is_scatter_end = [
-    col[0].startswith("scatter") and col[1] == "end" for col in timings.columns
-]
-
-scatter_ends = timings.loc[:, is_scatter_end]
-scatter_starts = timings.loc[:, is_scatter_start]
-scatter_ends.columns = scatter_ends.columns.droplevel(level=1)
-scatter_starts.columns = scatter_starts.columns.droplevel(level=1)
-scatter_duration = (scatter_ends - scatter_starts).sum().sum()
-scatter_perc = (scatter_duration / total_duration) * 100
-
-is_recon_start = [
-    col[0].startswith("recon") and col[1] == "start" for col in timings.columns
-]
-is_recon_end = [
-    col[0].startswith("recon") and col[1] == "end" for col in timings.columns
-]
-
-recon_ends = timings.loc[:, is_recon_end]
-recon_starts = timings.loc[:, is_recon_start]
-recon_ends.columns = recon_ends.columns.droplevel(level=1)
-recon_starts.columns = recon_starts.columns.droplevel(level=1)
-recon_duration = (recon_ends - recon_starts).sum().sum()
-recon_perc = (recon_duration / total_duration) * 100
-
-unassigned_duration = (
-    total_duration - histo_duration - scatter_duration - recon_duration
+from plotting.loading import (
+    is_e7_run,
+    load_e7_run,
+    load_metadata,
+    parse_resources_file,
+    parse_timings,
 )
-unassigned_perc = (unassigned_duration / total_duration) * 100
+from plotting.results_store import block_rows
+
+
+def load_generic_run(path: Path) -> Tuple[pd.DataFrame, float]:
+    """Block rows (see `block_rows`) and the total run time in seconds of a toolbox run.
+
+    Blocks of frames the run took from the cache (recorded by an earlier run) are
+    marked in the column 'cached'.
+    """
+    metadata = load_metadata(path)
+    blocks = block_rows(parse_timings(metadata))
+    cached_frames = [
+        frame_idx - 1
+        for frame_idx, frame_metadata in zip(
+            metadata.get("frame_indices", []), metadata.get("frame_metadata", [])
+        )
+        if frame_metadata.get("cached")
+    ]
+    blocks["cached"] = blocks["frame"].isin(cached_frames)
+    if (path / "resources.csv").exists():
+        resources = parse_resources_file(path / "resources.csv")
+        total_seconds = (resources.index[-1] - resources.index[0]).total_seconds()
+    elif metadata.get("total_seconds") is not None:
+        total_seconds = metadata["total_seconds"]
+    else:
+        frames = blocks[(blocks["block"] == "frame") & ~blocks["cached"]]
+        total_seconds = (
+            pd.to_datetime(frames["end"]).max() - pd.to_datetime(frames["start"]).min()
+        ).total_seconds()
+    return blocks, total_seconds
+
+
+def load_e7_blocks(path: Path) -> Tuple[pd.DataFrame, float]:
+    """Block rows and total run time of an e7 tools run.
+
+    Histogramming runs as a separate program before the reconstruction,
+    its frames are counted as 'histograming' block and added to the frame duration.
+    """
+    histo_resources, histo_timings, recon_resources, recon_timings = load_e7_run(path)
+    histo_blocks = block_rows(histo_timings).replace({"frame": "histograming"})
+    blocks = pd.concat((histo_blocks, block_rows(recon_timings)), ignore_index=True)
+    is_frame = blocks["block"] == "frame"
+    histo_durations = histo_blocks.set_index("frame")["duration_s"]
+    blocks.loc[is_frame, "duration_s"] += (
+        blocks.loc[is_frame, "frame"].map(histo_durations).fillna(0).to_numpy()
+    )
+
+    total_seconds = sum(
+        (resources.index[-1] - resources.index[0]).total_seconds()
+        for resources in (histo_resources, recon_resources)
+    )
+    return blocks, total_seconds
+
+
+def covered_seconds(blocks: pd.DataFrame) -> float:
+    """Length of the union of the time intervals of all block rows in seconds.
+
+    Overlapping intervals, e.g. frames of parallel workers, are counted once.
+    """
+    intervals = pd.DataFrame(
+        {"start": pd.to_datetime(blocks["start"]), "end": pd.to_datetime(blocks["end"])}
+    ).sort_values("start")
+    # An interval starting after the end of all earlier ones starts a new group
+    is_new = intervals["start"] > intervals["end"].cummax().shift()
+    merged = intervals.groupby(is_new.cumsum()).agg(
+        start=("start", "min"), end=("end", "max")
+    )
+    return (merged["end"] - merged["start"]).dt.total_seconds().sum()
+
+
+def block_statistics(
+    blocks: pd.DataFrame, total_seconds: float, percentiles: List[float]
+) -> pd.DataFrame:
+    """Statistics of the per frame durations of every block of a run.
+
+    :param blocks: Block rows as returned by `block_rows`, optionally with a boolean
+        column 'cached' marking blocks recorded by an earlier run
+    :param total_seconds: Total run time, the reference for the shares
+    :param percentiles: Percentiles (0 - 100) of the per frame durations to report
+    :return: Dataframe indexed by block name
+    """
+    # Blocks of an earlier run lie outside of this run's time
+    all_blocks = blocks[~blocks["cached"]] if "cached" in blocks else blocks
+    is_frame = blocks["block"] == "frame"
+    frame_durations = blocks[is_frame].set_index("frame")["duration_s"]
+    blocks = blocks[~is_frame]
+
+    per_frame = pd.concat(
+        (
+            blocks.groupby(["block_label", "frame"])["duration_s"].sum(),
+            blocks[blocks["block"] != blocks["block_label"]]
+            .groupby(["block", "frame"])["duration_s"]
+            .sum(),
+        )
+    )
+    unassigned = frame_durations - blocks.groupby("frame")["duration_s"].sum()
+    unassigned = unassigned.dropna().clip(lower=0)
+    per_frame = pd.concat(
+        (per_frame, pd.concat({"unassigned": unassigned}, names=["block", "frame"]))
+    )
+    per_frame.index.names = ["block", "frame"]
+
+    grouped = per_frame.groupby(level="block", sort=False)
+    statistics = grouped.agg(
+        frames="size", total_s="sum", mean_s="mean", std_s=lambda d: d.std(ddof=0)
+    )
+    # All rows, the histogramming of e7 runs is outside of the frames but counts as frame time
+    statistics.loc["between_frames"] = pd.Series(
+        {"frames": 0, "total_s": total_seconds - covered_seconds(all_blocks)}
+    )
+    statistics["frames"] = statistics["frames"].astype(int)
+    statistics.insert(2, "share_%", statistics["total_s"] / total_seconds * 100)
+    quantiles = grouped.quantile([p / 100 for p in percentiles]).unstack()
+    quantiles.columns = [f"p{p:g}_s" for p in percentiles]
+    return statistics.join(quantiles).sort_index()
+
+
+def compare_runs(paths: List[Path], percentiles: List[float]) -> pd.DataFrame:
+    """Block statistics of all runs, indexed by block and run."""
+    statistics = dict()
+    for path in paths:
+        blocks, total_seconds = (
+            load_e7_blocks(path) if is_e7_run(path) else load_generic_run(path)
+        )
+        statistics[f"{path.parent.name}/{path.name}"] = block_statistics(
+            blocks, total_seconds, percentiles
+        )
+    return (
+        pd.concat(statistics, names=["run", "block"])
+        .swaplevel()
+        .sort_index(level="block", sort_remaining=False)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("runs", nargs="+", type=Path, help="Toolbox run directories")
+    parser.add_argument(
+        "--percentiles",
+        nargs="+",
+        type=float,
+        default=[50, 95],
+        help="Percentiles of the per frame durations",
+    )
+    parser.add_argument("--csv", type=Path, help="Also write the table to a csv file")
+    args = parser.parse_args()
+
+    comparison = compare_runs(args.runs, args.percentiles)
+    if args.csv is not None:
+        comparison.to_csv(args.csv)
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(comparison.to_string(float_format="{:.1f}".format))
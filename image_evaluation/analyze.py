@@ -1,62 +1,207 @@
 import json
+import argparse
+from multiprocessing import Pool
+from typing import Iterable, List, Tuple
 
 import numpy as np
 import nibabel as nib
-from nilearn.datasets import fetch_atlas_aal
+
+from utils import (
+    LabelReducer,
+    RegionStatistics,
+    SharedArrays,
+    iter_frames,
+    load_cached_atlas,
+    read_frames,
+)
 
 NORM_IMAGE_FILE = "data/pet_mni4d.nii.gz"
+RESULT_FILE = "./data/result.json"
+ATLAS_CACHE_DIR = "data/atlas_cache"
+
+
+def positive_int(value: str) -> int:
+    """Argparse type for counts which must be at least 1."""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
 
-atlas_meta = fetch_atlas_aal()
-atlas = nib.load(atlas_meta["maps"]).get_fdata().astype(np.int16)
-image_sequence = nib.load(NORM_IMAGE_FILE).get_fdata()
+def fetch_aal() -> Tuple[str, list, list]:
+    """Download the AAL atlas with nilearn.
 
-labels = np.array(atlas_meta["labels"])
-indices = np.array(atlas_meta["indices"]).astype(np.int16)
+    :return: Path of the atlas image, region labels and region indices
+    """
+    from nilearn.datasets import fetch_atlas_aal
 
-is_cerebelum = np.char.startswith(labels, "Cerebelum")
-cerebelum_ids = indices[is_cerebelum]
-other_ids = indices[~is_cerebelum]
+    atlas_meta = fetch_atlas_aal()
+    return atlas_meta["maps"], atlas_meta["labels"], atlas_meta["indices"]
 
 
-def get_snrs(image: np.array) -> dict:
+def get_snrs(stats: RegionStatistics, region_ids: Iterable[int]) -> dict:
+    """SNR (mean / std) per region and over all labeled voxels.
+
+    :param stats: Per-label sums of a frame as returned by `LabelReducer.reduce`
+    :param region_ids: Atlas indices of the regions to report
+    """
     results = dict()
     snr_per_region = dict()
     results["snr_per_region"] = snr_per_region
 
-    image[image < 0] = 0
-
-    for index in map(int, atlas_meta["indices"]):
-        subset = image[atlas == index]
-        snr_per_region[index] = subset.mean() / subset.std()
+    for index in map(int, region_ids):
+        mean, std = stats.mean_and_std([index])
+        snr_per_region[index] = mean / std
 
-    subset = image[atlas != 0]
-    results["total_snr"] = subset.mean() / subset.std()
+    mean, std = stats.mean_and_std(stats.label_ids[stats.label_ids != 0])
+    results["total_snr"] = mean / std
 
     return results
 
 
-def get_cnrs(image: np.array) -> dict:
+def get_cnrs(
+    stats: RegionStatistics, reference_ids: Iterable[int], region_ids: Iterable[int]
+) -> dict:
+    """CNR per region with the pooled reference regions as background.
+
+    :param stats: Per-label sums of a frame as returned by `LabelReducer.reduce`
+    :param reference_ids: Atlas indices of the reference (cerebellum) regions
+    :param region_ids: Atlas indices of the regions to report
+    """
     results = dict()
     results["cnr_per_region"] = dict()
 
-    image[image < 0] = 0
-    is_cerebelum = np.isin(atlas, cerebelum_ids)
-    cerebelum_mean = image[is_cerebelum].mean()
-    cerebelum_std = image[is_cerebelum].std()
+    cerebelum_mean, cerebelum_std = stats.mean_and_std(reference_ids)
 
-    for index in map(int, other_ids):
-        mask = atlas == index
-        results["cnr_per_region"][index] = (
-            image[mask].mean() - cerebelum_mean
-        ) / cerebelum_std
+    for index in map(int, region_ids):
+        mean, _ = stats.mean_and_std([index])
+        results["cnr_per_region"][index] = (mean - cerebelum_mean) / cerebelum_std
 
     return results
 
 
-results = []
-for i in range(image_sequence.shape[-1]):
-    image = image_sequence[:, :, :, i]
-    results.append(dict(**get_snrs(image), **get_cnrs(image)))
-
-with open("./data/result.json", "w") as f:
-    json.dump(results, f)
+def evaluate_frame(
+    stats: RegionStatistics,
+    indices: np.ndarray,
+    cerebelum_ids: np.ndarray,
+    other_ids: np.ndarray,
+) -> dict:
+    """Combined SNR and CNR results of a single frame as written to the result file."""
+    return dict(
+        **get_snrs(stats, indices),
+        **get_cnrs(stats, cerebelum_ids, other_ids),
+    )
+
+
+# State of a worker process set up once by `_init_worker`
+_worker = dict()
+
+
+def _init_worker(image_file: str, shape: tuple, spec: tuple, region_ids: tuple):
+    shared = SharedArrays.attach(spec)
+    _worker["shared"] = shared  # Keep the mapping alive
+    _worker["reducer"] = LabelReducer.from_arrays(shape, shared.arrays)
+    _worker["image"] = nib.load(image_file, keep_file_open=True)
+    _worker["region_ids"] = region_ids
+
+
+def _evaluate_block(frame_range: Tuple[int, int]) -> List[dict]:
+    block = read_frames(_worker["image"], *frame_range)
+    return [
+        evaluate_frame(_worker["reducer"].reduce(block[..., i]), *_worker["region_ids"])
+        for i in range(block.shape[-1])
+    ]
+
+
+def evaluate(
+    image_file: str,
+    reducer: LabelReducer,
+    indices: np.ndarray,
+    cerebelum_ids: np.ndarray,
+    other_ids: np.ndarray,
+    workers: int = 1,
+    block_size: int = 1,
+) -> List[dict]:
+    """Evaluate all frames of a 4D image, optionally with a pool of processes.
+
+    With more than one worker, blocks of `block_size` frames are distributed
+    over the pool. The region index of `reducer` is placed in shared memory once
+    and every worker reads its frames directly from `image_file`.
+
+    :return: One result dict per frame in frame order
+    """
+    region_ids = (indices, cerebelum_ids, other_ids)
+    if workers == 1:
+        return [
+            evaluate_frame(reducer.reduce(image), *region_ids)
+            for image in iter_frames(image_file, block_size)
+        ]
+
+    n_frames = nib.load(image_file).shape[-1]
+    frame_ranges = [
+        (start, min(start + block_size, n_frames))
+        for start in range(0, n_frames, block_size)
+    ]
+
+    shared = SharedArrays(reducer.arrays)
+    try:
+        with Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(image_file, reducer.shape, shared.spec, region_ids),
+        ) as pool:
+            return [
+                result
+                for block_results in pool.imap(_evaluate_block, frame_ranges)
+                for result in block_results
+            ]
+    finally:
+        shared.unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute SNR and CNR per region.")
+    parser.add_argument(
+        "--block-size",
+        type=positive_int,
+        default=1,
+        help="Number of frames read from the 4D image at once",
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=1,
+        help="Number of processes evaluating frames in parallel",
+    )
+    parser.add_argument(
+        "--atlas-cache",
+        default=ATLAS_CACHE_DIR,
+        help="Directory of the local AAL atlas cache",
+    )
+    parser.add_argument(
+        "--refresh-atlas",
+        action="store_true",
+        help="Fetch the atlas again and rebuild its cache entry",
+    )
+    args = parser.parse_args()
+
+    atlas = load_cached_atlas(args.atlas_cache, fetch_aal, refresh=args.refresh_atlas)
+    labels = atlas.labels
+    indices = atlas.indices
+
+    is_cerebelum = np.char.startswith(labels, "Cerebelum")
+    cerebelum_ids = indices[is_cerebelum]
+    other_ids = indices[~is_cerebelum]
+
+    results = evaluate(
+        NORM_IMAGE_FILE,
+        atlas.reducer,
+        indices,
+        cerebelum_ids,
+        other_ids,
+        workers=args.workers,
+        block_size=args.block_size,
+    )
+
+    with open(RESULT_FILE, "w") as f:
+        json.dump(results, f)
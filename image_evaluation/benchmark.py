@@ -0,0 +1,231 @@
+"""Benchmark the single-pass label reduction against the per-region mask loop.
+
+Runs on a synthetic atlas and synthetic frames on the MNI 2mm grid by default.
+With `--check` the frames in `NORM_IMAGE_FILE` are streamed as in `analyze.py`,
+evaluated again and compared against an existing result json produced by the
+per-region implementation.
+
+With `--scaling N` a synthetic 4D image is evaluated with 1 to N worker processes
+and the wall time, speedup and parallel efficiency are reported.
+
+Usage: python benchmark.py [--frames N] [--check data/result.json] [--scaling N]
+"""
+
+import os
+import json
+import argparse
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import nibabel as nib
+
+from analyze import evaluate, evaluate_frame
+from utils import LabelReducer, iter_frames, load_cached_atlas
+
+MNI_SHAPE = (91, 109, 91)
+N_REGIONS = 116
+N_CEREBELUM_REGIONS = 18
+
+
+def make_synthetic_atlas(seed: int = 0):
+    """Atlas with `N_REGIONS` box shaped regions inside a background of zeros.
+
+    :return: atlas, region indices, cerebellum indices, other indices
+    """
+    rng = np.random.default_rng(seed)
+    atlas = np.zeros(MNI_SHAPE, dtype=np.int16)
+    inner = atlas[10:-10, 10:-10, 10:-10]
+    indices = np.arange(1, N_REGIONS + 1, dtype=np.int16) * 10
+    inner[...] = rng.choice(indices, size=inner.shape)
+    cerebelum_ids = indices[-N_CEREBELUM_REGIONS:]
+    other_ids = indices[:-N_CEREBELUM_REGIONS]
+    return atlas, indices, cerebelum_ids, other_ids
+
+
+def make_synthetic_frame(
+    seed: int, loc: float = 5000, scale: float = 2000
+) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.normal(loc=loc, scale=scale, size=MNI_SHAPE)
+
+
+def make_edge_case_frames(atlas, indices, cerebelum_ids) -> dict:
+    """Frames whose statistics are easy to get wrong from per-label sums.
+
+    A region that is all zero (SNR nan), a constant reference region (CNR inf)
+    and intensities far above their spread (cancellation in the variance).
+    """
+    zero_region = make_synthetic_frame(seed=0)
+    zero_region[atlas == indices[0]] = 0
+    constant_reference = make_synthetic_frame(seed=1)
+    constant_reference[np.isin(atlas, cerebelum_ids)] = 1000
+    return {
+        "zero region": zero_region,
+        "constant reference": constant_reference,
+        "large offset": make_synthetic_frame(seed=2, loc=1e6, scale=1),
+    }
+
+
+def get_snrs_masked(image, atlas, indices) -> dict:
+    """Reference implementation with one boolean mask per region."""
+    results = {"snr_per_region": dict()}
+    image[image < 0] = 0
+    for index in map(int, indices):
+        subset = image[atlas == index]
+        results["snr_per_region"][index] = subset.mean() / subset.std()
+    subset = image[atlas != 0]
+    results["total_snr"] = subset.mean() / subset.std()
+    return results
+
+
+def get_cnrs_masked(image, atlas, cerebelum_ids, other_ids) -> dict:
+    """Reference implementation with one boolean mask per region."""
+    results = {"cnr_per_region": dict()}
+    image[image < 0] = 0
+    is_cerebelum = np.isin(atlas, cerebelum_ids)
+    cerebelum_mean = image[is_cerebelum].mean()
+    cerebelum_std = image[is_cerebelum].std()
+    for index in map(int, other_ids):
+        mask = atlas == index
+        results["cnr_per_region"][index] = (
+            image[mask].mean() - cerebelum_mean
+        ) / cerebelum_std
+    return results
+
+
+def evaluate_reduced(reducer, image, indices, cerebelum_ids, other_ids) -> dict:
+    image[image < 0] = 0
+    return evaluate_frame(reducer.reduce(image), indices, cerebelum_ids, other_ids)
+
+
+def assert_results_match(expected: dict, actual: dict) -> None:
+    for key in ("snr_per_region", "cnr_per_region"):
+        expected_values = {int(k): v for k, v in expected[key].items()}
+        actual_values = {int(k): v for k, v in actual[key].items()}
+        assert expected_values.keys() == actual_values.keys(), key
+        np.testing.assert_allclose(
+            [actual_values[k] for k in expected_values],
+            list(expected_values.values()),
+            rtol=1e-6,
+        )
+    np.testing.assert_allclose(actual["total_snr"], expected["total_snr"], rtol=1e-6)
+
+
+def run_synthetic(n_frames: int) -> None:
+    atlas, indices, cerebelum_ids, other_ids = make_synthetic_atlas()
+    frames = [make_synthetic_frame(seed) for seed in range(n_frames)]
+
+    start = perf_counter()
+    expected = [
+        dict(
+            **get_snrs_masked(frame.copy(), atlas, indices),
+            **get_cnrs_masked(frame.copy(), atlas, cerebelum_ids, other_ids),
+        )
+        for frame in frames
+    ]
+    masked_seconds = perf_counter() - start
+
+    start = perf_counter()
+    reducer = LabelReducer(atlas)
+    actual = [
+        evaluate_reduced(reducer, frame.copy(), indices, cerebelum_ids, other_ids)
+        for frame in frames
+    ]
+    reduced_seconds = perf_counter() - start
+
+    for expected_frame, actual_frame in zip(expected, actual):
+        assert_results_match(expected_frame, actual_frame)
+
+    edge_cases = make_edge_case_frames(atlas, indices, cerebelum_ids)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for name, frame in edge_cases.items():
+            expected_frame = dict(
+                **get_snrs_masked(frame.copy(), atlas, indices),
+                **get_cnrs_masked(frame.copy(), atlas, cerebelum_ids, other_ids),
+            )
+            actual_frame = evaluate_reduced(
+                reducer, frame.copy(), indices, cerebelum_ids, other_ids
+            )
+            assert_results_match(expected_frame, actual_frame)
+
+    print(f"{n_frames} frames, {len(indices)} regions, shape {MNI_SHAPE}")
+    print(f"edge cases match: {', '.join(edge_cases)}")
+    print(f"per-region masks: {masked_seconds / n_frames * 1000:8.1f} ms/frame")
+    print(f"label reduction:  {reduced_seconds / n_frames * 1000:8.1f} ms/frame")
+    print(f"speedup:          {masked_seconds / reduced_seconds:8.1f}x")
+
+
+def run_scaling(max_workers: int, n_frames: int) -> None:
+    """Evaluate a synthetic 4D image with 1 to `max_workers` processes."""
+    atlas, indices, cerebelum_ids, other_ids = make_synthetic_atlas()
+    reducer = LabelReducer(atlas)
+    sequence = np.stack(
+        [make_synthetic_frame(seed) for seed in range(n_frames)], axis=-1
+    ).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        image_file = os.path.join(tmpdir, "pet_mni4d.nii")
+        nib.save(nib.Nifti1Image(sequence, np.eye(4)), image_file)
+        del sequence
+
+        print(f"{n_frames} frames, shape {MNI_SHAPE}")
+        print("workers  seconds  speedup  efficiency")
+        reference = None
+        for workers in range(1, max_workers + 1):
+            start = perf_counter()
+            results = evaluate(
+                image_file, reducer, indices, cerebelum_ids, other_ids, workers
+            )
+            seconds = perf_counter() - start
+
+            if reference is None:
+                reference, serial_seconds = results, seconds
+            assert results == reference
+
+            speedup = serial_seconds / seconds
+            print(
+                f"{workers:7d}  {seconds:7.2f}  {speedup:7.2f}  {speedup / workers:10.2f}"
+            )
+
+
+def run_check(result_file: str) -> None:
+    from analyze import NORM_IMAGE_FILE, ATLAS_CACHE_DIR, fetch_aal
+
+    with open(result_file) as f:
+        expected = json.load(f)
+
+    atlas = load_cached_atlas(ATLAS_CACHE_DIR, fetch_aal)
+    reducer = atlas.reducer
+    indices = atlas.indices
+    is_cerebelum = np.char.startswith(atlas.labels, "Cerebelum")
+
+    frames = iter_frames(NORM_IMAGE_FILE)
+    assert nib.load(NORM_IMAGE_FILE).shape[-1] == len(expected)
+
+    for image, expected_frame in zip(frames, expected):
+        actual_frame = evaluate_reduced(
+            reducer,
+            image,
+            indices,
+            indices[is_cerebelum],
+            indices[~is_cerebelum],
+        )
+        assert_results_match(expected_frame, actual_frame)
+
+    print(f"All {len(expected)} frames match {result_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--check", metavar="RESULT_JSON")
+    parser.add_argument("--scaling", metavar="MAX_WORKERS", type=int)
+    args = parser.parse_args()
+
+    if args.check:
+        run_check(args.check)
+    elif args.scaling:
+        run_scaling(args.scaling, args.frames)
+    else:
+        run_synthetic(args.frames)
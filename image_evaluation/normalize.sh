@@ -15,7 +15,7 @@ normalize_frame(){
 N_PROCS=32
 
 # Set up paths
-PET_IMAGE="data/sub-00/pet/result.nii.gz"  # Path to the 4D dynamic PET image
+PET_IMAGE="data/sub-00/pet/result"  # 4D dynamic PET image, FSL finds result.nii or result.nii.gz
 T1_IMAGE="data/sub-00/anat/sub-00_T1w.nii"        # Path to the T1-weighted anatomical MRI image
 MNI_TEMPLATE="/usr/share/fsl/5.0/data/standard/MNI152_T1_2mm.nii.gz"  # Path to MNI template (2mm resolution)
 MNI_BRAIN_MASK="/usr/share/fsl/5.0/data/standard/MNI152_T1_2mm_brain_mask.nii.gz"
@@ -0,0 +1,308 @@
+import os
+import json
+import hashlib
+import tempfile
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+import numpy as np
+import nibabel as nib
+
+
+def read_frames(image: nib.Nifti1Image, start: int, stop: int) -> np.ndarray:
+    """Read frames `start` to `stop` (exclusive) of a 4D image as a float32 block
+    with negative values set to 0."""
+    block = np.array(image.dataobj[..., start:stop], dtype=np.float32)
+    np.maximum(block, 0, out=block)
+    return block
+
+
+def iter_frames(filepath: str, block_size: int = 1) -> Iterator[np.ndarray]:
+    """Stream the frames of a 4D NIfTI image as float32 with negatives set to 0.
+
+    Frames are read `block_size` at a time through the nibabel array proxy,
+    so only one block is held in memory instead of the whole 4D image.
+    Uncompressed `.nii` files are memory mapped, `.nii.gz` files are
+    decompressed sequentially with a single open file handle.
+
+    :param filepath: Path to the 4D image
+    :param block_size: Number of frames to read at once
+    :return: Iterator over 3D frames in order
+    """
+    image = nib.load(filepath, keep_file_open=True)
+    n_frames = image.shape[-1]
+    for block_start in range(0, n_frames, block_size):
+        block_end = min(block_start + block_size, n_frames)
+        block = read_frames(image, block_start, block_end)
+        for i in range(block.shape[-1]):
+            yield block[..., i]
+
+
+class RegionStatistics(NamedTuple):
+    """Voxel count, sum and sum of squared deviations from the mean for every label
+    of an atlas.
+
+    All arrays are aligned with `label_ids`, which is sorted ascending.
+    """
+
+    label_ids: np.ndarray
+    counts: np.ndarray
+    sums: np.ndarray
+    squared_deviations: np.ndarray
+
+    def mean_and_std(self, ids: Iterable[int]) -> Tuple[np.float64, np.float64]:
+        """Mean and (population) standard deviation over the union of the regions.
+
+        The squared deviations of the regions are pooled around the common mean,
+        which avoids the cancellation of `sum of squares / count - mean**2` for
+        intensities that are large compared to their spread.
+
+        :param ids: Atlas label values of the regions to pool
+        :return: Mean and standard deviation, nan if no voxel is labeled with `ids`
+        """
+        positions = np.isin(self.label_ids, list(ids))
+        counts = self.counts[positions]
+        count = counts.sum()
+        if count == 0:
+            return np.float64(np.nan), np.float64(np.nan)
+        sums = self.sums[positions]
+        mean = sums.sum() / count
+        region_means = sums / counts
+        variance = (
+            self.squared_deviations[positions].sum()
+            + (counts * (region_means - mean) ** 2).sum()
+        ) / count
+        return np.float64(mean), np.float64(np.sqrt(variance))
+
+
+class LabelReducer:
+    """Compute per-label statistics of images in a single pass.
+
+    Instead of building a boolean mask `atlas == index` for every region,
+    the atlas is sorted once into a CSR-style region index: `voxels` holds the
+    flat indices of all labeled voxels grouped by label (ascending within a
+    label) and `offsets[i]:offsets[i + 1]` is the slice belonging to
+    `label_ids[i]`. Each image is reduced by gathering the labeled voxels once
+    and summing the segments with `np.add.reduceat`. The background is not
+    part of the index.
+
+    :param atlas: Integer label volume, 0 marks the background
+    """
+
+    def __init__(self, atlas: np.ndarray) -> None:
+        flat = atlas.ravel()
+        voxels = np.flatnonzero(flat)
+        voxels = voxels[np.argsort(flat[voxels], kind="stable")].astype(np.int32)
+        label_ids, counts = np.unique(flat[voxels], return_counts=True)
+
+        self.shape = atlas.shape
+        self.label_ids = label_ids
+        self.counts = counts
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.voxels = voxels
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """The precomputed region index, e.g. to place it in shared memory."""
+        return {
+            "label_ids": self.label_ids,
+            "counts": self.counts,
+            "offsets": self.offsets,
+            "voxels": self.voxels,
+        }
+
+    @classmethod
+    def from_arrays(
+        cls, shape: Tuple[int, ...], arrays: Dict[str, np.ndarray]
+    ) -> "LabelReducer":
+        """Recreate a reducer from `arrays` of another one without copying them."""
+        reducer = cls.__new__(cls)
+        reducer.shape = tuple(shape)
+        reducer.label_ids = arrays["label_ids"]
+        reducer.counts = arrays["counts"]
+        reducer.offsets = arrays["offsets"]
+        reducer.voxels = arrays["voxels"]
+        return reducer
+
+    def reduce(self, image: np.ndarray) -> RegionStatistics:
+        """Reduce an image with the same shape as the atlas to per-label sums.
+
+        :param image: Image in atlas space, accumulated in double precision
+        :return: Counts, sums and sums of squared deviations for every label
+        """
+        if image.shape != self.shape:
+            raise ValueError(
+                f"Image shape {image.shape} does not match atlas shape {self.shape}"
+            )
+        if len(self.voxels) == 0:
+            empty = np.zeros(0)
+            return RegionStatistics(self.label_ids, self.counts, empty, empty)
+
+        values = image.ravel()[self.voxels].astype(np.float64)
+        sums = np.add.reduceat(values, self.offsets[:-1])
+        # Second pass over the gathered values around the mean of every label
+        values -= np.repeat(sums / self.counts, self.counts)
+        values *= values
+        squared_deviations = np.add.reduceat(values, self.offsets[:-1])
+
+        return RegionStatistics(self.label_ids, self.counts, sums, squared_deviations)
+
+
+class CachedAtlas(NamedTuple):
+    """Atlas loaded from the on-disk cache, see `load_cached_atlas`."""
+
+    atlas: np.ndarray
+    labels: np.ndarray
+    indices: np.ndarray
+    reducer: LabelReducer
+
+
+ATLAS_CACHE_POINTER = "current.json"
+_ATLAS_CACHE_ARRAYS = ("atlas", "label_ids", "counts", "offsets", "voxels")
+
+
+def load_cached_atlas(
+    cache_dir: str, fetch: Callable[[], Tuple[str, list, list]], refresh: bool = False
+) -> CachedAtlas:
+    """Load an atlas and its region index from a local cache.
+
+    Each cache entry lives in a directory named after the sha256 of the atlas
+    image and its labels and stores the label volume, the region index of
+    `LabelReducer` as `.npy` files and the labels in `meta.json`.
+    `current.json` points to the entry to use, so later runs memory map the
+    arrays without calling `fetch` (and without network access).
+
+    :param cache_dir: Directory holding the cache entries
+    :param fetch: Callable returning the atlas image path, labels and indices,
+        only called if the cache is empty or `refresh` is set
+    :param refresh: Rebuild the cache entry from `fetch`
+    """
+    pointer_file = os.path.join(cache_dir, ATLAS_CACHE_POINTER)
+    if refresh or not os.path.exists(pointer_file):
+        _build_atlas_cache(cache_dir, *fetch())
+
+    with open(pointer_file) as f:
+        entry_dir = os.path.join(cache_dir, json.load(f)["hash"])
+    with open(os.path.join(entry_dir, "meta.json")) as f:
+        meta = json.load(f)
+
+    arrays = {
+        name: np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode="r")
+        for name in _ATLAS_CACHE_ARRAYS
+    }
+    return CachedAtlas(
+        atlas=arrays["atlas"],
+        labels=np.array(meta["labels"]),
+        indices=np.array(meta["indices"], dtype=np.int16),
+        reducer=LabelReducer.from_arrays(meta["shape"], arrays),
+    )
+
+
+def _build_atlas_cache(
+    cache_dir: str, atlas_file: str, labels: list, indices: list
+) -> None:
+    labels = [str(label) for label in labels]
+    indices = [int(index) for index in indices]
+
+    content_hash = hashlib.sha256()
+    with open(atlas_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            content_hash.update(chunk)
+    content_hash.update(json.dumps([labels, indices]).encode())
+    digest = content_hash.hexdigest()
+
+    entry_dir = os.path.join(cache_dir, digest)
+    if not os.path.exists(entry_dir):
+        atlas = np.asarray(nib.load(atlas_file).get_fdata(), dtype=np.int16)
+        reducer = LabelReducer(atlas)
+
+        # Write to a temporary directory first so an interrupted run
+        # never leaves an incomplete entry behind
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+        for name, array in dict(atlas=atlas, **reducer.arrays).items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "source": atlas_file,
+                    "shape": atlas.shape,
+                    "labels": labels,
+                    "indices": indices,
+                },
+                f,
+            )
+        os.rename(tmp_dir, entry_dir)
+
+    pointer_file = os.path.join(cache_dir, ATLAS_CACHE_POINTER)
+    with open(f"{pointer_file}.tmp", "w") as f:
+        json.dump({"hash": digest}, f)
+    os.replace(f"{pointer_file}.tmp", pointer_file)
+
+
+def attach_shared_memory(name: str) -> SharedMemory:
+    """Attach to a shared memory block without tracking it in this process.
+
+    Attaching registers the block with the resource tracker like creating it,
+    which may unlink it when the attaching process ends, although it belongs to its creator.
+    """
+    try:
+        return SharedMemory(name=name, track=False)  # Python >= 3.13
+    except TypeError:
+        shm = SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedArrays:
+    """Place a set of numpy arrays in one shared memory block.
+
+    The creating process constructs the object from a dict of arrays,
+    worker processes attach with the picklable `spec` and get read-only
+    views on the same memory instead of their own pickled copies.
+    The creator is responsible for calling `unlink` when all workers are done.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]) -> None:
+        layout = []
+        offset = 0
+        for name, array in arrays.items():
+            offset = -(-offset // 64) * 64  # Keep every array cache line aligned
+            layout.append((name, array.dtype.str, array.shape, offset))
+            offset += array.nbytes
+        self._shm = SharedMemory(create=True, size=max(offset, 1))
+        self.spec = (self._shm.name, layout)
+        self.arrays = self._views(self._shm, layout)
+        for name, array in arrays.items():
+            self.arrays[name][...] = array
+
+    @staticmethod
+    def _views(shm: SharedMemory, layout: List[tuple]) -> Dict[str, np.ndarray]:
+        return {
+            name: np.ndarray(
+                shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset
+            )
+            for name, dtype, shape, offset in layout
+        }
+
+    @classmethod
+    def attach(cls, spec: tuple) -> "SharedArrays":
+        """Attach to arrays created in another process from their `spec`."""
+        name, layout = spec
+        shared = cls.__new__(cls)
+        shared._shm = attach_shared_memory(name)
+        shared.spec = spec
+        shared.arrays = cls._views(shared._shm, layout)
+        for array in shared.arrays.values():
+            array.flags.writeable = False
+        return shared
+
+    def unlink(self) -> None:
+        """Release the shared memory block, only to be called by the creator."""
+        self.arrays = dict()
+        self._shm.close()
+        # Workers share the resource tracker of their creator, before Python 3.13
+        # attaching removed the block from it, unlink expects it to be registered
+        resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
@@ -1,12 +1,14 @@
 """Utilities to load metadata and timing information"""
 
 import os
+import re
 import json
+import bisect
 import warnings
 
 warnings.filterwarnings("ignore")
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import pandas as pd
 import numpy as np
@@ -14,6 +16,7 @@ import pandas as pd
 
 
 E7_LOG_START_OF_MSG_COL_IDX = 39
+METADATA_RECORD_FILE = "metadata.jsonl"
 
 
 def load_resources_and_timings(path: Path) -> Tuple[pd.DataFrame, pd.DataFrame]:
@@ -24,64 +27,254 @@ def load_resources_and_timings(path: Path) -> Tuple[pd.DataFrame, pd.DataFrame]:
              with one row for each frame
     """
     resource_file = path / "resources.csv"
+
+    timings = parse_timings(load_metadata(path))
+    resource_data = parse_resources_file(resource_file)
+
+    return resource_data, timings
+
+
+def load_metadata(path: Path) -> dict:
+    """Load 'metadata.json' from a toolbox directory.
+
+    Falls back to the 'metadata.jsonl' record stream if the run
+    has not finished (or crashed) before writing 'metadata.json'.
+
+    :param path: Path to a toolbox output directory
+    :return: Dict in the layout of 'metadata.json'
+    """
     metadata_file = path / "metadata.json"
+    if not metadata_file.exists() and (path / METADATA_RECORD_FILE).exists():
+        return MetadataRecordReader(path / METADATA_RECORD_FILE).read()
 
     with open(metadata_file) as f:
-        metadata = json.load(f)
+        return json.load(f)
 
-    timings = parse_timings(metadata)
-    resource_data = parse_resources_file(resource_file)
 
-    return resource_data, timings
+class MetadataRecordReader:
+    """Incrementally read the 'metadata.jsonl' record stream
+    which ReconMetadata appends to while a reconstruction is running.
+
+    Every call of `read` only parses the lines appended since the previous call,
+    so it can be polled cheaply to follow a long reconstruction.
+    A partially written last line is left for the next call.
+    Frames the run took from the cache get the timings and frame metadata of the
+    earlier run which reconstructed them from its rotated 'metadata.<time>.jsonl',
+    with 'cached' set in their frame metadata.
+
+    :param record_file: Path to the 'metadata.jsonl' file
+    :param previous_frames: Timings and frame metadata of earlier runs by frame index,
+        read from the rotated record files next to `record_file` if not given
+    """
+
+    def __init__(
+        self, record_file: Path, previous_frames: Optional[Dict[int, tuple]] = None
+    ) -> None:
+        self._record_file = record_file
+        self._offset = 0
+        self._frame_indices = []
+        if previous_frames is None:
+            previous_frames = read_previous_frames(record_file)
+        self._previous_frames = previous_frames
+        self.metadata = {
+            "metadata": dict(),
+            "total_seconds": None,
+            "frame_indices": self._frame_indices,
+            "timings": [],
+            "frame_metadata": [],
+        }
+
+    def _add_frame(self, frame_idx: int, timings: dict, frame_metadata: dict) -> None:
+        # Frames reconstructed in parallel finish out of order
+        position = bisect.bisect_left(self._frame_indices, frame_idx)
+        if (
+            position < len(self._frame_indices)
+            and self._frame_indices[position] == frame_idx
+        ):
+            self.metadata["timings"][position] = timings
+            self.metadata["frame_metadata"][position] = frame_metadata
+            return
+        self._frame_indices.insert(position, frame_idx)
+        self.metadata["timings"].insert(position, timings)
+        self.metadata["frame_metadata"].insert(position, frame_metadata)
+
+    def read(self) -> dict:
+        """Parse new records.
+
+        :return: Dict in the layout of 'metadata.json' with all frames completed so far
+            ordered by frame index,
+            'total_seconds' is None until the reconstruction has ended
+        """
+        with open(self._record_file, "rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                self._offset += len(line)
+                record = json.loads(line)
+                if "metadata" in record:
+                    self.metadata["metadata"].update(record["metadata"])
+                elif "frame" in record:
+                    self._add_frame(
+                        record.get("frame_idx", len(self._frame_indices) + 1),
+                        record["frame"],
+                        record.get("frame_metadata", dict()),
+                    )
+                elif "cached_frame_idx" in record:
+                    frame_idx = record["cached_frame_idx"]
+                    if frame_idx in self._previous_frames:
+                        timings, frame_metadata = self._previous_frames[frame_idx]
+                        self._add_frame(
+                            frame_idx, timings, {**frame_metadata, "cached": True}
+                        )
+                elif "total_seconds" in record:
+                    self.metadata["total_seconds"] = record["total_seconds"]
+        return self.metadata
+
+    def read_timings(self) -> pd.DataFrame:
+        """Timings of all frames completed so far, see `parse_timings`."""
+        return parse_timings(self.read())
+
+
+def read_previous_frames(record_file: Path) -> Dict[int, tuple]:
+    """Timings and frame metadata of the frames of earlier runs by frame index.
+
+    ReconMetadata renames the record file of an earlier run to 'metadata.<time>.jsonl',
+    later runs replace the frames of earlier ones.
+
+    :param record_file: Path to the current 'metadata.jsonl' file
+    """
+    previous_frames = dict()
+    for previous_file in sorted(
+        record_file.parent.glob(f"{record_file.stem}.*{record_file.suffix}")
+    ):
+        records = MetadataRecordReader(previous_file, dict(previous_frames)).read()
+        previous_frames.update(
+            zip(
+                records["frame_indices"],
+                zip(records["timings"], records["frame_metadata"]),
+            )
+        )
+    return previous_frames
+
+
+RESOURCE_COLUMNS = {
+    "Timestamp": "time",
+    "CPU_Usage(%)": "cpu_util",
+    "Memory_Usage(%)": "memory_util",
+    "Memory_Usage/Limit": "memory",
+    "GPU_Memory": "gpu_memory",
+    "GPU_Utilization": "gpu_util",
+    "Disk_Read": "disk_read",
+    "Disk_Written": "disk_written",
+}
+# Memory is reported in GiB, MiB count as 1/1000 GiB like in the plots so far
+MEMORY_UNIT_DIVISORS = {"GiB": 1, "MiB": 1e3, "KiB": 1e6, "kB": 1e6, "B": 1e9}
+MEMORY_PATTERN = r"^\s*(?P<value>[\d.]+)\s*(?P<unit>GiB|MiB|KiB|kB|B)\b"
+PERCENT_PATTERN = r"^\s*(?P<value>[\d.]+)\s*%"
+MIB_PATTERN = r"^\s*(?P<value>[\d.]+)\s*MiB"
+
+
+def _to_float32(column: pd.Series) -> np.ndarray:
+    """Numeric or numeric string column as float32 with missing values as nan."""
+    if isinstance(column.dtype, pd.ArrowDtype):
+        column = column.astype("float32[pyarrow]")
+    else:
+        column = column.astype(np.float32)
+    return column.to_numpy(np.float32, na_value=np.nan)
+
+
+def _extract_number(column: pd.Series, pattern: str) -> np.ndarray:
+    """Extract the `value` group of `pattern` from every non empty value as float32."""
+    if pd.api.types.is_numeric_dtype(column.dtype) or column.isna().all():
+        # Empty columns, e.g. GPU columns sampled without a GPU
+        return _to_float32(column)
+    if not isinstance(column.dtype, pd.ArrowDtype):
+        column = column.astype("string")
+    values = column.str.extract(pattern, expand=False)
+    if (values.isna() & column.notna()).any():
+        raise ValueError(f"Values of column '{column.name}' do not match {pattern}")
+    return _to_float32(values)
+
+
+def _read_resources_csv(datafile: str) -> pd.DataFrame:
+    """Read with the multithreaded pyarrow engine into arrow backed columns,
+    whose string methods run in pyarrow compute instead of per value in Python."""
+    try:
+        return pd.read_csv(datafile, engine="pyarrow", dtype_backend="pyarrow")
+    except ImportError:
+        return pd.read_csv(datafile)
+
+
+def _resources_cache_file(datafile: str) -> Path:
+    """Parquet cache next to the csv, keyed by its modification time and size."""
+    datafile = Path(datafile)
+    stat = datafile.stat()
+    return datafile.with_name(
+        f".{datafile.name}.{stat.st_mtime_ns}-{stat.st_size}.parquet"
+    )
 
 
-def parse_resources_file(datafile: str) -> pd.DataFrame:
+def parse_resources_file(datafile: str, use_cache: bool = True) -> pd.DataFrame:
     """Read resource information produced for a toolbox
     by the comparison script into a dataframe.
 
+    Every unit suffixed column is parsed with a single regex extraction and
+    the csv is read with the pyarrow engine if it is installed.
+    The parsed dataframe is cached as a hidden Parquet file next to the csv,
+    which is used as long as the modification time and size of the csv are unchanged.
+    Without pyarrow (or fastparquet) nothing is cached.
+
     :param datafile: path to a resources.csv file from a toolbox
+    :param use_cache: Read and write the Parquet cache
     :return: A dataframe with columns 'time', 'n_cpus',
         'memory', 'gpu_util' 'gpu_memory', `disk_read`, `disk_written`
         Memory values are in GiB, disk read/written in GiB / s, utilization in %
     """
-    data = (
-        pd.read_csv(datafile)
-        .rename(
-            {
-                "Timestamp": "time",
-                "CPU_Usage(%)": "cpu_util",
-                "Memory_Usage(%)": "memory_util",
-                "Memory_Usage/Limit": "memory",
-                "GPU_Memory": "gpu_memory",
-                "GPU_Utilization": "gpu_util",
-                "Disk_Read": "disk_read",
-                "Disk_Written": "disk_written",
-            },
-            axis=1,
-        )
-        .drop("memory_util", axis=1)
+    cache_file = _resources_cache_file(datafile) if use_cache else None
+    if cache_file is not None and cache_file.exists():
+        try:
+            return pd.read_parquet(cache_file)
+        except ImportError:
+            pass
+
+    raw = _read_resources_csv(datafile).rename(RESOURCE_COLUMNS, axis=1)
+
+    memory = raw["memory"]
+    if not isinstance(memory.dtype, pd.ArrowDtype):
+        memory = memory.astype("string")
+    memory = memory.str.extract(MEMORY_PATTERN)
+    if memory["value"].isna().any():
+        raise ValueError(f"Values of column 'memory' do not match {MEMORY_PATTERN}")
+    memory_divisors = _to_float32(memory["unit"].map(MEMORY_UNIT_DIVISORS))
+
+    time = raw["time"]
+    if isinstance(time.dtype, pd.ArrowDtype) and time.dtype.kind == "M":
+        time = time.astype("datetime64[us]")
+    else:
+        time = pd.to_datetime(time, format="ISO8601")
+
+    data = pd.DataFrame(
+        {
+            "memory": _to_float32(memory["value"]) / memory_divisors,
+            "gpu_memory": _extract_number(raw["gpu_memory"], MIB_PATTERN) / 1000,
+            "gpu_util": _extract_number(raw["gpu_util"], PERCENT_PATTERN),
+            "disk_read": _to_float32(raw["disk_read"]) / 1000,
+            "disk_written": _to_float32(raw["disk_written"]) / 1000,
+            "n_cpus": _extract_number(raw["cpu_util"], PERCENT_PATTERN) / 100,
+        },
+        index=pd.DatetimeIndex(time, name="time"),
     )
 
-    data["time"] = pd.to_datetime(data["time"])
-    data.set_index("time", inplace=True)
-    data["memory"] = data["memory"].str.split(" / ").str[0]
-    is_zero_b = data["memory"] == "0B"
-    data.loc[is_zero_b, "memory"] = "0GiB"
-    is_gigabyte = data["memory"].str.endswith("GiB")
-    is_megabyte = data["memory"].str.endswith("MiB")
-    assert (is_gigabyte | is_megabyte).all()
-    data["memory"] = data["memory"].str[:-3].astype(np.float32)
-    data.loc[is_megabyte, "memory"] = data.loc[is_megabyte, "memory"] / 1000
-
-    data["n_cpus"] = data["cpu_util"].str[:-1].astype(np.float32) / 100
-    data.drop("cpu_util", axis=1, inplace=True)
-
-    data["gpu_util"] = data["gpu_util"].str[:-2].astype(np.float32)
-    assert data["gpu_memory"].str.endswith("MiB").all()
-    data["gpu_memory"] = data["gpu_memory"].str[:-4].astype(np.float32) / 1000
-
-    data["disk_written"] = data["disk_written"].astype(np.float32) / 1000
-    data["disk_read"] = data["disk_read"].astype(np.float32) / 1000
+    if cache_file is not None:
+        for old_cache_file in cache_file.parent.glob(
+            f".{Path(datafile).name}.*.parquet"
+        ):
+            old_cache_file.unlink()
+        try:
+            data.to_parquet(cache_file)
+        except (ImportError, OSError):
+            pass
 
     return data
 
@@ -89,10 +282,18 @@ def parse_resources_file(datafile: str) -> pd.DataFrame:
 def parse_timings(metadata: dict) -> pd.DataFrame:
     """Extract the timing information from metadata into a dataframe.
 
+    Frames are labeled from 0. Metadata with 'frame_indices' (starting at 1)
+    labels every frame by its index minus 1, so frames without timings, e.g. frames
+    a resumed run took from the cache, do not shift the labels of the following frames.
+    Otherwise the frames are labeled by their position.
+
     :param metadata: Dict loaded from the metadata.json saved for a toolbox
     :return: dataframe with one row per frame
         columns are a multiindex with first level block name and second start/end times
     """
+    frame_labels = None
+    if "frame_indices" in metadata:
+        frame_labels = [frame_idx - 1 for frame_idx in metadata["frame_indices"]]
     timings = pd.DataFrame(
         [
             {
@@ -101,18 +302,136 @@ def parse_timings(metadata: dict) -> pd.DataFrame:
                 for inner_key, value in inner_dict.items()
             }
             for frame in metadata["timings"]
-        ]
+        ],
+        index=frame_labels,
     ).map(pd.to_datetime)
     timings.columns = pd.MultiIndex.from_tuples(timings.columns)
     return timings
 
 
+INTERVAL_SEARCH_SIDES = {
+    # closed: side to search starts with, side to search ends with
+    "both": ("left", "right"),
+    "neither": ("right", "left"),
+    "left": ("left", "left"),
+    "right": ("right", "right"),
+}
+
+
+def interval_bounds(
+    index: pd.DatetimeIndex, starts, ends, closed: str = "both"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions of the samples inside of each interval in a sorted time index.
+
+    The samples of interval i are `index[lower[i]:upper[i]]`, so the rows of
+    a dataframe are selected with `iloc` slices instead of boolean masks.
+
+    :param index: Sorted time index of the resource samples
+    :param starts: Start times of the intervals
+    :param ends: End times of the intervals
+    :param closed: Which interval edges include samples, as in `pd.Interval`
+    :return: lower, upper positions for every interval
+    """
+    if not index.is_monotonic_increasing:
+        raise ValueError("Resource samples must be sorted by time")
+    start_side, end_side = INTERVAL_SEARCH_SIDES[closed]
+    lower = index.searchsorted(np.asarray(starts, dtype=index.dtype), start_side)
+    upper = index.searchsorted(np.asarray(ends, dtype=index.dtype), end_side)
+    return lower, np.maximum(upper, lower)
+
+
+def assign_to_intervals(
+    index: pd.DatetimeIndex, starts, ends, closed: str = "both"
+) -> np.ndarray:
+    """Position of the interval every sample of a sorted time index belongs to.
+
+    Intervals with a missing (NaT) start or end are ignored. Where intervals
+    overlap, samples are assigned to the interval starting last among those
+    containing them, so samples after the end of a nested interval fall back
+    to the interval enclosing it.
+
+    :param index: Sorted time index of the resource samples
+    :param starts: Start times of the intervals
+    :param ends: End times of the intervals
+    :param closed: Which interval edges include samples, as in `pd.Interval`
+    :return: Interval position for every sample, -1 for samples outside of all intervals
+    """
+    starts = pd.DatetimeIndex(starts)
+    ends = pd.DatetimeIndex(ends)
+    positions = np.flatnonzero(~(starts.isna() | ends.isna()))
+    lower, upper = interval_bounds(index, starts[positions], ends[positions], closed)
+
+    # Written in the order of their start, later starting intervals
+    # only replace the intervals enclosing them where they overlap
+    assigned = np.full(len(index), -1, dtype=np.int64)
+    order = np.argsort(lower, kind="stable")
+    for position, start, end in zip(positions[order], lower[order], upper[order]):
+        assigned[start:end] = position
+    return assigned
+
+
+def assign_frames_and_blocks(
+    index: pd.DatetimeIndex, timings: pd.DataFrame, closed: str = "both"
+) -> pd.DataFrame:
+    """Interval join of resource samples with the frames and blocks they were taken in.
+
+    :param index: Sorted time index of the resource samples
+    :param timings: Timings as returned by `parse_timings` or the e7 loaders
+    :param closed: Which interval edges include samples, as in `pd.Interval`
+    :return: Dataframe with the same index and columns 'frame' (label of the
+        frame in `timings`, NA outside of frames) and 'block' (name of the
+        block, NaN where no block besides 'frame' is running)
+    """
+    frame_positions = assign_to_intervals(
+        index, timings[("frame", "start")], timings[("frame", "end")], closed
+    )
+    frames = pd.array(timings.index.to_numpy()[frame_positions], dtype="Int64")
+    frames[frame_positions == -1] = pd.NA
+
+    block_names = timings.columns.get_level_values(0).unique().drop("frame")
+    block_timings = timings.loc[:, list(block_names)].stack(level=0, future_stack=True)
+    block_positions = assign_to_intervals(
+        index, block_timings["start"], block_timings["end"], closed
+    )
+    blocks = pd.Categorical.from_codes(
+        np.where(
+            block_positions == -1,
+            -1,
+            block_names.get_indexer(
+                block_timings.index.get_level_values(1)[block_positions]
+            ),
+        ),
+        categories=block_names,
+    )
+    return pd.DataFrame({"frame": frames, "block": blocks}, index=index)
+
+
+def iter_frame_slices(
+    resource_data: pd.DataFrame, timings: pd.DataFrame, closed: str = "both"
+) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """Resource samples of every frame as `iloc` slices without copying the data.
+
+    :param resource_data: Resource samples with a sorted DatetimeIndex
+    :param timings: Timings as returned by `parse_timings` or the e7 loaders
+    :param closed: Which interval edges include samples, as in `pd.Interval`
+    :return: Iterator over frame label, resource samples of the frame
+    """
+    lower, upper = interval_bounds(
+        resource_data.index,
+        timings[("frame", "start")],
+        timings[("frame", "end")],
+        closed,
+    )
+    for frame, frame_lower, frame_upper in zip(timings.index, lower, upper):
+        yield frame, resource_data.iloc[frame_lower:frame_upper]
+
+
 def prepare_for_single_frame_plot(
     resource_data: pd.DataFrame, frame_timings: pd.DataFrame, frame_index: int
 ) -> Tuple[pd.DataFrame, pd.Series]:
     """Extract frame from resource data and time everything in seconds relative to start.
 
-    :param resource_data: DataFrame with DatetimeIndex
+    :param resource_data: DataFrame with sorted DatetimeIndex
     :param frame_timings: Timing information for all frames as loaded from resources.csv
     :param frame_index: Index of the frame to create the plot for
     :return: resource_data: Extracted data for specified frame
@@ -122,122 +441,182 @@ def prepare_for_single_frame_plot(
     single_frame_timings = frame_timings.loc[frame_index, :]
     frame_start = single_frame_timings["frame"]["start"]
     frame_end = single_frame_timings["frame"]["end"]
-    is_in_frame = (resource_data.index > frame_start) & (
-        resource_data.index < frame_end
+    (lower,), (upper,) = interval_bounds(
+        resource_data.index, [frame_start], [frame_end], closed="neither"
     )
-    resource_data = resource_data[is_in_frame]
+    resource_data = resource_data.iloc[lower:upper]
     single_frame_timings = (single_frame_timings - frame_start).dt.seconds
     resource_data.index = (resource_data.index - frame_start).seconds
 
     return resource_data, single_frame_timings
 
 
-def fix_e7_log_column_lengths(
-    filepath: Path, fixed_col_length_file: Path, force: bool = False
-) -> None:
-    """So that e7 logs can be read with pd.read_fwf,
-    message column is padded with whitespace where messages
-    are shorter than the maximum message length.
-    First line is removed from the log.
+class E7Event(NamedTuple):
+    """A log message marking the start or end of a block in an e7 tools log."""
+
+    pattern: str  # Regex searched in the stripped message, '^' anchors it at its start
+    block: str
+    edge: str  # "start" or "end"
+
+
+# Used for GPU and No-GPU logs alike, blocks are returned in the order of the tables
+E7_RECON_EVENTS = (
+    E7Event(r"^axis table=4084", "frame", "start"),
+    E7Event(r"^finished calculation of image", "frame", "end"),
+    E7Event(r"estimate scatter sinogram", "scatter", "start"),
+    E7Event(r"End Scatter Simulation Iteration 2", "scatter", "end"),
+    E7Event(r"start calculation of image", "recon", "start"),
+    E7Event(r"finished calculation of image", "recon", "end"),
+)
+E7_HISTO_EVENTS = (
+    E7Event(r"Sinogram no =", "frame", "start"),
+    E7Event(r"Frame_write: Just sent Frame", "frame", "end"),
+)
+# HistogramReplay logs "Sinogram no =" during its setup in the first 600 lines
+# and twice for every histogrammed frame, the first frame_write ends the setup
+E7_HISTO_SETUP_LINES = 600
+E7_HISTO_STARTS_PER_FRAME = 2
+E7_HISTO_SETUP_FRAME_WRITES = 1
+
+
+def iter_e7_events(
+    filepath: Path, events: Iterable[E7Event]
+) -> Iterator[Tuple[int, str, List[E7Event]]]:
+    """Stream an e7 tools log once and yield the lines matching any event.
+
+    Log lines have fixed columns, the message type is in column 0,
+    the timestamp in columns 2 to 25 and the message starts at column 38.
+    Every message is searched once with a single compiled alternation of
+    the event patterns, the events whose pattern matched are looked up
+    only for the few matching lines, so memory does not grow with the log size.
 
     :param filepath: Path to e7 tools log ouput
-    :param transformed_filepath: Path to write result to
-    :param force: Do not skip if transformed file exists
+    :param events: Messages marking the blocks, a pattern may be used by several events
+    :return: Iterator over the line index (header and blank lines not counted),
+        timestamp and matched events of every matching line
     """
-    if not os.path.exists(fixed_col_length_file) or force:
-        with open(filepath, "r") as f:
-            next(f)  # Drop header
-            log_lines = f.readlines()
-
-        max_msg_col_length = max(len(line) for line in log_lines)
-
-        with open(fixed_col_length_file, "w") as f:
-            for original_line in log_lines:
-                msg_col_length = len(original_line) - E7_LOG_START_OF_MSG_COL_IDX
-                new_line = (
-                    original_line[:-1]
-                    + " " * (max_msg_col_length - msg_col_length)
-                    + "\n"
-                )
-                f.write(new_line)
-
+    events_by_pattern = dict()
+    for event in events:
+        events_by_pattern.setdefault(re.compile(event.pattern), []).append(event)
+    alternation = re.compile(
+        "|".join(f"(?:{pattern.pattern})" for pattern in events_by_pattern)
+    )
 
-def load_e7_fixed_col_length_file(path: Path) -> pd.DataFrame:
-    """Load the transformed file and perform preprocessing.
+    with open(filepath, "r") as f:
+        next(f)  # Drop header
+        line_idx = -1
+        for line in f:
+            if not line.strip():
+                continue
+            line_idx += 1
+            message = line[E7_LOG_START_OF_MSG_COL_IDX - 1 :].strip()
+            match = alternation.search(message)
+            if match is None:
+                continue
+            # match() only lets '^' match at the start of the message, not at the position
+            yield line_idx, line[2:25], [
+                event
+                for pattern, pattern_events in events_by_pattern.items()
+                if pattern.match(message, match.start())
+                for event in pattern_events
+            ]
+
+
+def parse_e7_timings(filepath: Path, events: Iterable[E7Event]) -> pd.DataFrame:
+    """Collect the start and end times of all blocks of an e7 tools log in one pass.
+
+    A start opens its block and an end closes it. Starts of a block which is
+    already open and ends of a block which is not open are counted as unmatched.
 
-    :param path: Preprocessed file with a constant column length
-    :return: dataframe with time index and colums msg_type, msg
+    :param filepath: Path to e7 tools log ouput
+    :param events: Messages marking the blocks, a pattern may be used by several events
+    :return: Dataframe with one row per block and (block, 'start'/'end') columns
+    :raises ValueError: If there are unmatched events or the blocks were not seen equally often
     """
-    with open(path, "r") as f:
-        max_msg_col_length = len(f.readline())
+    blocks = {event.block: {"start": [], "end": []} for event in events}
+    is_open = dict.fromkeys(blocks, False)
+    unmatched = {block: {"start": 0, "end": 0} for block in blocks}
+    for _, time, matched_events in iter_e7_events(filepath, events):
+        for event in matched_events:
+            if is_open[event.block] == (event.edge == "start"):
+                unmatched[event.block][event.edge] += 1
+                continue
+            blocks[event.block][event.edge].append(time)
+            is_open[event.block] = event.edge == "start"
+
+    counts = {
+        block: (
+            len(times["start"]) + unmatched[block]["start"],
+            len(times["end"]) + unmatched[block]["end"],
+        )
+        for block, times in blocks.items()
+    }
+    if (
+        any(n_starts != n_ends for n_starts, n_ends in counts.values())
+        or any(
+            n
+            for block_unmatched in unmatched.values()
+            for n in block_unmatched.values()
+        )
+        or len({len(times["start"]) for times in blocks.values()}) > 1
+    ):
+        raise ValueError(
+            f"Mismatched events in {filepath}: "
+            + ", ".join(
+                f"{block} {n_starts} starts / {n_ends} ends "
+                f"({unmatched[block]['start']} starts while open, "
+                f"{unmatched[block]['end']} ends while closed)"
+                for block, (n_starts, n_ends) in counts.items()
+            )
+        )
 
-    return (
-        pd.read_fwf(path, colspecs=[(0, 1), (2, 25), (38, max_msg_col_length)])
-        .set_axis(["msg_type", "time", "msg"], axis=1)
-        .assign(time=lambda df: pd.to_datetime(df["time"]))
-        .set_index("time")
-        .assign(msg=lambda df: df.msg.str.strip())
+    return pd.DataFrame(
+        {
+            (block, edge): pd.to_datetime(times[edge])
+            for block, times in blocks.items()
+            for edge in ("start", "end")
+        }
     )
 
 
-def load_e7_recon_timings(fixed_col_length_file: Path) -> pd.DataFrame:
+def load_e7_recon_timings(logfile: Path) -> pd.DataFrame:
     """Parse e7 tools log file into common dataframe
     with duration information of frames
 
-    :param fixed_col_length_file: Preprocessed file with a constant colum length
-    :return: Dataframe with frame timings
+    :param logfile: e7 tools reconstruction log
+    :return: Dataframe with frame, scatter and recon timings
     """
-    data = load_e7_fixed_col_length_file(fixed_col_length_file)
-    msg = data["msg"]
-
-    cond_start = msg.str.startswith("axis table=4084").fillna(False)
-    cond_end = msg.str.startswith("finished calculation of image").fillna(False)
+    return parse_e7_timings(logfile, E7_RECON_EVENTS)
 
-    frame_starts = data[cond_start].index
-    frame_ends = data[cond_end].index
 
-    cond_start = msg.str.contains("estimate scatter sinogram").fillna(False)
-    cond_end = msg.str.contains("End Scatter Simulation Iteration 2").fillna(False)
-    scatter_starts = data[cond_start].index
-    scatter_ends = data[cond_end].index
-
-    cond_start = msg.str.contains("start calculation of image").fillna(False)
-    cond_end = msg.str.contains("finished calculation of image").fillna(False)
-    recon_starts = data[cond_start].index
-    recon_ends = data[cond_end].index
-
-    return pd.DataFrame(
-        data={
-            ("frame", "start"): frame_starts,
-            ("frame", "end"): frame_ends,
-            ("scatter", "start"): scatter_starts,
-            ("scatter", "end"): scatter_ends,
-            ("recon", "start"): recon_starts,
-            ("recon", "end"): recon_ends,
-        }
-    )
-
-
-def load_e7_histo_timings(fixed_col_length_file: Path) -> pd.DataFrame:
+def load_e7_histo_timings(logfile: Path) -> pd.DataFrame:
     """Load timings for histogramming form log.
     The data is returned in the dataframe as 'frame' as the first
     level of the multiindex to be compatible with 'prepare_for_single_frame_plot'.
 
-    :param fixed_col_length_file: Preprocessed file with a constant colum length
-    """
-    data = load_e7_fixed_col_length_file(fixed_col_length_file)
-    msg = data["msg"]
+    A frame starts with the first of its "Sinogram no =" messages after the setup lines
+    and ends with its frame_write.
 
-    cond_start = msg.str.contains("Sinogram no =")
-    cond_end = msg.str.contains("Frame_write: Just sent Frame")
-
-    histo_starts = data.index[600:][cond_start[600:]][::2]
-    histo_ends = data[cond_end].index[1:]
+    :param logfile: e7 tools HistogramReplay log
+    :raises ValueError: If the number of starts and ends does not match
+    """
+    times = {"start": [], "end": []}
+    for line_idx, time, matched_events in iter_e7_events(logfile, E7_HISTO_EVENTS):
+        edge = matched_events[0].edge
+        if edge == "end" or line_idx >= E7_HISTO_SETUP_LINES:
+            times[edge].append(time)
+    starts = times["start"][::E7_HISTO_STARTS_PER_FRAME]
+    ends = times["end"][E7_HISTO_SETUP_FRAME_WRITES:]
+    if len(starts) != len(ends):
+        raise ValueError(
+            f"Mismatched events in {logfile}: "
+            f"frame {len(starts)} starts / {len(ends)} ends"
+        )
 
     return pd.DataFrame(
-        data={
-            ("frame", "start"): histo_starts,
-            ("frame", "end"): histo_ends,
+        {
+            ("frame", "start"): pd.to_datetime(starts),
+            ("frame", "end"): pd.to_datetime(ends),
         }
     )
 
@@ -269,7 +648,19 @@ def load_e7_resources_and_timings(path: Path, *, gpu: bool) -> Tuple[pd.DataFram
     :param path: Directory with 'No-GPU' and 'GPU' directories
     :param gpu: Inidicator which of the two options should be used
     """
-    base_path = path / "GPU" if gpu else path / "No-GPU"
+    return load_e7_run(path / "GPU" if gpu else path / "No-GPU")
+
+
+def is_e7_run(path: Path) -> bool:
+    """Whether a directory holds e7 tools logs instead of generic toolbox output."""
+    return any(file.startswith("log_e7_recon") for file in os.listdir(path))
+
+
+def load_e7_run(base_path: Path) -> Tuple[pd.DataFrame, ...]:
+    """Load logs and resources of a single e7 tools run, e.g. 'JSRecon/GPU'.
+
+    :return: histogramming resources and timings, reconstruction resources and timings
+    """
     recon_logfiles = [
         file
         for file in os.listdir(base_path)
@@ -290,14 +681,8 @@ def load_e7_resources_and_timings(path: Path, *, gpu: bool) -> Tuple[pd.DataFram
     histo_logpath = base_path / histo_logfiles.pop()
     recon_logpath = base_path / recon_logfiles.pop()
 
-    transf_histo_logpath = Path(f"{str(histo_logpath)[:-4]}_transformed.txt")
-    transf_recon_logpath = Path(f"{str(recon_logpath)[:-4]}_transformed.txt")
-
-    fix_e7_log_column_lengths(recon_logpath, transf_recon_logpath)
-    fix_e7_log_column_lengths(histo_logpath, transf_histo_logpath)
-
-    histo_timings = load_e7_histo_timings(transf_histo_logpath)
-    recon_timings = load_e7_recon_timings(transf_recon_logpath)
+    histo_timings = load_e7_histo_timings(histo_logpath)
+    recon_timings = load_e7_recon_timings(recon_logpath)
 
     histo_resource_data = parse_e7_resource_file(histo_resources_path)
     recon_resource_data = parse_e7_resource_file(recon_resources_path)
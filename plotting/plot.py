@@ -1,10 +1,14 @@
+import os
+import json
+import hashlib
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mplpatch
+from matplotlib.figure import Figure
 
 from plotting.utils import add_blocks_to_ax, MyFormatter
 from plotting.loading import prepare_for_single_frame_plot
@@ -16,134 +20,288 @@ def plot_frame(
     frame_nr: int,
     target_dir: Path,
     gpu: bool,
+    manifest: Optional["PlotManifest"] = None,
 ):
     """Plot disk, cpu&ram and, if gpu==True, gpu."""
-    plot_disk(resources, timings, target_dir / f"disk_frame{frame_nr}.png")
-    plot_cpu_ram(resources, timings, target_dir / f"cpu&ram_frame{frame_nr}.png")
+    plot_disk(
+        resources, timings, target_dir / f"disk_frame{frame_nr}.png", None, manifest
+    )
+    plot_cpu_ram(
+        resources, timings, target_dir / f"cpu&ram_frame{frame_nr}.png", None, manifest
+    )
     if gpu:
-        plot_gpu(resources, timings, target_dir / f"gpu_frame{frame_nr}.png")
+        plot_gpu(
+            resources, timings, target_dir / f"gpu_frame{frame_nr}.png", None, manifest
+        )
 
 
-def plot_cpu_ram(
-    resource_data: pd.DataFrame,
-    frame_timings: pd.Series,
-    target_file: Optional[Path] = None,
-    vertical_line_pos: Optional[int] = None,
-) -> None:
-    fig: plt.Figure
-    cpu_ax: plt.Axes
-    mem_ax: plt.Axes
-
-    fig, (cpu_ax, mem_ax) = plt.subplots(2, 1, figsize=(7, 5), dpi=300, sharex=True)
+class Panel(NamedTuple):
+    """One of the two stacked axes of a frame plot."""
+
+    column: str
+    ylabel: str
+    title: Optional[str] = None
+    min_ymax: Optional[float] = None  # Upper y limit if all values are below
+
+
+FRAME_PLOT_PANELS = {
+    "cpu&ram": (
+        Panel("n_cpus", "CPU utilization [$n_{cores}$]", min_ymax=1.05),
+        Panel("memory", "Memory usage [GB]"),
+    ),
+    "gpu": (
+        Panel("gpu_util", "GPU utilization [%]"),
+        Panel("gpu_memory", "GPU memory usage [GB]"),
+    ),
+    "disk": (
+        Panel("disk_read", "MB/s", title="Data read from disk"),
+        Panel("disk_written", "MB/s", title="Data written to disk"),
+    ),
+}
+
+
+class FramePlot:
+    """Figure with two resource columns of a frame over time and its blocks.
+
+    Figure, axes, labels and lines are built once, `draw` only replaces
+    the line data, block spans, limits and the legend. One instance can
+    therefore render any number of frames without rebuilding the figure.
+
+    :param panels: Columns and labels of the upper and lower axes
+    :param fig: Figure to draw on, by default a figure which is not managed
+        by pyplot so it stays alive between frames without being shown
+    """
+
+    def __init__(
+        self, panels: Tuple[Panel, Panel], fig: Optional[plt.Figure] = None
+    ) -> None:
+        self.panels = panels
+        self.fig = Figure(figsize=(7, 5), dpi=300) if fig is None else fig
+        self.axes = self.fig.subplots(2, 1, sharex=True)
+        self.lines = []
+        for ax, panel in zip(self.axes, panels):
+            if panel.title is not None:
+                ax.set_title(panel.title)
+            ax.set_ylabel(panel.ylabel)
+            (line,) = ax.plot([], [])
+            self.lines.append(line)
+        self.axes[-1].set_xlabel("Time [min]")
+        self.axes[0].xaxis.set_major_formatter(MyFormatter())
+        self._legend = None
+
+    def draw(
+        self,
+        resource_data: pd.DataFrame,
+        frame_timings: pd.Series,
+        vertical_line_pos: Optional[int] = None,
+    ) -> None:
+        x_max = resource_data.index.max()
+        for ax, line, panel in zip(self.axes, self.lines, self.panels):
+            for artist in [*ax.patches, *ax.lines]:
+                if artist is not line:
+                    artist.remove()
+
+            values = resource_data[panel.column]
+            line.set_data(resource_data.index, values)
+            ax.relim()
+            ax.set_autoscaley_on(True)
+            ax.autoscale_view(scalex=False)
+            ax.set_ylim(bottom=0)
+            if panel.min_ymax is not None and values.max() < panel.min_ymax:
+                ax.set_ylim(0, panel.min_ymax)
+            ax.set_xlim(0, x_max)
+            ax.set_xticks(np.arange(0, x_max, 60))
+
+            if vertical_line_pos is not None:
+                ax.axvline(
+                    vertical_line_pos, linestyle="--", color="black", linewidth=1
+                )
+            add_blocks_to_ax(ax, frame_timings)
+
+        handles, labels = self.axes[0].get_legend_handles_labels()
+        if len(handles) >= 2:
+            handles[-2], handles[-1] = handles[-1], handles[-2]
+            labels[-2], labels[-1] = labels[-1], labels[-2]
+
+        patch = mplpatch.Patch(
+            facecolor="white", edgecolor="darkgray", label="unassigned"
+        )
+        handles.append(patch)
+        labels.append("unassigned")
 
-    cpu_ax.set_ylabel("CPU utilization [$n_{cores}$]")
-    mem_ax.set_ylabel("Memory usage [GB]")
-    mem_ax.set_xlabel("Time [min]")
-    cpu_ax.set_xlim(0, resource_data.index.max())
-    mem_ax.set_xlim(0, resource_data.index.max())
+        if self._legend is not None:
+            self._legend.remove()
+        self._legend = self.fig.legend(
+            handles, labels, ncols=5, loc="lower center", frameon=False
+        )
 
-    if resource_data["n_cpus"].max() < 1.05:
-        cpu_ax.set_ylim(0, 1.05)
+        self.fig.tight_layout(rect=[0, 0.05, 1, 1])
 
-    cpu_ax.plot(resource_data.index, resource_data["n_cpus"])
-    mem_ax.plot(resource_data.index, resource_data["memory"])
 
-    if vertical_line_pos is not None:
-        cpu_ax.axvline(vertical_line_pos, linestyle="--", color="black", linewidth=1)
-        mem_ax.axvline(vertical_line_pos, linestyle="--", color="black", linewidth=1)
+def _hash_source_files(*filepaths: Path) -> str:
+    source_hash = hashlib.sha256()
+    for filepath in filepaths:
+        source_hash.update(filepath.read_bytes())
+    return source_hash.hexdigest()
 
-    cpu_ax.xaxis.set_major_formatter(MyFormatter())
 
-    cpu_ax.set_ylim(bottom=0)
-    mem_ax.set_ylim(bottom=0)
+# Changes to the rendering code invalidate all plots
+RENDER_CODE_HASH = _hash_source_files(
+    Path(__file__), Path(__file__).with_name("utils.py")
+)
 
-    cpu_ax.set_xticks(np.arange(0, resource_data.index.max(), 60))
-    mem_ax.set_xticks(np.arange(0, resource_data.index.max(), 60))
 
-    add_blocks_to_ax(cpu_ax, frame_timings)
-    add_blocks_to_ax(mem_ax, frame_timings)
+def frame_plot_hash(
+    kind: str,
+    resource_data: pd.DataFrame,
+    frame_timings: pd.Series,
+    vertical_line_pos: Optional[int] = None,
+) -> str:
+    """Content hash of everything a frame plot is drawn from.
+
+    Covers the plotted columns of the resource slice with their index,
+    the block timings, the plot kind with its panels and the rendering code.
+    """
+    panels = FRAME_PLOT_PANELS[kind]
+    content_hash = hashlib.sha256(
+        repr((RENDER_CODE_HASH, kind, panels, vertical_line_pos)).encode()
+    )
+    columns = [panel.column for panel in panels]
+    content_hash.update(pd.util.hash_pandas_object(resource_data[columns]).values)
+    content_hash.update(pd.util.hash_pandas_object(frame_timings).values)
+    return content_hash.hexdigest()
+
+
+class PlotManifest:
+    """Content hashes of rendered plots to skip plots whose inputs did not change.
+
+    The manifest is a json file with the hash of every plot file and the
+    files rendered and skipped by the last run. Plots are recorded in the
+    process rendering them, worker processes hand their records to the
+    parent with `pop_records` and `add_records`.
+
+    :param path: Manifest file, read if it exists
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.hashes = dict()
+        if self.path.exists():
+            with open(self.path) as f:
+                self.hashes = json.load(f)["hashes"]
+        self._records = []
+        self.rendered = []
+        self.skipped = []
+
+    def is_current(self, target_file: Path, content_hash: str) -> bool:
+        return (
+            self.hashes.get(str(target_file)) == content_hash
+            and Path(target_file).exists()
+        )
 
-    handles, labels = cpu_ax.get_legend_handles_labels()
+    def record(self, target_file: Path, content_hash: str, skipped: bool) -> None:
+        self._records.append((str(target_file), content_hash, skipped))
 
-    if len(handles) >= 2:
-        handles[-2], handles[-1] = handles[-1], handles[-2]
-        labels[-2], labels[-1] = labels[-1], labels[-2]
+    def pop_records(self) -> List[Tuple[str, str, bool]]:
+        records, self._records = self._records, []
+        return records
 
-    patch = mplpatch.Patch(facecolor="white", edgecolor="darkgray", label="unassigned")
-    handles.append(patch)
-    labels.append("unassigned")
+    def add_records(self, records: List[Tuple[str, str, bool]]) -> None:
+        for target_file, content_hash, skipped in records:
+            self.hashes[target_file] = content_hash
+            (self.skipped if skipped else self.rendered).append(target_file)
 
-    fig.legend(handles, labels, ncols=5, loc="lower center", frameon=False)
+    def save(self) -> None:
+        self.add_records(self.pop_records())
+        tmp_file = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(
+                {
+                    "hashes": self.hashes,
+                    "rendered": sorted(self.rendered),
+                    "skipped": sorted(self.skipped),
+                },
+                f,
+                indent=2,
+            )
+        os.replace(tmp_file, self.path)
 
-    plt.tight_layout(rect=[0, 0.05, 1, 1])
 
-    if target_file is None:
-        plt.show()
-    else:
-        plt.savefig(target_file)
-    plt.close()
+# Frame plots of this process, reused for every frame saved to a file
+_frame_plots: Dict[str, FramePlot] = dict()
 
 
-def plot_gpu(
+def render_frame_plot(
+    kind: str,
     resource_data: pd.DataFrame,
     frame_timings: pd.Series,
     target_file: Optional[Path] = None,
     vertical_line_pos: Optional[int] = None,
+    manifest: Optional[PlotManifest] = None,
 ) -> None:
-    fig: plt.Figure
-    gpu_util_ax: plt.Axes
-    gpu_mem_ax: plt.Axes
-
-    fig, (gpu_util_ax, gpu_mem_ax) = plt.subplots(
-        2, 1, figsize=(7, 5), dpi=300, sharex=True
-    )
-
-    gpu_util_ax.set_ylabel("GPU utilization [%]")
-    gpu_mem_ax.set_ylabel("GPU memory usage [GB]")
-    gpu_mem_ax.set_xlabel("Time [min]")
-    gpu_util_ax.set_xlim(0, resource_data.index.max())
-    gpu_mem_ax.set_xlim(0, resource_data.index.max())
+    """Draw one of `FRAME_PLOT_PANELS` and save it or show it if `target_file` is None.
 
-    gpu_util_ax.plot(resource_data.index, resource_data["gpu_util"])
-    gpu_mem_ax.plot(resource_data.index, resource_data["gpu_memory"])
-
-    if vertical_line_pos is not None:
-        gpu_util_ax.axvline(
-            vertical_line_pos, linestyle="--", color="black", linewidth=1
-        )
-        gpu_mem_ax.axvline(
-            vertical_line_pos, linestyle="--", color="black", linewidth=1
+    With a `manifest`, saving is skipped if the file was rendered from the same
+    content before and the plot is recorded in the manifest.
+    """
+    if target_file is None:
+        frame_plot = FramePlot(
+            FRAME_PLOT_PANELS[kind], plt.figure(figsize=(7, 5), dpi=300)
         )
+        frame_plot.draw(resource_data, frame_timings, vertical_line_pos)
+        plt.show()
+        plt.close(frame_plot.fig)
+        return
 
-    gpu_mem_ax.xaxis.set_major_formatter(MyFormatter())
-
-    gpu_util_ax.set_ylim(bottom=0)
-    gpu_mem_ax.set_ylim(bottom=0)
-
-    gpu_util_ax.set_xticks(np.arange(0, resource_data.index.max(), 60))
-    gpu_mem_ax.set_xticks(np.arange(0, resource_data.index.max(), 60))
+    if manifest is not None:
+        content_hash = frame_plot_hash(
+            kind, resource_data, frame_timings, vertical_line_pos
+        )
+        if manifest.is_current(target_file, content_hash):
+            manifest.record(target_file, content_hash, skipped=True)
+            return
 
-    add_blocks_to_ax(gpu_util_ax, frame_timings)
-    add_blocks_to_ax(gpu_mem_ax, frame_timings)
+    if kind not in _frame_plots:
+        _frame_plots[kind] = FramePlot(FRAME_PLOT_PANELS[kind])
+    _frame_plots[kind].draw(resource_data, frame_timings, vertical_line_pos)
+    _frame_plots[kind].fig.savefig(target_file)
 
-    handles, labels = gpu_util_ax.get_legend_handles_labels()
-    if len(handles) >= 2:
-        handles[-2], handles[-1] = handles[-1], handles[-2]
-        labels[-2], labels[-1] = labels[-1], labels[-2]
+    if manifest is not None:
+        manifest.record(target_file, content_hash, skipped=False)
 
-    patch = mplpatch.Patch(facecolor="white", edgecolor="darkgray", label="unassigned")
-    handles.append(patch)
-    labels.append("unassigned")
 
-    fig.legend(handles, labels, ncols=5, loc="lower center", frameon=False)
+def plot_cpu_ram(
+    resource_data: pd.DataFrame,
+    frame_timings: pd.Series,
+    target_file: Optional[Path] = None,
+    vertical_line_pos: Optional[int] = None,
+    manifest: Optional[PlotManifest] = None,
+) -> None:
+    render_frame_plot(
+        "cpu&ram",
+        resource_data,
+        frame_timings,
+        target_file,
+        vertical_line_pos,
+        manifest,
+    )
 
-    plt.tight_layout(rect=[0, 0.05, 1, 1])
 
-    if target_file is None:
-        plt.show()
-    else:
-        plt.savefig(target_file)
-    plt.close()
+def plot_gpu(
+    resource_data: pd.DataFrame,
+    frame_timings: pd.Series,
+    target_file: Optional[Path] = None,
+    vertical_line_pos: Optional[int] = None,
+    manifest: Optional[PlotManifest] = None,
+) -> None:
+    render_frame_plot(
+        "gpu",
+        resource_data,
+        frame_timings,
+        target_file,
+        vertical_line_pos,
+        manifest,
+    )
 
 
 def plot_disk(
@@ -151,57 +309,16 @@ def plot_disk(
     frame_timings: pd.Series,
     target_file: Optional[Path] = None,
     vertical_line_pos: Optional[int] = None,
+    manifest: Optional[PlotManifest] = None,
 ) -> None:
-    fig: plt.Figure
-    read_ax: plt.Axes
-    write_ax: plt.Axes
-
-    fig, (read_ax, write_ax) = plt.subplots(2, 1, figsize=(7, 5), dpi=300, sharex=True)
-
-    read_ax.set_title("Data read from disk")
-    write_ax.set_title("Data written to disk")
-    read_ax.set_ylabel("MB/s")
-    write_ax.set_ylabel("MB/s")
-    write_ax.set_xlabel("Time [min]")
-    read_ax.set_xlim(0, resource_data.index.max())
-    write_ax.set_xlim(0, resource_data.index.max())
-
-    read_ax.plot(resource_data.index, resource_data["disk_read"])
-    write_ax.plot(resource_data.index, resource_data["disk_written"])
-
-    if vertical_line_pos is not None:
-        read_ax.axvline(vertical_line_pos, linestyle="--", color="black", linewidth=1)
-        write_ax.axvline(vertical_line_pos, linestyle="--", color="black", linewidth=1)
-
-    read_ax.xaxis.set_major_formatter(MyFormatter())
-
-    read_ax.set_ylim(bottom=0)
-    write_ax.set_ylim(bottom=0)
-
-    read_ax.set_xticks(np.arange(0, resource_data.index.max(), 60))
-    write_ax.set_xticks(np.arange(0, resource_data.index.max(), 60))
-
-    add_blocks_to_ax(read_ax, frame_timings)
-    add_blocks_to_ax(write_ax, frame_timings)
-
-    handles, labels = read_ax.get_legend_handles_labels()
-    if len(handles) >= 2:
-        handles[-2], handles[-1] = handles[-1], handles[-2]
-        labels[-2], labels[-1] = labels[-1], labels[-2]
-
-    patch = mplpatch.Patch(facecolor="white", edgecolor="darkgray", label="unassigned")
-    handles.append(patch)
-    labels.append("unassigned")
-
-    fig.legend(handles, labels, ncols=5, loc="lower center", frameon=False)
-
-    plt.tight_layout(rect=[0, 0.05, 1, 1])
-
-    if target_file is None:
-        plt.show()
-    else:
-        plt.savefig(target_file)
-    plt.close()
+    render_frame_plot(
+        "disk",
+        resource_data,
+        frame_timings,
+        target_file,
+        vertical_line_pos,
+        manifest,
+    )
 
 
 def plot_e7_frame(
@@ -212,6 +329,7 @@ def plot_e7_frame(
     frame_nr: int,
     target_dir: Path,
     gpu: bool,
+    manifest: Optional[PlotManifest] = None,
 ):
     """Plot all plots for the single frame and save them to target dir."""
     recon_frame_data, recon_frame_timings = prepare_for_single_frame_plot(
@@ -239,12 +357,14 @@ def plot_e7_frame(
         frame_timings,
         target_dir / f"e7-tools{'-gpu' if gpu else ''}_disk_frame{frame_nr}.png",
         vert_line_pos,
+        manifest,
     )
     plot_cpu_ram(
         frame_data,
         frame_timings,
         target_dir / f"e7-tools{'-gpu' if gpu else ''}_cpu&ram_frame{frame_nr}.png",
         vert_line_pos,
+        manifest,
     )
     if gpu:
         plot_gpu(
@@ -252,4 +372,5 @@ def plot_e7_frame(
             frame_timings,
             target_dir / f"e7-tools{'-gpu' if gpu else ''}_gpu_frame{frame_nr}.png",
             vert_line_pos,
+            manifest,
         )
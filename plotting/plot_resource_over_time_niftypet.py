@@ -3,17 +3,15 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 import numpy as np
 
-from .loading import load_resources_and_timings
+from .loading import assign_to_intervals, load_resources_and_timings
 
 resources, timings = load_resources_and_timings(Path("results/SIRF-STIR"))
 
-mask = (resources.index.values[:, None] >= timings[("frame", "start")].values) & (
-    resources.index.values[:, None] <= timings[("frame", "end")].values
+frame_nr = assign_to_intervals(
+    resources.index, timings[("frame", "start")], timings[("frame", "end")]
 )
-
-ram = resources.loc[mask.any(axis=1), ["memory"]]
-mask = mask[mask.any(axis=1)]
-ram["frame_nr"] = mask.argmax(axis=1)
+ram = resources.loc[frame_nr != -1, ["memory"]]
+ram["frame_nr"] = frame_nr[frame_nr != -1]
 
 mean_ram = ram.groupby("frame_nr").mean()
 mean_ram = mean_ram.loc[1:, :]
@@ -1,4 +1,23 @@
+"""Render the per-frame resource plots of all toolboxes.
+
+Frames are spread over a pool of worker processes. The data is loaded once
+before the pool is forked, and every worker reuses one figure per plot kind
+for all its frames (see `plotting.plot.FramePlot`).
+
+Plots are only rendered if their content hash differs from the one in
+`results/plots/manifest.json`, which also lists the rendered and skipped plots.
+
+Usage: python -m plotting.plot_resources [--workers N] [--force]
+"""
+
+import os
+import argparse
 from pathlib import Path
+from multiprocessing import get_context
+
+import matplotlib
+
+matplotlib.use("Agg")
 
 from tqdm import tqdm
 
@@ -7,17 +26,34 @@ from plotting.loading import (
     prepare_for_single_frame_plot,
     load_e7_resources_and_timings,
 )
-from plotting.plot import plot_frame, plot_e7_frame
+from plotting.plot import PlotManifest, plot_frame, plot_e7_frame
+from plotting.utils import positive_int
 
 RUNDIR = Path("results")
 TOOLBOXES = {"SIRF-STIR", "NiftyPET"}
 TOOLBOX_SUPPORTS_GPU = {"SIRF-STIR": False, "NiftyPET": True}
+N_FRAMES = 106
+MANIFEST_FILE = RUNDIR / "plots" / "manifest.json"
 
 timing_and_resources = {
     toolbox: load_resources_and_timings(RUNDIR / toolbox) for toolbox in TOOLBOXES
 }
+timing_and_resources_gpu = load_e7_resources_and_timings(
+    Path("results/JSRecon"), gpu=True
+)
+timing_and_resources_nogpu = load_e7_resources_and_timings(
+    Path("results/JSRecon"), gpu=False
+)
+
 
-for frame_idx in tqdm(range(106), "Processing generic toolbox frames"):
+manifest = PlotManifest(MANIFEST_FILE)
+
+
+def render_frame(frame_idx: int) -> list:
+    """Render all plots of a frame for every toolbox.
+
+    :return: Manifest records of the plots
+    """
     for toolbox in TOOLBOXES:
         # NiftyPET only starts at frame 10 because it fails on lack of events before
         if toolbox == "NiftyPET" and frame_idx < 10:
@@ -32,22 +68,60 @@ for frame_idx in tqdm(range(106), "Processing generic toolbox frames"):
             frame_nr=frame_idx,
             target_dir=Path(f"./results/plots/{toolbox}"),
             gpu=TOOLBOX_SUPPORTS_GPU[toolbox],
+            manifest=manifest,
         )
 
-timing_and_resources_gpu = load_e7_resources_and_timings(
-    Path("results/JSRecon"), gpu=True
-)
-timing_and_resources_nogpu = load_e7_resources_and_timings(
-    Path("results/JSRecon"), gpu=False
-)
-
-for frame_idx in tqdm(range(106), "Processing e7 frames"):
     plot_e7_frame(
-        *timing_and_resources_gpu, frame_idx, Path("./results/plots/e7-tools"), gpu=True
+        *timing_and_resources_gpu,
+        frame_idx,
+        Path("./results/plots/e7-tools"),
+        gpu=True,
+        manifest=manifest,
     )
     plot_e7_frame(
         *timing_and_resources_nogpu,
         frame_idx,
         Path("./results/plots/e7-tools"),
         gpu=False,
+        manifest=manifest,
+    )
+    return manifest.pop_records()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=os.cpu_count(),
+        help="Number of processes rendering frames in parallel",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Render all plots even if their inputs did not change",
+    )
+    args = parser.parse_args()
+
+    if args.force:
+        manifest.hashes = dict()
+
+    frames = range(N_FRAMES)
+    if args.workers == 1:
+        for frame_idx in tqdm(frames, "Rendering frames"):
+            manifest.add_records(render_frame(frame_idx))
+    else:
+        # Fork so the workers inherit the loaded data instead of loading it again
+        with get_context("fork").Pool(args.workers) as pool:
+            for records in tqdm(
+                pool.imap_unordered(render_frame, frames),
+                "Rendering frames",
+                total=N_FRAMES,
+            ):
+                manifest.add_records(records)
+
+    manifest.save()
+    print(
+        f"Rendered {len(manifest.rendered)} plots, "
+        f"skipped {len(manifest.skipped)} unchanged plots (see {MANIFEST_FILE})"
     )
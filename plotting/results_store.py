@@ -0,0 +1,330 @@
+"""Index all comparison runs in `results/` into one SQLite store.
+
+`run_comparison.sh` writes every run to `results/<date>-<sha>/<toolbox>/`.
+`ingest` parses the metadata, resources.csv and evaluation.json of every
+toolbox of every run once and stores block timings, resource samples
+(joined to their frame and block) and image quality per region in tables
+indexed by toolbox, commit, run date, frame and block. Toolbox directories
+whose files did not change since the last ingest are skipped, rows of
+toolbox directories which no longer exist are removed.
+Cross-run questions are then answered from the store without reparsing.
+
+Usage:
+    python -m plotting.results_store ingest [--results results] [--store FILE]
+    python -m plotting.results_store durations --block recon [--quantile 0.95]
+"""
+
+import re
+import json
+import sqlite3
+import argparse
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import pandas as pd
+
+from plotting.loading import (
+    assign_frames_and_blocks,
+    load_metadata,
+    parse_resources_file,
+    parse_timings,
+)
+from plotting.utils import get_blocklable
+
+RESULTS_DIR = Path("results")
+STORE_FILE = RESULTS_DIR / "results.sqlite"
+RUN_DIR_PATTERN = re.compile(
+    r"^(?P<date>\d{4}-\d{2}-\d{2})-(?P<hour>\d{2})-(?P<minute>\d{2})-(?P<sha>[0-9a-f]+)$"
+)
+TOOLBOX_FILES = ("metadata.json", "metadata.jsonl", "resources.csv", "evaluation.json")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS toolbox_runs (
+    run_id TEXT, toolbox TEXT, commit_sha TEXT, run_date TEXT,
+    metadata TEXT, total_seconds REAL, signature TEXT,
+    PRIMARY KEY (run_id, toolbox)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    run_id TEXT, toolbox TEXT, commit_sha TEXT, run_date TEXT,
+    frame INTEGER, block TEXT, block_label TEXT,
+    start TEXT, "end" TEXT, duration_s REAL
+);
+CREATE INDEX IF NOT EXISTS blocks_by_label
+    ON blocks (block_label, toolbox, commit_sha, run_date, frame);
+CREATE INDEX IF NOT EXISTS blocks_by_run ON blocks (run_id, toolbox, frame, block);
+CREATE TABLE IF NOT EXISTS resources (
+    run_id TEXT, toolbox TEXT, commit_sha TEXT, run_date TEXT,
+    time TEXT, frame INTEGER, block TEXT,
+    memory REAL, gpu_memory REAL, gpu_util REAL,
+    disk_read REAL, disk_written REAL, n_cpus REAL
+);
+CREATE INDEX IF NOT EXISTS resources_by_run
+    ON resources (toolbox, commit_sha, run_date, frame, block);
+CREATE INDEX IF NOT EXISTS resources_by_run_id ON resources (run_id, toolbox);
+CREATE TABLE IF NOT EXISTS evaluation (
+    run_id TEXT, toolbox TEXT, commit_sha TEXT, run_date TEXT,
+    frame INTEGER, region INTEGER, snr REAL, cnr REAL, total_snr REAL
+);
+CREATE INDEX IF NOT EXISTS evaluation_by_run
+    ON evaluation (toolbox, commit_sha, run_date, frame, region);
+CREATE INDEX IF NOT EXISTS evaluation_by_run_id ON evaluation (run_id, toolbox);
+"""
+DATA_TABLES = ("blocks", "resources", "evaluation")
+
+
+def connect(store_file: Path = STORE_FILE, create: bool = False) -> sqlite3.Connection:
+    """Open the store and create missing tables and indices.
+
+    :param store_file: Path of the SQLite file
+    :param create: Create the store if it does not exist yet instead of raising
+    :return: Open connection
+    """
+    if not create and not Path(store_file).exists():
+        raise FileNotFoundError(
+            f"No results store at {store_file}, create it with the ingest command"
+        )
+    connection = sqlite3.connect(store_file)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def iter_toolbox_dirs(results_dir: Path) -> Iterator[Tuple[str, str, str, Path]]:
+    """Toolbox directories of all runs named `<date>-<sha>` by `run_comparison.sh`.
+
+    :return: Iterator over run id, commit sha, run date (ISO format), toolbox directory
+    """
+    for run_dir in sorted(results_dir.iterdir()):
+        match = RUN_DIR_PATTERN.match(run_dir.name)
+        if match is None or not run_dir.is_dir():
+            continue
+        run_date = f"{match['date']} {match['hour']}:{match['minute']}"
+        for toolbox_dir in sorted(run_dir.iterdir()):
+            if toolbox_dir.is_dir():
+                yield run_dir.name, match["sha"], run_date, toolbox_dir
+
+
+def files_signature(toolbox_dir: Path) -> str:
+    """Modification time and size of all files the store is built from."""
+    return ";".join(
+        f"{name}:{stat.st_mtime_ns}-{stat.st_size}"
+        for name in TOOLBOX_FILES
+        if (toolbox_dir / name).exists()
+        for stat in [(toolbox_dir / name).stat()]
+    )
+
+
+def block_rows(timings: pd.DataFrame) -> pd.DataFrame:
+    """One row per frame and block with start, end and duration in seconds."""
+    blocks = (
+        timings.stack(level=0, future_stack=True)
+        .dropna(subset=["start", "end"])
+        .rename_axis(["frame", "block"])
+        .reset_index()
+    )
+    return blocks.assign(
+        block_label=blocks["block"].map(get_blocklable),
+        duration_s=(blocks["end"] - blocks["start"]).dt.total_seconds(),
+        start=blocks["start"].astype(str),
+        end=blocks["end"].astype(str),
+    )
+
+
+def resource_rows(resources: pd.DataFrame, timings: pd.DataFrame) -> pd.DataFrame:
+    """Resource samples with the frame and block they were taken in."""
+    joined = assign_frames_and_blocks(resources.index, timings)
+    return (
+        resources.assign(frame=joined["frame"], block=joined["block"].astype(object))
+        .rename_axis("time")
+        .reset_index()
+        .assign(time=lambda df: df["time"].astype(str))
+    )
+
+
+def evaluation_rows(evaluation: list) -> pd.DataFrame:
+    """One row per frame and region with SNR, CNR and the total SNR of the frame."""
+    return pd.DataFrame(
+        [
+            {
+                "frame": frame,
+                "region": int(region),
+                "snr": snr,
+                "cnr": frame_values["cnr_per_region"].get(region),
+                "total_snr": frame_values["total_snr"],
+            }
+            for frame, frame_values in enumerate(evaluation)
+            for region, snr in frame_values["snr_per_region"].items()
+        ],
+        columns=["frame", "region", "snr", "cnr", "total_snr"],
+    )
+
+
+def remove_toolbox_run(
+    connection: sqlite3.Connection, run_id: str, toolbox: str
+) -> None:
+    """Delete all rows of a toolbox run, within the transaction of the caller."""
+    for table in (*DATA_TABLES, "toolbox_runs"):
+        connection.execute(
+            f"DELETE FROM {table} WHERE run_id = ? AND toolbox = ?",
+            (run_id, toolbox),
+        )
+
+
+def ingest_toolbox_run(
+    connection: sqlite3.Connection,
+    run_id: str,
+    commit_sha: str,
+    run_date: str,
+    toolbox_dir: Path,
+) -> None:
+    """Replace all rows of a toolbox run with the content of its directory."""
+    toolbox = toolbox_dir.name
+    key = dict(run_id=run_id, toolbox=toolbox, commit_sha=commit_sha, run_date=run_date)
+
+    tables = dict()
+    metadata = dict()
+    if (toolbox_dir / "metadata.json").exists() or (
+        toolbox_dir / "metadata.jsonl"
+    ).exists():
+        metadata = load_metadata(toolbox_dir)
+        timings = parse_timings(metadata)
+        tables["blocks"] = block_rows(timings)
+        if (toolbox_dir / "resources.csv").exists():
+            resources = parse_resources_file(toolbox_dir / "resources.csv")
+            tables["resources"] = resource_rows(resources, timings)
+    if (toolbox_dir / "evaluation.json").exists():
+        with open(toolbox_dir / "evaluation.json") as f:
+            tables["evaluation"] = evaluation_rows(json.load(f))
+
+    with connection:
+        remove_toolbox_run(connection, run_id, toolbox)
+        for table, rows in tables.items():
+            rows.assign(**key).to_sql(
+                table, connection, if_exists="append", index=False
+            )
+        connection.execute(
+            "INSERT INTO toolbox_runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                run_id,
+                toolbox,
+                commit_sha,
+                run_date,
+                json.dumps(metadata.get("metadata", dict())),
+                metadata.get("total_seconds"),
+                files_signature(toolbox_dir),
+            ),
+        )
+
+
+def ingest(
+    results_dir: Path = RESULTS_DIR, store_file: Path = STORE_FILE
+) -> Tuple[int, int, int]:
+    """Add new and changed toolbox runs of all run directories to the store
+    and remove the toolbox runs whose directory was deleted.
+
+    :return: Number of ingested, of unchanged (skipped) and of removed toolbox runs
+    """
+    connection = connect(store_file, create=True)
+    signatures = dict(
+        ((run_id, toolbox), signature)
+        for run_id, toolbox, signature in connection.execute(
+            "SELECT run_id, toolbox, signature FROM toolbox_runs"
+        )
+    )
+    n_ingested = n_skipped = 0
+    for run_id, commit_sha, run_date, toolbox_dir in iter_toolbox_dirs(results_dir):
+        signature = signatures.pop((run_id, toolbox_dir.name), None)
+        if signature == files_signature(toolbox_dir):
+            n_skipped += 1
+            continue
+        ingest_toolbox_run(connection, run_id, commit_sha, run_date, toolbox_dir)
+        n_ingested += 1
+
+    # Toolbox runs left over were not found in results_dir anymore
+    with connection:
+        for run_id, toolbox in signatures:
+            remove_toolbox_run(connection, run_id, toolbox)
+    connection.close()
+    return n_ingested, n_skipped, len(signatures)
+
+
+def query_block_durations(
+    connection: sqlite3.Connection,
+    block_label: str,
+    toolbox: Optional[str] = None,
+) -> pd.DataFrame:
+    """Durations of all blocks with a label (e.g. 'recon' for 'recon_itr<n>') over all runs.
+
+    :return: Dataframe with columns toolbox, commit_sha, run_date, run_id, frame,
+        block and duration_s
+    """
+    query = (
+        "SELECT toolbox, commit_sha, run_date, run_id, frame, block, duration_s "
+        "FROM blocks WHERE block_label = ?"
+    )
+    params = [block_label]
+    if toolbox is not None:
+        query += " AND toolbox = ?"
+        params.append(toolbox)
+    return pd.read_sql_query(query, connection, params=params)
+
+
+def block_duration_quantiles(
+    connection: sqlite3.Connection,
+    block_label: str,
+    quantile: float = 0.95,
+    toolbox: Optional[str] = None,
+) -> pd.DataFrame:
+    """Quantile of the per frame duration of a block for every toolbox and commit.
+
+    Iterations of a block within a frame (e.g. 'recon_itr<n>') are summed first.
+
+    :return: Dataframe indexed by toolbox and commit_sha with the columns
+        runs, frames and duration_s
+    """
+    durations = (
+        query_block_durations(connection, block_label, toolbox)
+        .groupby(["toolbox", "commit_sha", "run_id", "frame"])["duration_s"]
+        .sum()
+        .reset_index()
+    )
+    return durations.groupby(["toolbox", "commit_sha"]).agg(
+        runs=("run_id", "nunique"),
+        frames=("frame", "size"),
+        duration_s=("duration_s", lambda d: d.quantile(quantile)),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--store", type=Path, default=STORE_FILE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = subparsers.add_parser("ingest", help="Add new and changed runs")
+    ingest_parser.add_argument("--results", type=Path, default=RESULTS_DIR)
+    durations_parser = subparsers.add_parser(
+        "durations", help="Quantile of block durations per toolbox and commit"
+    )
+    durations_parser.add_argument("--block", required=True, help="e.g. recon")
+    durations_parser.add_argument("--quantile", type=float, default=0.95)
+    durations_parser.add_argument("--toolbox")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        n_ingested, n_skipped, n_removed = ingest(args.results, args.store)
+        print(
+            f"Ingested {n_ingested} toolbox runs, {n_skipped} unchanged, "
+            f"{n_removed} removed"
+        )
+    else:
+        try:
+            connection = connect(args.store)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+        print(
+            block_duration_quantiles(
+                connection, args.block, args.quantile, args.toolbox
+            ).to_string()
+        )
+        connection.close()
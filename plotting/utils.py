@@ -1,4 +1,5 @@
 import re
+import argparse
 
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -16,6 +17,14 @@ get_blocklable = lambda block_name: re.match(
 ).group(1)
 
 
+def positive_int(value: str) -> int:
+    """Argparse type for counts which must be at least 1."""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+
 class MyFormatter(Formatter):
     def __call__(self, x, pos=0):
         minutes = int(x // 60)
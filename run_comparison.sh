@@ -9,6 +9,7 @@ TARGET_DIRS=(NiftyPET SIRF-STIR)
 GIT_COMMIT_SHORT_SHA=$(git rev-parse --short HEAD)
 GPU_DEVICE_ID=0
 DISK_ID="nvme0n1"
+SAMPLE_INTERVAL=0.1  # Seconds between resource samples
 
 printf -v date '%(%Y-%m-%d-%H-%M)T' -1
 export OUTPUT_VERSION_DIR=${date}-${GIT_COMMIT_SHORT_SHA}
@@ -18,6 +19,7 @@ mkdir "${DESTINATION_PARENT_DIR}"
 # Ensure everything is cleaned up in case the script is
 # terminated before finished.
 cleanup() {
+    kill $sampler_pid 2>/dev/null
     docker stop $CONTAINER_NAME
     docker stop image-normalization 2>/dev/null
     docker stop image-analysis 2>/dev/null
@@ -25,46 +27,50 @@ cleanup() {
 }
 trap cleanup SIGINT
 
-# Function to capture stats and append them to CSV
-capture_stats() {
-    gpu_stats=$(nvidia-smi -i $GPU_DEVICE_ID --query-gpu memory.used,utilization.gpu --format=csv,noheader)
-    disk_read=$(iostat -m 1 2 | tail -20 | grep $DISK_ID | awk '{print $2}')
-    disk_write=$(iostat -m 1 2 | tail -20 | grep $DISK_ID | awk '{print $3}')
-    docker stats --no-stream --format \
-    "{{.CPUPerc}},{{.MemPerc}},{{.MemUsage}}" $CONTAINER_NAME | \
-    while IFS= read -r line; do
-        # Get current timestamp
-        timestamp=$(date --utc '+%Y-%m-%d %H:%M:%S')
-        # Append to CSV with timestamp
-        echo "$timestamp,$line,$gpu_stats,$disk_read,$disk_write" >> $STAT_LOG_PATH
-    done
-}
-
 for target in ${TARGET_DIRS[@]}; do
     DESTINATION_DIR=${DESTINATION_PARENT_DIR}/${target}
     CONTAINER_NAME="$(echo "$target" | tr '[:upper:]' '[:lower:]')-recon"
     STAT_LOG_PATH=${DESTINATION_DIR}/resources.csv
 
     mkdir "${DESTINATION_DIR}"
-    echo "Timestamp,CPU_Usage(%),Memory_Usage(%),Memory_Usage/Limit,GPU_Memory,GPU_Utilization,Disk_Read,Disk_Written" > $STAT_LOG_PATH
 
     cd $target
 
     ./run_recon.sh $1 /dev/null 2>&1 &
     task_pid=$!
     echo "Logging resource information to ${STAT_LOG_PATH}"
-    while kill -0 "$task_pid" 2>/dev/null; do
-        capture_stats
-        sleep 1
-    done
+    python3 ../sample_resources.py \
+        --container $CONTAINER_NAME \
+        --disk $DISK_ID \
+        --gpu-device $GPU_DEVICE_ID \
+        --interval $SAMPLE_INTERVAL \
+        --output $STAT_LOG_PATH \
+        --pid $task_pid &
+    sampler_pid=$!
     wait "$task_pid"
+    wait "$sampler_pid"
 
     echo "Copying reconstruction results to ${DESTINATION_DIR}"
-    cp ./output/result.nii.gz ${DESTINATION_DIR}/result.nii.gz
-    cp ./output/metadata.json ${DESTINATION_DIR}/metadata.json
+    # SIRF-STIR writes an uncompressed result.nii, NiftyPET a result.nii.gz
+    RESULT_NAME=$(basename "$(ls -t ./output/result.nii ./output/result.nii.gz 2>/dev/null | head -n 1)")
+    cp ./output/${RESULT_NAME} ${DESTINATION_DIR}/${RESULT_NAME}
+    # metadata.jsonl is appended after every frame, metadata.json only written at the end
+    # of a complete run, so a crashed run may come with the record stream only
+    for metadata_file in metadata.json metadata.jsonl; do
+        if [ -f ./output/${metadata_file} ]; then
+            cp ./output/${metadata_file} ${DESTINATION_DIR}/${metadata_file}
+        else
+            echo "No ${metadata_file} in ${target}/output"
+        fi
+    done
+    # Record streams of earlier runs, which hold the timings of frames a resumed run took from the cache
+    for rotated_file in ./output/metadata.*.jsonl; do
+        [ -f "${rotated_file}" ] && cp "${rotated_file}" ${DESTINATION_DIR}/
+    done
 
     cd ../image_evaluation
-    cp ${DESTINATION_DIR}/result.nii.gz ./data/sub-00/pet/result.nii.gz
+    rm -f ./data/sub-00/pet/result.nii ./data/sub-00/pet/result.nii.gz
+    cp ${DESTINATION_DIR}/${RESULT_NAME} ./data/sub-00/pet/${RESULT_NAME}
     ./run_eval.sh $1
 
     echo "Copying normalized images and evaluation results to ${DESTINATION_DIR}"
@@ -0,0 +1,265 @@
+"""Low overhead resource sampler for a running reconstruction container.
+
+Reads CPU and memory usage of the container directly from its cgroup v2 files
+and disk throughput from /proc/diskstats instead of calling `docker stats`
+and `iostat` for every sample, so sampling at 10 Hz and more is cheap.
+Rows are written in the format of the `resources.csv` files produced by
+`run_comparison.sh`, which `plotting.loading.parse_resources_file` reads.
+GPU columns are only filled if a GPU device is given and left empty otherwise.
+
+Disk_Read and Disk_Written are the MiB/s read from and written to the whole
+disk (by all processes) averaged over the sample interval. Files recorded by
+the former `iostat -m` sampling have the same headers but other values: its
+columns 2 and 3, which are transfers per second and MB/s read.
+
+Usage:
+    python sample_resources.py --container sirf-stir-recon --disk nvme0n1 \\
+        --output results/<run>/SIRF-STIR/resources.csv [--interval 0.1] \\
+        [--gpu-device 0] [--pid <pid to wait for>]
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# Disk_Read and Disk_Written are in MiB/s
+CSV_HEADER = (
+    "Timestamp,CPU_Usage(%),Memory_Usage(%),Memory_Usage/Limit,"
+    "GPU_Memory,GPU_Utilization,Disk_Read,Disk_Written"
+)
+SECTOR_SIZE = 512  # /proc/diskstats always counts 512 byte sectors
+MiB = 1024**2
+GiB = 1024**3
+
+
+def find_container_cgroup(container: str) -> Optional[str]:
+    """Locate the cgroup v2 directory of a running docker container.
+
+    :param container: Name or id of the container
+    :return: Path to the cgroup directory or None if the container is not running
+    """
+    try:
+        container_id = subprocess.run(
+            ["docker", "inspect", "--format", "{{.Id}}", container],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+    candidates = [
+        # systemd cgroup driver
+        os.path.join(CGROUP_ROOT, "system.slice", f"docker-{container_id}.scope"),
+        # cgroupfs cgroup driver
+        os.path.join(CGROUP_ROOT, "docker", container_id),
+    ]
+    for candidate in candidates:
+        if os.path.exists(os.path.join(candidate, "cpu.stat")):
+            return candidate
+    return None
+
+
+def read_cpu_usec(cgroup: str) -> int:
+    with open(os.path.join(cgroup, "cpu.stat")) as f:
+        for line in f:
+            key, value = line.split()
+            if key == "usage_usec":
+                return int(value)
+    raise RuntimeError(f"No usage_usec in {cgroup}/cpu.stat")
+
+
+def read_memory(cgroup: str, host_memory: int) -> Tuple[int, int]:
+    """Memory usage without inactive page cache and the limit like `docker stats`.
+
+    :return: usage in bytes, limit in bytes
+    """
+    with open(os.path.join(cgroup, "memory.current")) as f:
+        usage = int(f.read())
+    with open(os.path.join(cgroup, "memory.stat")) as f:
+        for line in f:
+            key, value = line.split()
+            if key == "inactive_file":
+                usage -= min(int(value), usage)
+                break
+    with open(os.path.join(cgroup, "memory.max")) as f:
+        limit = f.read().strip()
+    return usage, host_memory if limit == "max" else int(limit)
+
+
+def read_host_memory() -> int:
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("No MemTotal in /proc/meminfo")
+
+
+def read_disk_bytes(disk: str) -> Tuple[int, int]:
+    """Total bytes read and written by the block device since boot."""
+    with open("/proc/diskstats") as f:
+        for line in f:
+            fields = line.split()
+            if fields[2] == disk:
+                return int(fields[5]) * SECTOR_SIZE, int(fields[9]) * SECTOR_SIZE
+    raise RuntimeError(f"Disk '{disk}' not found in /proc/diskstats")
+
+
+def format_bytes(n_bytes: float) -> str:
+    """Format in the units `parse_resources_file` accepts (MiB or GiB)."""
+    if n_bytes >= GiB:
+        return f"{n_bytes / GiB:.3f}GiB"
+    return f"{n_bytes / MiB:.2f}MiB"
+
+
+class GpuPoller:
+    """Keep one `nvidia-smi` process running in loop mode and remember
+    its latest output instead of starting it once per sample.
+
+    :param device_id: Index of the GPU to query
+    :param interval: Query interval in seconds
+    """
+
+    def __init__(self, device_id: int, interval: float) -> None:
+        self.latest = ","
+        self._process = subprocess.Popen(
+            [
+                "nvidia-smi",
+                "-i",
+                str(device_id),
+                "--query-gpu=memory.used,utilization.gpu",
+                "--format=csv,noheader",
+                f"-lms={max(int(interval * 1000), 1)}",
+            ],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self) -> None:
+        for line in self._process.stdout:
+            self.latest = line.strip()
+
+    def stop(self) -> None:
+        self._process.terminate()
+
+
+def is_running(pid: Optional[int]) -> bool:
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def sample(
+    output: str,
+    disk: str,
+    interval: float,
+    container: Optional[str] = None,
+    cgroup: Optional[str] = None,
+    gpu_device: Optional[int] = None,
+    pid: Optional[int] = None,
+) -> None:
+    """Append one row per interval to `output` until `pid` exits.
+
+    Samples are only written while the cgroup exists, which matches
+    `docker stats` printing nothing for a container that is not running.
+
+    :param output: resources.csv to append to, the header is written if it is empty
+    :param disk: Block device name as in /proc/diskstats, e.g. nvme0n1
+    :param interval: Seconds between samples
+    :param container: Docker container to sample, looked up until it is running
+    :param cgroup: cgroup v2 directory to sample instead of a container
+    :param gpu_device: Index of the GPU to sample, GPU columns stay empty if None
+    :param pid: Stop once this process has exited, run forever if None
+    """
+    host_memory = read_host_memory()
+    gpu = GpuPoller(gpu_device, interval) if gpu_device is not None else None
+    next_lookup = 0.0
+    previous = None
+
+    with open(output, "a", buffering=1) as f:
+        if f.tell() == 0:
+            f.write(CSV_HEADER + "\n")
+
+        next_tick = time.monotonic()
+        while is_running(pid):
+            now = time.monotonic()
+            if cgroup is None and container is not None and now >= next_lookup:
+                cgroup = find_container_cgroup(container)
+                next_lookup = now + 1
+
+            cpu_usec = None
+            if cgroup is not None:
+                try:
+                    cpu_usec = read_cpu_usec(cgroup)
+                    memory, limit = read_memory(cgroup, host_memory)
+                except FileNotFoundError:  # Container has stopped
+                    cpu_usec = None
+                    if container is not None:
+                        cgroup = None
+            disk_read, disk_written = read_disk_bytes(disk)
+
+            if cpu_usec is None:
+                previous = None
+            elif previous is not None:
+                prev_time, prev_cpu, prev_read, prev_written = previous
+                elapsed = now - prev_time
+                cpu_perc = (cpu_usec - prev_cpu) / (elapsed * 1e6) * 100
+                read_mb = (disk_read - prev_read) / MiB / elapsed
+                written_mb = (disk_written - prev_written) / MiB / elapsed
+                timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+                f.write(
+                    f"{timestamp},{cpu_perc:.2f}%,{memory / limit * 100:.2f}%,"
+                    f"{format_bytes(memory)} / {format_bytes(limit)},"
+                    f"{gpu.latest if gpu else ','},{read_mb:.2f},{written_mb:.2f}\n"
+                )
+            if cpu_usec is not None:
+                previous = (now, cpu_usec, disk_read, disk_written)
+
+            next_tick += interval
+            time.sleep(max(next_tick - time.monotonic(), 0))
+
+    if gpu is not None:
+        gpu.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--container", help="Name of the docker container")
+    target.add_argument("--cgroup", help="cgroup v2 directory to sample")
+    parser.add_argument("--disk", required=True, help="Block device, e.g. nvme0n1")
+    parser.add_argument("--output", required=True, help="CSV file to append to")
+    parser.add_argument(
+        "--interval", type=float, default=0.1, help="Seconds between samples"
+    )
+    parser.add_argument("--gpu-device", type=int, help="GPU index for GPU columns")
+    parser.add_argument("--pid", type=int, help="Stop when this process exits")
+    args = parser.parse_args()
+
+    try:
+        sample(
+            args.output,
+            args.disk,
+            args.interval,
+            container=args.container,
+            cgroup=args.cgroup,
+            gpu_device=args.gpu_device,
+            pid=args.pid,
+        )
+    except KeyboardInterrupt:
+        sys.exit(0)